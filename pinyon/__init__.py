@@ -1,8 +1,12 @@
 import importlib
+import re
+
 import mongoengine as mge
+from mongoengine.base import get_document
 from mongoengine.document import Document
-from mongoengine.errors import DoesNotExist
+from mongoengine.errors import NotRegistered
 from mongoengine.fields import StringField
+from mongoengine.queryset import QuerySet
 
 __author__ = 'Logan Ward'
 
@@ -16,6 +20,12 @@ mongodb_settings = dict(
 )
 """Settings for MongoDB server"""
 
+_registered_classes = set()
+"""Classes that have already been registered by this process. Tuples of (module name, class name)"""
+
+_unknown_hierarchies = set()
+"""Class hierarchies that were not found in the KnownClass database"""
+
 
 class KnownClass(Document):
     """Record of a certain type of document being present in database
@@ -23,23 +33,124 @@ class KnownClass(Document):
     This collection is designed for storing the full class name (i.e., including module) of a class, so that it
     """
 
+    meta = {'indexes': ['class_hierarchy']}
+
     module_name = StringField(required=True)
     """Name of the module of class being registered"""
 
     class_name = StringField(required=True, unique_with=['module_name'])
     """Name of the class being registered"""
 
+    class_hierarchy = StringField()
+    """Class hierarchy used by mongoengine to identify documents of this class (e.g., WorkflowTool.FilterTransformer)"""
+
     @staticmethod
     def register_class(obj):
         """Register a class in the KnownClass database
 
+        Each class is only registered once per process
+
         :param obj: Object to be registered
         """
-        try:
-            KnownClass.objects.get(module_name=obj.__module__, class_name=obj.__class__.__name__)
-        except DoesNotExist:
-            # Create it
-            KnownClass(module_name = obj.__module__, class_name = obj.__class__.__name__).save()
+        key = (obj.__module__, obj.__class__.__name__)
+        if key in _registered_classes:
+            return
+
+        # Create it, or fill in the hierarchy of an older record
+        KnownClass.objects(module_name=key[0], class_name=key[1]).update_one(
+            set__class_hierarchy=getattr(obj, '_class_name', None), upsert=True)
+        _registered_classes.add(key)
+
+    @staticmethod
+    def get_subclasses(root):
+        """Get all known classes that are part of a certain class hierarchy
+
+        Does not create instances of the classes.
+
+        :param root: string, name of the class hierarchy (e.g., WorkflowTool)
+        :return: list of tuples (module name, class name), sorted by class name
+        """
+
+        output = []
+        for known in KnownClass.objects:
+            hierarchy = known.class_hierarchy
+
+            # Records made before the hierarchy was stored need to be imported once
+            if hierarchy is None:
+                try:
+                    hierarchy = getattr(get_class(known.module_name, known.class_name), '_class_name', None)
+                except Exception:
+                    continue
+                if hierarchy is not None:
+                    known.update(set__class_hierarchy=hierarchy)
+
+            if hierarchy is not None and (hierarchy == root or hierarchy.startswith(root + '.')):
+                output.append((known.module_name, known.class_name))
+        return sorted(output, key=lambda x: x[1])
+
+
+class LazyClassQuerySet(QuerySet):
+    """Query set that finds documents of every subclass, including those that have not been imported yet
+
+    By default, mongoengine only queries for the subclasses that have already been imported."""
+
+    def __init__(self, document, collection):
+        super(LazyClassQuerySet, self).__init__(document, collection)
+
+        if document._meta.get('allow_inheritance') is True:
+            # mongoengine 0.19 renamed the query on the class from _initial_query to _cls_query
+            attribute = '_cls_query' if hasattr(self, '_cls_query') else '_initial_query'
+            setattr(self, attribute, self.get_class_query(document))
+
+    @staticmethod
+    def get_class_query(document):
+        """Get the query that matches documents of a class and all of its subclasses
+
+        :param document: class, document class
+        :return: dict, query on the `_cls` field"""
+
+        if '.' not in document._class_name:
+            # All documents in the collection are part of this hierarchy
+            return {}
+        return {'_cls': {'$regex': '^%s(\\.|$)' % re.escape(document._class_name)}}
+
+
+class LazyClassMixin(object):
+    """Mixin for documents with subclasses that are imported the first time a document of that class is loaded
+
+    Documents using this mixin should also use `LazyClassQuerySet` as their queryset class"""
+
+    @classmethod
+    def _from_son(cls, son, *args, **kwargs):
+        load_document_class(son.get('_cls'))
+        return super(LazyClassMixin, cls)._from_son(son, *args, **kwargs)
+
+
+def load_document_class(class_hierarchy):
+    """Make sure the class of a document is imported
+
+    :param class_hierarchy: string, class hierarchy stored with the document (i.e., its _cls field)
+    """
+
+    if class_hierarchy is None or class_hierarchy in _unknown_hierarchies:
+        return
+
+    # Check if it is already imported
+    try:
+        get_document(class_hierarchy)
+        return
+    except NotRegistered:
+        pass
+
+    # Find the module holding that class
+    class_name = class_hierarchy.split('.')[-1]
+    known = KnownClass.objects(class_hierarchy=class_hierarchy).first()
+    if known is None:
+        known = KnownClass.objects(class_name=class_name).first()
+    if known is None:
+        _unknown_hierarchies.add(class_hierarchy)
+        return
+    get_class(known.module_name, known.class_name)
 
 
 def connect_to_database(**setting_overrides):
@@ -62,9 +173,22 @@ def connect_to_database(**setting_overrides):
     )
 
 
+def ensure_indexes():
+    """Make sure the indexes used by common queries exist in the database"""
+    from pinyon.extract import BaseExtractor
+    from pinyon.tool import WorkflowTool
+    from pinyon.toolchain import ToolChain
+
+    for document in [KnownClass, BaseExtractor, WorkflowTool, ToolChain]:
+        document.ensure_indexes()
+
+
 def import_all_known_classes(debug=False):
     """Imports all classes known in the KnownClass database
 
+    Classes are otherwise imported as needed when documents are loaded from the database,
+    so this is only needed when instances of every class are desired
+
     :param debug: boolean, whether to print which classes are being imported
     :return: dict, key is a tuple (module name, class name) and value is the instantiated class
     """
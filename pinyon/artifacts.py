@@ -1,12 +1,19 @@
 """Classes used to store results from processing steps, and facilitate converting them to different formats"""
 import dill as pickle
 from tempfile import mkstemp
+from cStringIO import StringIO
+import hashlib
 import json
+import marshal
+import pstats
 
 import os
 from mongoengine.document import EmbeddedDocument
 from mongoengine.fields import *
 
+from pinyon import metrics
+from pinyon.compression import CompressedBinaryField
+
 
 class Artifact(EmbeddedDocument):
     """Holds a output from a tool, and facilitates transforming it into other, useful formats"""
@@ -17,7 +24,45 @@ class Artifact(EmbeddedDocument):
 
     description = StringField(required=True, help_text='Longer description of this artifact')
 
-    object = BinaryField(required=True, help_text='Raw data for this artifact')
+    object = CompressedBinaryField(required=True, help_text='Raw data for this artifact')
+
+    rendered = MapField(CompressedBinaryField(lazy=False), help_text='Outputs that have already been rendered')
+    """Previously-rendered outputs. Key is produced by `get_render_key`. Cleared when the object changes"""
+
+    max_rendered_size = 4 * 1024 * 1024
+    """Largest rendered output that will be stored, in bytes"""
+
+    def get_render_key(self, target_format, **kwargs):
+        """Get the key used to store a rendered output
+
+        :param target_format: string, desired format for the output
+        :return: string, key"""
+
+        if len(kwargs) == 0:
+            return target_format
+        options = hashlib.sha1(json.dumps(kwargs, sort_keys=True, default=str)).hexdigest()
+        return '%s-%s' % (target_format, options[:16])
+
+    def clear_rendered(self):
+        """Remove any previously-rendered outputs"""
+        self.rendered = {}
+
+    def is_rendered(self, target_format, **kwargs):
+        """Check whether an output has already been rendered
+
+        :param target_format: string, desired format for the output
+        :return: boolean"""
+        return self.rendered is not None and self.get_render_key(target_format, **kwargs) in self.rendered
+
+    def get_digest(self):
+        """Get a hash of the contents of this artifact
+
+        :return: string, SHA1 hash of the raw data"""
+
+        data = self.object
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        return hashlib.sha1(data if data is not None else '').hexdigest()
 
     def available_formats(self):
         """List the available output formats for this data
@@ -39,7 +84,33 @@ class Artifact(EmbeddedDocument):
     def render_output(self, target_format, **kwargs):
         """Handles turning the data into the required format
 
-        kwargs are, potentially, used by the conversion
+        kwargs are, potentially, used by the conversion. Outputs are stored after rendering, so that they need
+        not be rendered again. Subclasses implement the conversion in `_render_output`
+
+        :param target_format: string, desired format for the output
+        :return: probably string, output rendered into the desired form
+        """
+
+        # Use the stored copy, if available
+        key = self.get_render_key(target_format, **kwargs)
+        if self.rendered is not None and key in self.rendered:
+            stored = self.rendered[key]
+            return stored[1:].decode('utf-8') if stored[:1] == 'u' else stored[1:]
+
+        output = self._render_output(target_format, **kwargs)
+
+        # Store it, unless it is just the raw data or too large
+        if output is not None and output is not self.object and len(output) <= self.max_rendered_size:
+            if self.rendered is None:
+                self.rendered = {}
+            if isinstance(output, unicode):
+                self.rendered[key] = 'u' + output.encode('utf-8')
+            else:
+                self.rendered[key] = 'b' + output
+        return output
+
+    def _render_output(self, target_format, **kwargs):
+        """Convert the data into the required format
 
         :param target_format: string, desired format for the output
         :return: probably string, output rendered into the desired form
@@ -72,15 +143,18 @@ class PythonArtifact(Artifact):
 
     def set_object(self, x):
         self.object = pickle.dumps(x)
+        self.clear_rendered()
+        metrics.artifact_bytes.inc(len(self.object), type=self.__class__.__name__, operation='serialize')
 
     def get_object(self):
+        metrics.artifact_bytes.inc(len(self.object), type=self.__class__.__name__, operation='deserialize')
         return pickle.loads(self.object)
 
-    def render_output(self, target_format, **kwargs):
+    def _render_output(self, target_format, **kwargs):
         if target_format == 'pkl':
             return self.object
         else:
-            super(PythonArtifact, self).render_output(target_format, **kwargs)
+            return super(PythonArtifact, self)._render_output(target_format, **kwargs)
 
 
 class PandasArtifact(PythonArtifact):
@@ -100,12 +174,14 @@ class PandasArtifact(PythonArtifact):
     def default_format(self):
         return 'excel'
 
-    def render_output(self, target_format, **kwargs):
+    def _render_output(self, target_format, **kwargs):
 
         # Get the pandas object
         data = self.get_object()
 
         if target_format == 'csv':
+            # Python 2 pandas writes ASCII by default, which fails for any other characters
+            kwargs.setdefault('encoding', 'utf-8')
             return data.to_csv(index=False, **kwargs)
         elif target_format == 'excel':
             fp, filename = mkstemp(suffix='.xlsx')
@@ -118,7 +194,7 @@ class PandasArtifact(PythonArtifact):
         elif target_format == 'html':
             return data.to_html(index=False)
         else:
-            return super(PandasArtifact, self).render_output(target_format, **kwargs)
+            return super(PandasArtifact, self)._render_output(target_format, **kwargs)
 
 
 class BokehArtifact(Artifact):
@@ -143,11 +219,13 @@ class BokehArtifact(Artifact):
         from bokeh.embed import components
         script, div = components(plot)
         self.object = json.dumps(dict(script=script, div=div))
+        self.clear_rendered()
+        metrics.artifact_bytes.inc(len(self.object), type=self.__class__.__name__, operation='serialize')
 
     def default_format(self):
         return 'html'
 
-    def render_output(self, target_format, **kwargs):
+    def _render_output(self, target_format, **kwargs):
 
         if target_format == 'components':
             return self.object
@@ -175,4 +253,62 @@ class BokehArtifact(Artifact):
 </body>
             """%(self.name, self.description, data['div'], data['script'])
         else:
-            super(BokehArtifact, self).render_output(target_format, **kwargs)
\ No newline at end of file
+            return super(BokehArtifact, self)._render_output(target_format, **kwargs)
+
+
+class ProfileArtifact(Artifact):
+    """Stores a CPU profile collected with cProfile
+
+    The profile is saved in the format written by `pstats.Stats.dump_stats`, so downloads can be read with pstats
+    or other profile viewers (e.g., snakeviz)"""
+
+    max_functions = 50
+    """Number of functions listed in the text summary"""
+
+    def available_formats(self):
+        output = super(ProfileArtifact, self).available_formats()
+
+        output['pstats'] = dict(extension='prof', description='Profile that can be read with the pstats module')
+        output['txt'] = dict(extension='txt', description='Functions that took the most time, including calls ' +
+                                                          'they made')
+        del output['raw']
+
+        return output
+
+    def default_format(self):
+        return 'txt'
+
+    def set_object(self, profiler):
+        """Store the results of a profiler
+
+        :param profiler: Profile, profiler that has finished collecting data"""
+        profiler.create_stats()
+        self.object = marshal.dumps(profiler.stats)
+        self.clear_rendered()
+        metrics.artifact_bytes.inc(len(self.object), type=self.__class__.__name__, operation='serialize')
+
+    def get_object(self, stream=None):
+        """Load the profile
+
+        :param stream: file-like object, where `Stats` prints its reports
+        :return: Stats, profile statistics"""
+        metrics.artifact_bytes.inc(len(self.object), type=self.__class__.__name__, operation='deserialize')
+
+        # pstats only reads profiles from files
+        fp, filename = mkstemp(suffix='.prof')
+        try:
+            with os.fdopen(fp, 'wb') as f:
+                f.write(self.object)
+            return pstats.Stats(filename, stream=stream)
+        finally:
+            os.remove(filename)
+
+    def _render_output(self, target_format, **kwargs):
+        if target_format == 'pstats':
+            return self.object
+        elif target_format == 'txt':
+            output = StringIO()
+            self.get_object(stream=output).sort_stats('cumulative').print_stats(self.max_functions)
+            return output.getvalue()
+        else:
+            return super(ProfileArtifact, self)._render_output(target_format, **kwargs)
\ No newline at end of file
@@ -0,0 +1,206 @@
+"""Command-line interface for running pinyon tools without the web application
+
+Database settings are read from the command line or, if not provided, the environment variables
+PINYON_DB_NAME, PINYON_DB_HOST, PINYON_DB_PORT, PINYON_DB_USER, and PINYON_DB_PASSWORD. Any setting not
+found in either place is taken from `pinyon.mongodb_settings`.
+
+Exit codes:
+    0 -> All tools ran successfully
+    1 -> At least one tool failed to run
+    2 -> Command line arguments were invalid
+    3 -> Requested tool or toolchain was not found
+"""
+import argparse
+import logging
+import os
+import sys
+
+from mongoengine.errors import DoesNotExist, ValidationError
+
+from pinyon import mongodb_settings, connect_to_database, ensure_indexes
+
+EXIT_OK = 0
+EXIT_FAILURE = 1
+EXIT_USAGE = 2
+EXIT_NOT_FOUND = 3
+
+environment_variables = dict(
+    name='PINYON_DB_NAME',
+    host='PINYON_DB_HOST',
+    port='PINYON_DB_PORT',
+    user='PINYON_DB_USER',
+    pswd='PINYON_DB_PASSWORD'
+)
+"""Names of the environment variables holding each database setting"""
+
+
+def get_database_settings(args, environ=None):
+    """Get the settings used to connect to the database
+
+    :param args: Namespace, parsed command line arguments
+    :param environ: dict, environment variables. Defaults to `os.environ`
+    :return: dict, settings to pass to `connect_to_database`
+    """
+
+    if environ is None:
+        environ = os.environ
+
+    settings = dict(mongodb_settings)
+    for key, variable in environment_variables.items():
+        if variable in environ:
+            settings[key] = environ[variable]
+        value = getattr(args, 'db_%s' % key, None)
+        if value is not None:
+            settings[key] = value
+    settings['port'] = int(settings['port'])
+    return settings
+
+
+def make_parser():
+    """Make the parser for the command line arguments
+
+    :return: ArgumentParser"""
+
+    parser = argparse.ArgumentParser(prog='pinyon', description='Run pinyon tools and toolchains')
+
+    # Database settings
+    parser.add_argument('--db-name', dest='db_name', help='Name of the database')
+    parser.add_argument('--db-host', dest='db_host', help='Host of the MongoDB server')
+    parser.add_argument('--db-port', dest='db_port', type=int, help='Port of the MongoDB server')
+    parser.add_argument('--db-user', dest='db_user', help='User name for the database')
+    parser.add_argument('--db-password', dest='db_pswd', help='Password for the database')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Print progress messages')
+
+    commands = parser.add_subparsers(dest='command')
+
+    # Running a single tool or subtree
+    tool = commands.add_parser('run-tool', help='Re-run a single tool')
+    tool.add_argument('tool_id', help='ID of the tool')
+    tool.add_argument('--subtree', action='store_true', help='Also re-run every tool after this one')
+    tool.add_argument('--jobs', type=int, default=1, help='Number of tools to run in parallel')
+    tool.add_argument('--profile', action='store_true',
+                      help='Store a CPU profile of the run as the "profile" output of the tool')
+
+    # Running a whole toolchain
+    toolchain = commands.add_parser('run-toolchain', help='Re-run every tool in a toolchain')
+    toolchain.add_argument('name', help='Name of the toolchain')
+    toolchain.add_argument('--skip-extractor', action='store_true',
+                           help='Use the data currently stored by the extractor rather than re-extracting it')
+    toolchain.add_argument('--jobs', type=int, default=1, help='Number of tools to run in parallel')
+
+    # Prerendering plots for decision tools
+    prerender = commands.add_parser('prerender', help='Render the plots for each entry of a decision tool')
+    prerender.add_argument('tool_id', help='ID of the tool')
+    prerender.add_argument('--start', type=int, help='Index of the first row to render')
+    prerender.add_argument('--stop', type=int, help='Index of the row after the last to render')
+    prerender.add_argument('--jobs', type=int, default=1, help='Number of notebooks run at the same time')
+
+    # Database maintenance
+    commands.add_parser('ensure-indexes', help='Create the indexes used by pinyon, if they do not exist')
+
+    return parser
+
+
+def run_tool(args):
+    """Run a single tool, or a tool and every tool after it
+
+    :param args: Namespace, parsed command line arguments
+    :return: int, exit code"""
+    from pinyon.tool import WorkflowTool
+    from pinyon.toolchain import run_tool_tree
+
+    try:
+        tool = WorkflowTool.objects.get(id=args.tool_id)
+    except (DoesNotExist, ValidationError):
+        logging.error('No such tool: %s' % args.tool_id)
+        return EXIT_NOT_FOUND
+
+    if args.subtree:
+        if args.profile:
+            logging.error('Profiles can only be collected when running a single tool')
+            return EXIT_USAGE
+        failures = run_tool_tree([tool], n_jobs=args.jobs)
+        return EXIT_FAILURE if len(failures) > 0 else EXIT_OK
+
+    try:
+        tool.run(ignore_results=True, save_results=True, profile=args.profile)
+    except Exception:
+        logging.exception('Failed to run %s' % tool.name)
+        return EXIT_FAILURE
+    return EXIT_OK
+
+
+def prerender(args):
+    """Render the plots for each entry of a decision tool
+
+    :param args: Namespace, parsed command line arguments
+    :return: int, exit code"""
+    from pinyon.tool import WorkflowTool
+
+    try:
+        tool = WorkflowTool.objects.get(id=args.tool_id)
+    except (DoesNotExist, ValidationError):
+        logging.error('No such tool: %s' % args.tool_id)
+        return EXIT_NOT_FOUND
+    if not hasattr(tool, 'prerender_entries'):
+        logging.error('Tool %s does not render plots for each entry' % tool.name)
+        return EXIT_USAGE
+
+    try:
+        count = tool.prerender_entries(start=args.start, stop=args.stop, n_jobs=args.jobs, save_results=True)
+    except Exception:
+        logging.exception('Failed to render plots for %s' % tool.name)
+        return EXIT_FAILURE
+    logging.info('Rendered plots for %d entries' % count)
+    return EXIT_OK
+
+
+def run_toolchain(args):
+    """Run all of the tools in a toolchain
+
+    :param args: Namespace, parsed command line arguments
+    :return: int, exit code"""
+    from pinyon.toolchain import ToolChain
+
+    try:
+        toolchain = ToolChain.objects.get(name=args.name)
+    except DoesNotExist:
+        logging.error('No such toolchain: %s' % args.name)
+        return EXIT_NOT_FOUND
+
+    try:
+        failures = toolchain.run(n_jobs=args.jobs, rerun_extractor=not args.skip_extractor)
+    except Exception:
+        logging.exception('Failed to run the extractor for %s' % toolchain.name)
+        return EXIT_FAILURE
+    return EXIT_FAILURE if len(failures) > 0 else EXIT_OK
+
+
+def main(argv=None):
+    """Entry point for the `pinyon` command
+
+    :param argv: list, command line arguments. Defaults to `sys.argv[1:]`
+    :return: int, exit code"""
+
+    args = make_parser().parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    # Connect to the database
+    connect_to_database(**get_database_settings(args))
+
+    # Run the command
+    if args.command == 'run-tool':
+        return run_tool(args)
+    elif args.command == 'run-toolchain':
+        return run_toolchain(args)
+    elif args.command == 'prerender':
+        return prerender(args)
+    elif args.command == 'ensure-indexes':
+        ensure_indexes()
+        return EXIT_OK
+    return EXIT_USAGE
+
+
+if __name__ == '__main__':
+    sys.exit(main())
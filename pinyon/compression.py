@@ -0,0 +1,182 @@
+"""Tools for compressing large binary objects before storing them in the database
+
+Each compressed blob starts with a short header recording which codec was used to compress it, so blobs written
+with any codec can be read back regardless of the current settings. Blobs without a header (e.g., those written
+before compression was added) are returned unchanged.
+
+Blobs read from the database are only decompressed when the field is accessed, and blobs that have not changed are
+written back without being compressed again.
+"""
+import logging
+import os
+import zlib
+
+from mongoengine.fields import BinaryField
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+_header = b'\x00PNYC'
+"""Marks the start of a compressed blob. Followed by a single byte identifying the codec"""
+
+default_codec = os.environ.get('PINYON_COMPRESSION_CODEC', 'zlib')
+"""Codec used to compress new blobs. One of: zlib, zstd, lz4, none"""
+
+_codec_ids = dict(zlib=b'\x01', zstd=b'\x02', lz4=b'\x03')
+"""Byte used to identify each codec in the header of a blob"""
+
+
+def available_codecs():
+    """List the codecs that can be used on this system
+
+    :return: list of string, names of codecs"""
+
+    output = ['none', 'zlib']
+    if zstandard is not None:
+        output.append('zstd')
+    if lz4_frame is not None:
+        output.append('lz4')
+    return output
+
+
+def compress(data, codec=None):
+    """Compress a blob
+
+    :param data: string, data to be compressed
+    :param codec: string, name of codec to use. Defaults to `default_codec`
+    :return: string, compressed data (including the header)
+    """
+
+    if data is None:
+        return None
+
+    # Pick the codec
+    if codec is None:
+        codec = default_codec
+    if codec not in ['none', 'zlib', 'zstd', 'lz4']:
+        raise Exception('No such codec: %s' % codec)
+    if codec not in available_codecs():
+        logging.warning('Codec %s is not installed. Compressing with zlib' % codec)
+        codec = 'zlib'
+
+    # Compress the data
+    if codec == 'none':
+        return data
+    elif codec == 'zlib':
+        compressed = zlib.compress(data, 6)
+    elif codec == 'zstd':
+        compressed = zstandard.ZstdCompressor(level=3).compress(data)
+    else:
+        compressed = lz4_frame.compress(data)
+    return _header + _codec_ids[codec] + compressed
+
+
+def decompress(data):
+    """Decompress a blob
+
+    :param data: string, data to be decompressed
+    :return: string, decompressed data
+    """
+
+    if data is None or not data.startswith(_header):
+        return data
+
+    # Get the codec
+    codec_id = data[len(_header):len(_header) + 1]
+    compressed = data[len(_header) + 1:]
+
+    # Decompress it
+    if codec_id == _codec_ids['zlib']:
+        return zlib.decompress(compressed)
+    elif codec_id == _codec_ids['zstd']:
+        if zstandard is None:
+            raise Exception('Blob was compressed with zstd, which is not installed')
+        return zstandard.ZstdDecompressor().decompress(compressed)
+    elif codec_id == _codec_ids['lz4']:
+        if lz4_frame is None:
+            raise Exception('Blob was compressed with lz4, which is not installed')
+        return lz4_frame.decompress(compressed)
+    raise Exception('Unrecognized codec in compressed blob')
+
+
+class DecompressedBlob(str):
+    """Data that was decompressed from a blob. Keeps the compressed form, so it can be stored without compressing
+    the data again"""
+
+    compressed = None
+    """Compressed form of this data"""
+
+
+class CompressedBlob(object):
+    """Compressed data read from the database that has not yet been decompressed"""
+
+    def __init__(self, compressed):
+        """
+        :param compressed: string, compressed data (including the header)
+        """
+        self.compressed = compressed
+
+    def decompress(self):
+        """Decompress the data
+
+        :return: DecompressedBlob, decompressed data"""
+        output = DecompressedBlob(decompress(self.compressed))
+        output.compressed = self.compressed
+        return output
+
+
+class CompressedBinaryField(BinaryField):
+    """Binary field that is compressed when stored in the database
+
+    The value of the field is always the uncompressed data. Values read from the database are decompressed the first
+    time the field is accessed, unless `lazy` is False"""
+
+    def __init__(self, codec=None, lazy=True, **kwargs):
+        """
+        :param codec: string, name of codec used to compress this field. Defaults to `default_codec`
+        :param lazy: boolean, whether to wait until the field is accessed to decompress values. Must be False when
+            used inside of other fields (e.g., MapField), which do not access values through this field
+        """
+        self.codec = codec
+        self.lazy = lazy
+        super(CompressedBinaryField, self).__init__(**kwargs)
+
+    def __get__(self, instance, owner):
+        value = super(CompressedBinaryField, self).__get__(instance, owner)
+        if isinstance(value, CompressedBlob):
+            value = value.decompress()
+            instance._data[self.name] = value
+        return value
+
+    def to_mongo(self, value):
+        # Reuse the compressed form of values that have not changed since they were read
+        if isinstance(value, (CompressedBlob, DecompressedBlob)) and value.compressed is not None:
+            return super(CompressedBinaryField, self).to_mongo(value.compressed)
+        return super(CompressedBinaryField, self).to_mongo(compress(value, self.codec))
+
+    def to_python(self, value):
+        if isinstance(value, (CompressedBlob, DecompressedBlob)):
+            return value
+
+        # Blobs that were stored as strings are converted to binary
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+
+        # Values that are not compressed (e.g., those passed to the constructor of a document) are unchanged
+        if value is None or not value.startswith(_header):
+            return value
+        blob = CompressedBlob(value)
+        return blob if self.lazy else blob.decompress()
+
+    def validate(self, value):
+        # Values that have not been decompressed were read from the database, and are already valid
+        if isinstance(value, CompressedBlob):
+            return
+        super(CompressedBinaryField, self).validate(value)
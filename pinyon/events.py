@@ -0,0 +1,159 @@
+"""Records of progress while tools and extractors are run
+
+Each time a tool or extractor starts, finishes or fails, an event is stored in a capped collection. The web
+application streams these events to clients as they arrive (see `stream_events`), so that users can follow the
+progress of a long run. Events are read in the order they were stored, using a tailable cursor.
+"""
+import json
+import logging
+import time
+from datetime import datetime
+
+from bson import ObjectId
+from mongoengine import Document
+from pymongo import CursorType
+from mongoengine.fields import DateTimeField, FloatField, IntField, ObjectIdField, StringField
+
+__author__ = 'Logan Ward'
+
+max_stream_time = 30
+"""Longest time a single request can stream events, in seconds. Each stream holds a thread of the web server"""
+
+
+class RunEvent(Document):
+    """Marks a change in the status of a tool or extractor"""
+
+    meta = {
+        'max_documents': 100000,
+        'max_size': 64 * 1024 * 1024,
+        'indexes': [('toolchain', 'id')]
+    }
+
+    toolchain = ObjectIdField(required=True)
+    """ID of the toolchain this event is associated with"""
+
+    source_type = StringField(required=True, choices=['tool', 'extractor'])
+    """Type of object that created this event"""
+
+    source_id = StringField(required=True)
+    """ID of the tool or extractor"""
+
+    source_name = StringField(required=True)
+    """Name of the tool or extractor"""
+
+    event = StringField(required=True, choices=['started', 'finished', 'failed'])
+    """What happened"""
+
+    time = DateTimeField(required=True, default=datetime.now)
+    """When the event occurred"""
+
+    duration = FloatField()
+    """How long the run took, in seconds. Only for finished and failed runs"""
+
+    rows_in = IntField()
+    """Number of rows in the input data"""
+
+    rows_out = IntField()
+    """Number of rows in the output data"""
+
+    error = StringField()
+    """Error that caused a run to fail"""
+
+    def to_dict(self):
+        """Get this event as a dictionary that can be rendered as JSON
+
+        :return: dict"""
+        output = dict((k, self[k]) for k in ['source_type', 'source_id', 'source_name', 'event', 'duration',
+                                              'rows_in', 'rows_out', 'error'])
+        output['id'] = str(self.id)
+        output['toolchain'] = str(self.toolchain)
+        output['time'] = self.time.isoformat()
+        return output
+
+
+def publish_event(toolchains, source_type, source_id, source_name, event, **kwargs):
+    """Record an event for several toolchains
+
+    Failures are logged but not raised, so that a problem with storing events never stops a run
+
+    :param toolchains: list of ObjectId, IDs of the toolchains associated with this event
+    :param source_type: string, type of the object that created the event ('tool' or 'extractor')
+    :param source_id: string, ID of that object
+    :param source_name: string, name of that object
+    :param event: string, what happened ('started', 'finished' or 'failed')
+    :param kwargs: other fields of the event (e.g., duration, rows_in, rows_out, error)
+    """
+    for toolchain in toolchains:
+        try:
+            RunEvent(toolchain=toolchain, source_type=source_type, source_id=str(source_id),
+                     source_name=source_name, event=event, **kwargs).save()
+        except Exception:
+            logging.exception('Failed to record %s event for %s' % (event, source_name))
+
+
+def format_event(event):
+    """Render an event in the server-sent events format
+
+    :param event: RunEvent, event to be rendered
+    :return: string, message for the event stream"""
+    return 'id: %s\ndata: %s\n\n' % (event.id, json.dumps(event.to_dict()))
+
+
+def stream_events(toolchain, after=None, timeout=max_stream_time, interval=1.0, heartbeat=15, history=20):
+    """Generate a stream of server-sent events for a toolchain
+
+    Events are sent in the order they were stored, which may differ from the order of their IDs when several
+    processes publish events
+
+    :param toolchain: ObjectId, ID of the toolchain
+    :param after: string, ID of the last event the client received. If None, or if that event is no longer
+        stored, starts with the most recent events
+    :param timeout: float, how long to stream events, in seconds. Clients reconnect automatically after the stream ends
+    :param interval: float, longest time to wait for new events before checking whether the stream should end
+    :param heartbeat: float, how often to send a comment to keep the connection open, in seconds
+    :param history: int, number of recent events to send first when `after` is None
+    :return: iterator over string, messages for the event stream
+    """
+
+    collection = RunEvent._get_collection()
+    query = {RunEvent._fields['toolchain'].db_field: toolchain}
+
+    # Send the recent history, unless resuming from an event that is still stored
+    if after is not None:
+        after = ObjectId(after)
+    if after is None or collection.find_one(dict(query, _id=after), {'_id': 1}) is None:
+        recent = list(collection.find(query).sort('$natural', -1).limit(history))
+        for doc in reversed(recent):
+            yield format_event(RunEvent._from_son(doc))
+        after = recent[0]['_id'] if len(recent) > 0 else None
+
+    # Follow new events, skipping those up to and including the last one sent
+    deadline = time.time() + timeout
+    last_sent = time.time()
+    cursor = None
+    while time.time() < deadline:
+        if cursor is None or not cursor.alive:
+            # Cursors on an empty collection close immediately
+            if cursor is not None:
+                time.sleep(interval)
+            cursor = collection.find(query, cursor_type=CursorType.TAILABLE_AWAIT)
+            cursor.max_await_time_ms(int(interval * 1000))
+            searching = after is not None
+
+        try:
+            doc = cursor.next()
+        except StopIteration:
+            # No new events. If the last event sent was not found, it is no longer stored and the rest are newer
+            searching = False
+            doc = None
+
+        if doc is not None:
+            if searching:
+                searching = doc['_id'] != after
+            else:
+                after = doc['_id']
+                last_sent = time.time()
+                yield format_event(RunEvent._from_son(doc))
+        elif time.time() - last_sent > heartbeat:
+            last_sent = time.time()
+            yield ': keep-alive\n\n'
@@ -1,23 +1,33 @@
 """This module contains code for extracting data 
 from various data repositories"""
+import hashlib
+import json
 import logging
 import pickle as pickle
+import time
 
 import datetime
 from mongoengine import Document
-from mongoengine.fields import DateTimeField, DictField, StringField
+from mongoengine.fields import BooleanField, DateTimeField, DictField, IntField, ListField, StringField
 
 from pinyon.artifacts import PandasArtifact
+from pinyon.compression import CompressedBinaryField
+from pinyon.events import publish_event
 from pinyon.tool import WorkflowTool
-from .. import KnownClass
-from pandas import read_excel
+from .. import KnownClass, LazyClassMixin, LazyClassQuerySet, metrics
+from pandas import DataFrame, concat, read_csv, read_excel, to_numeric
+
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
 
 __author__ = 'Logan Ward'
 
 
-class BaseExtractor(Document):
+class BaseExtractor(LazyClassMixin, Document):
     """Base class for extracting data from a certain resource"""
-    meta = {'allow_inheritance': True}
+    meta = {'allow_inheritance': True, 'queryset_class': LazyClassQuerySet, 'index_cls': False}
     
     name = StringField(required=True, unique=True)
     """Name of the extractor"""
@@ -33,7 +43,7 @@ class BaseExtractor(Document):
     _data_cache = None
     """Storage for DataFrame object generated during extraction"""
 
-    result = StringField(required=False)
+    result = CompressedBinaryField(required=False)
     """Storage for the pickled form of _data_cache"""
     
     def get_data(self, ignore_cache=False, save_results=False, run_subsequent=False):
@@ -63,7 +73,20 @@ class BaseExtractor(Document):
         else:
             # Run the extractor
             logging.info("Running extractor: %s"%self.name)
-            self._data_cache = self._run_extraction()
+            self.publish_event('started')
+            start_time = time.time()
+            try:
+                self._data_cache = self._run_extraction()
+            except Exception, e:
+                duration = time.time() - start_time
+                metrics.extractor_runs.inc(type=self.__class__.__name__, status='failed')
+                metrics.extractor_duration.observe(duration, type=self.__class__.__name__)
+                self.publish_event('failed', duration=duration, error='%s: %s' % (e.__class__.__name__, e))
+                raise
+            duration = time.time() - start_time
+            metrics.extractor_runs.inc(type=self.__class__.__name__, status='finished')
+            metrics.extractor_duration.observe(duration, type=self.__class__.__name__)
+            self.publish_event('finished', duration=duration, rows_out=len(self._data_cache))
             self.last_exported = datetime.datetime.now()
 
             # Save results, if needed
@@ -85,6 +108,20 @@ class BaseExtractor(Document):
 
         return output
 
+    def get_dataframe(self):
+        """Get the extracted data as a DataFrame, without storing it in an artifact
+
+        Runs the extraction if no data has been stored
+
+        :return: DataFrame, extracted data"""
+
+        if self._data_cache is None:
+            if self.result is not None:
+                self._data_cache = pickle.loads(self.result)
+            else:
+                self.get_data()
+        return self._data_cache
+
     def _run_extraction(self):
         """Actually perform the data extraction.
 
@@ -109,6 +146,17 @@ class BaseExtractor(Document):
         from ..toolchain import ToolChain
         return ToolChain.objects(extractor=self)
 
+    def publish_event(self, event, **kwargs):
+        """Record a change in the status of this extractor for each toolchain that uses it
+
+        :param event: string, what happened ('started', 'finished' or 'failed')
+        :param kwargs: other fields of the event (see `pinyon.events.RunEvent`)
+        """
+        if self.id is None:
+            return
+        toolchains = [t.id for t in self.get_toolchains().only('id')]
+        publish_event(toolchains, 'extractor', self.id, self.name, event, **kwargs)
+
     def get_next_steps(self):
         """Get all tool that directly pull data from this extractor"""
 
@@ -122,11 +170,181 @@ class BaseExtractor(Document):
         return output
 
 
-class ExcelExtractor(BaseExtractor):
-    """Extractor designed to pull data from excel files"""
+def get_file_hash(path, block_size=1 << 20):
+    """Compute the hash of a file without reading it all into memory
+
+    :param path: string, path to the file
+    :param block_size: int, number of bytes read at a time
+    :return: string, SHA1 hash of the file contents
+    """
+
+    output = hashlib.sha1()
+    with open(path, 'rb') as fp:
+        block = fp.read(block_size)
+        while len(block) > 0:
+            output.update(block)
+            block = fp.read(block_size)
+    return output.hexdigest()
+
+
+def downcast_dtypes(data, level='all', categorize=True):
+    """Convert the columns of a DataFrame to the smallest types that can hold them
+
+    :param data: DataFrame, data to be converted. Modified in place
+    :param level: string, what to downcast:
+        'none' -> Nothing
+        'integer' -> Integer columns to the smallest integer type that holds all values (lossless)
+        'all' -> Also convert floating point columns to float32 and repetitive string columns to categories
+    :param categorize: boolean, whether to convert string columns to categories when level is 'all'
+    :return: DataFrame, converted data
+    """
+
+    if level == 'none':
+        return data
+
+    for column in data.columns:
+        series = data[column]
+        kind = series.dtype.kind
+        if kind in 'iu':
+            data[column] = to_numeric(series, downcast='unsigned' if series.min() >= 0 else 'integer')
+        elif kind == 'f' and level == 'all':
+            data[column] = to_numeric(series, downcast='float')
+        elif kind == 'O' and level == 'all' and categorize and len(series) > 0:
+            # Only worthwhile if values are repeated often
+            if series.nunique() < len(series) / 2:
+                data[column] = series.astype('category')
+    return data
+
+
+def read_excel_chunks(path, sheet, chunksize, usecols=None):
+    """Read a sheet from an Excel file a few rows at a time
+
+    Only reads .xlsx files. The first row of the sheet is used as the column names
+
+    :param path: string, path to the Excel file
+    :param sheet: string, name of the sheet
+    :param chunksize: int, number of rows in each chunk
+    :param usecols: list, names of the columns to read. None to read all columns
+    :return: iterator over DataFrames
+    """
+
+    if openpyxl is None:
+        raise Exception('Reading Excel files in chunks requires openpyxl')
+
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = workbook[sheet].iter_rows()
+
+        # Get the columns to be read
+        header = [c.value for c in next(rows)]
+        if usecols is None:
+            columns = range(len(header))
+        else:
+            columns = [i for i, h in enumerate(header) if h in usecols]
+        names = [header[i] for i in columns]
+
+        # Read in the data
+        chunk = []
+        start = 0
+        for row in rows:
+            values = [c.value for c in row]
+            chunk.append([values[i] if i < len(values) else None for i in columns])
+            if len(chunk) >= chunksize:
+                yield DataFrame(chunk, columns=names, index=range(start, start + len(chunk)))
+                start += len(chunk)
+                chunk = []
+        if len(chunk) > 0 or start == 0:
+            yield DataFrame(chunk, columns=names, index=range(start, start + len(chunk)))
+    finally:
+        if hasattr(workbook, 'close'):
+            workbook.close()
+
+
+class FileExtractorMixin(object):
+    """Settings and operations shared by extractors that read data from a file
+
+    Data can be read in chunks, which are each converted to smaller data types before the next chunk is read. This
+    keeps the memory needed to read large files close to the size of the final dataset.
+
+    Extraction is skipped if the file and reading options have not changed since the data was last read."""
 
     path = StringField(required=True)
-    """Path to target Excel file"""
+    """Path to the target file"""
+
+    usecols = ListField(StringField(), default=[])
+    """Names of columns to read. Empty to read all columns"""
+
+    dtypes = DictField()
+    """Data type for certain columns, ex: {'temperature': 'float32'}"""
+
+    chunksize = IntField(min_value=1)
+    """Number of rows to read at a time. None to read the whole file at once"""
+
+    downcast = StringField(default='none', choices=['none', 'integer', 'all'])
+    """Whether to convert columns to smaller data types. See `downcast_dtypes`"""
+
+    skip_unchanged = BooleanField(default=False)
+    """Whether to skip re-reading the file if it has not changed, even when asked to ignore the cached data"""
+
+    source_fingerprint = StringField()
+    """Hash of the file and reading options from the last extraction"""
+
+    def get_read_options(self):
+        """Get the options that control how the file is read
+
+        :return: dict, options"""
+        return dict(usecols=self.usecols, dtypes=self.dtypes, downcast=self.downcast)
+
+    def get_source_fingerprint(self):
+        """Get a hash of the contents of the file and the options used to read it
+
+        :return: string, fingerprint"""
+        options = json.dumps(self.get_read_options(), sort_keys=True, default=str)
+        return hashlib.sha1(get_file_hash(self.path) + options).hexdigest()
+
+    def get_data(self, ignore_cache=False, save_results=False, run_subsequent=False):
+        # Use the previous result if the file has not changed
+        skipped = False
+        if ignore_cache and self.skip_unchanged and self.source_fingerprint is not None \
+                and (self._data_cache is not None or self.result is not None) \
+                and self.get_source_fingerprint() == self.source_fingerprint:
+            logging.info('File for %s is unchanged, skipping extraction' % self.name)
+            ignore_cache = False
+            skipped = True
+
+        output = super(FileExtractorMixin, self).get_data(ignore_cache=ignore_cache, save_results=save_results,
+                                                          run_subsequent=run_subsequent and not skipped)
+
+        # Data are the same, but the user still asked for the next steps to be re-run
+        if skipped and run_subsequent:
+            for tool in self.get_next_steps():
+                tool.run(ignore_results=True, save_results=save_results, run_subsequent=True)
+        return output
+
+    def _combine_chunks(self, chunks):
+        """Assemble a dataset from chunks of a file, downcasting each chunk as it is read
+
+        :param chunks: iterator over DataFrame, chunks of the data
+        :return: DataFrame, full dataset
+        """
+
+        output = []
+        for chunk in chunks:
+            if len(self.dtypes) > 0:
+                chunk = chunk.astype(dict((k, v) for k, v in self.dtypes.items() if k in chunk.columns))
+
+            # Categories are only assigned once the whole dataset is read
+            output.append(downcast_dtypes(chunk, self.downcast, categorize=False))
+
+        data = output[0] if len(output) == 1 else concat(output)
+        return downcast_dtypes(data, self.downcast)
+
+
+class ExcelExtractor(FileExtractorMixin, BaseExtractor):
+    """Extractor designed to pull data from excel files
+
+    Reading in chunks (see `chunksize`) requires openpyxl, only works with .xlsx files, and cannot be combined
+    with `import_options`. The first row of the sheet must hold the column names"""
 
     sheet = StringField(required=True)
     """Name of target sheet in target file"""
@@ -134,5 +352,58 @@ class ExcelExtractor(BaseExtractor):
     import_options = DictField()
     """Any options for the read_excel function of pandas"""
 
+    def get_read_options(self):
+        output = super(ExcelExtractor, self).get_read_options()
+        output.update(sheet=self.sheet, chunksize=self.chunksize, import_options=self.import_options)
+        return output
+
+    def _run_extraction(self):
+        self.source_fingerprint = self.get_source_fingerprint()
+        usecols = self.usecols if len(self.usecols) > 0 else None
+
+        # Read the file a few rows at a time
+        if self.chunksize is not None:
+            if len(self.import_options) > 0:
+                raise Exception('import_options cannot be used when reading Excel files in chunks')
+            return self._combine_chunks(read_excel_chunks(self.path, self.sheet, self.chunksize, usecols=usecols))
+
+        # Read the whole file
+        data = read_excel(self.path, self.sheet, **self.import_options)
+        if usecols is not None:
+            data = data[usecols]
+        return self._combine_chunks([data])
+
+
+class DelimitedTextExtractor(FileExtractorMixin, BaseExtractor):
+    """Extractor designed to pull data from CSV, TSV, or other delimited text files"""
+
+    delimiter = StringField(default=',')
+    """Character separating each field in a row. Use '\\t' for TSV files"""
+
+    memory_map = BooleanField(default=True)
+    """Whether to map the file directly into memory, rather than reading it through a buffer"""
+
+    import_options = DictField()
+    """Any other options for the read_csv function of pandas"""
+
+    def get_read_options(self):
+        output = super(DelimitedTextExtractor, self).get_read_options()
+        output.update(delimiter=self.delimiter, import_options=self.import_options)
+        return output
+
     def _run_extraction(self):
-        return read_excel(self.path, self.sheet, **self.import_options)
\ No newline at end of file
+        self.source_fingerprint = self.get_source_fingerprint()
+
+        # Assemble options for pandas
+        options = dict(self.import_options)
+        options['sep'] = self.delimiter
+        options['memory_map'] = self.memory_map
+        if len(self.usecols) > 0:
+            options['usecols'] = self.usecols
+        if len(self.dtypes) > 0:
+            options['dtype'] = dict(self.dtypes)
+
+        # Read the file
+        if self.chunksize is None:
+            return self._combine_chunks([read_csv(self.path, **options)])
+        return self._combine_chunks(read_csv(self.path, chunksize=self.chunksize, **options))
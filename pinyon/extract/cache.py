@@ -0,0 +1,185 @@
+"""Local storage of records downloaded from remote data sources
+
+Records are stored as JSON lines, one file for each host and template. Each line holds the ID of a record, the hash
+of its contents, and the record itself. Files are read through a memory map, so only the lines being parsed are
+paged into memory.
+"""
+import hashlib
+import json
+import logging
+import mmap
+import os
+from collections import OrderedDict
+from tempfile import mkstemp
+
+__author__ = 'Logan Ward'
+
+
+def get_record_hash(record):
+    """Compute the hash of a record
+
+    :param record: dict, record to be hashed
+    :return: string, SHA1 hash of the JSON form of the record
+    """
+    return hashlib.sha1(json.dumps(record, sort_keys=True, default=str)).hexdigest()
+
+
+def get_records_version(hashes):
+    """Compute a hash that identifies a certain set of records
+
+    :param hashes: list of string, hash of each record, in order
+    :return: string, hash of the set of records
+    """
+    return hashlib.sha1('\n'.join(hashes)).hexdigest()
+
+
+def get_record_id(record):
+    """Get the ID of a record
+
+    :param record: dict, record from MDCS
+    :return: string, value of the `_id` field if present. Otherwise, the hash of the record
+    """
+    if isinstance(record, dict) and '_id' in record:
+        return str(record['_id'])
+    return get_record_hash(record)
+
+
+class RecordCache(object):
+    """Cache of records, keyed by host, template ID and record ID"""
+
+    def __init__(self, directory=None):
+        """
+        :param directory: string, path to the directory holding the cache. Defaults to the value of the
+            PINYON_RECORD_CACHE environment variable, or ~/.pinyon/records
+        """
+        if directory is None:
+            directory = os.environ.get('PINYON_RECORD_CACHE',
+                                       os.path.join(os.path.expanduser('~'), '.pinyon', 'records'))
+        self.directory = directory
+
+    def get_path(self, host, template_id):
+        """Get the path to the file holding records for a certain template
+
+        :param host: string, URL of the host
+        :param template_id: string, ID of the template
+        :return: string, path to the cache file
+        """
+        key = hashlib.sha1((u'%s\n%s' % (host, template_id)).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, '%s.jsonl' % key)
+
+    def get_version(self, host, template_id):
+        """Get a hash that identifies the set of records stored for a template
+
+        :param host: string, URL of the host
+        :param template_id: string, ID of the template
+        :return: string, hash of the set of records. None if no records are stored
+        """
+        path = self.get_path(host, template_id) + '.version'
+        if not os.path.isfile(path):
+            return None
+        with open(path) as fp:
+            return fp.read().strip()
+
+    def has_records(self, host, template_id):
+        """Check whether records for a template are in the cache
+
+        :param host: string, URL of the host
+        :param template_id: string, ID of the template
+        :return: boolean
+        """
+        return os.path.isfile(self.get_path(host, template_id))
+
+    def _read_lines(self, host, template_id):
+        """Iterate through the entries in a cache file
+
+        :param host: string, URL of the host
+        :param template_id: string, ID of the template
+        :return: iterator over dict, each with keys: id, hash, record
+        """
+
+        path = self.get_path(host, template_id)
+        if not os.path.isfile(path) or os.path.getsize(path) == 0:
+            return
+
+        with open(path, 'rb') as fp:
+            contents = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                line = contents.readline()
+                while line:
+                    yield json.loads(line, object_pairs_hook=OrderedDict)
+                    line = contents.readline()
+            finally:
+                contents.close()
+
+    def load(self, host, template_id):
+        """Read the records for a template
+
+        :param host: string, URL of the host
+        :param template_id: string, ID of the template
+        :return: list, records in the order they were stored
+        """
+        return [line['record'] for line in self._read_lines(host, template_id)]
+
+    def get_hashes(self, host, template_id):
+        """Get the hash of each record in the cache
+
+        :param host: string, URL of the host
+        :param template_id: string, ID of the template
+        :return: dict, key is the record ID, value is the hash of the record
+        """
+        return dict((line['id'], line['hash']) for line in self._read_lines(host, template_id))
+
+    def update(self, host, template_id, records):
+        """Replace the cached records for a template
+
+        :param host: string, URL of the host
+        :param template_id: string, ID of the template
+        :param records: list, records currently held by the host
+        :return: int, number of records that are new or changed
+        """
+
+        old_hashes = self.get_hashes(host, template_id)
+
+        # Write to a temporary file, then move it into place so readers never see a partial file
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        fd, temp_path = mkstemp(dir=self.directory, suffix='.tmp')
+        count = changed = 0
+        hashes = []
+        with os.fdopen(fd, 'wb') as fp:
+            for record in records:
+                count += 1
+                record_id = get_record_id(record)
+                record_hash = get_record_hash(record)
+                hashes.append(record_hash)
+                if old_hashes.get(record_id) != record_hash:
+                    changed += 1
+                fp.write(json.dumps(OrderedDict([('id', record_id), ('hash', record_hash), ('record', record)]),
+                                    default=str))
+                fp.write('\n')
+
+        # Replace the version first. If interrupted before the records are moved, the version no longer matches any
+        #  earlier extraction, so results from the old records are not mistaken for results from the new ones
+        fd, version_path = mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as fp:
+            fp.write(get_records_version(hashes))
+        os.rename(version_path, self.get_path(host, template_id) + '.version')
+        os.rename(temp_path, self.get_path(host, template_id))
+
+        logging.info('Cached %d records for template %s, %d new or changed' % (count, template_id, changed))
+        return changed
+
+    def clear(self, host, template_id):
+        """Remove the records of a template from the cache
+
+        :param host: string, URL of the host
+        :param template_id: string, ID of the template
+        """
+        path = self.get_path(host, template_id)
+        for name in [path, path + '.version']:
+            if os.path.isfile(name):
+                os.unlink(name)
+
+
+record_cache = RecordCache()
+"""Cache used by the extractors"""
@@ -7,12 +7,21 @@ extractor is specifically tailored to a certain data structure.
 """
 from __future__ import absolute_import
 
+import hashlib
+import json
+import numbers
+import pickle
+from collections import OrderedDict
+from multiprocessing import Pool
+
 import mdcs
+import numpy as np
 
-from pinyon import KnownClass
+from pinyon import KnownClass, LazyClassMixin
 from . import BaseExtractor
+from .cache import record_cache, get_record_hash, get_records_version
 from mongoengine.fields import *
-from mongoengine import EmbeddedDocument, Document
+from mongoengine import EmbeddedDocument, Document, ValidationError
 import pandas as pd
 from pint import UnitRegistry
 from periodictable import elements as pt_elements
@@ -23,7 +32,7 @@ _ureg = UnitRegistry(autoconvert_offset_to_baseunit=True)
 """Unit conversion tool"""
 
 
-class EntryFlattener(EmbeddedDocument):
+class EntryFlattener(LazyClassMixin, EmbeddedDocument):
     """Base class for methods that flatten data from an MDCS data file."""
     meta={'allow_inheritance': True}
     
@@ -34,6 +43,13 @@ class EntryFlattener(EmbeddedDocument):
     description = StringField(required=False)
     """Description of this data column """
 
+    dtype = StringField(required=False)
+    """Data type of the column produced by this flattener (e.g., float32, int64, category).
+    If not set, uses `output_dtype`"""
+
+    output_dtype = None
+    """Default data type of the values produced by this flattener. None to let pandas infer the type"""
+
     def __init__(self, *args, **kwargs):
         super(EntryFlattener, self).__init__(*args, **kwargs)
 
@@ -51,6 +67,29 @@ class EntryFlattener(EmbeddedDocument):
         """
         raise NotImplementedError()
 
+    def clean(self):
+        # Make sure the data type is known to numpy
+        if self.dtype is not None and self.dtype != 'category':
+            try:
+                np.dtype(str(self.dtype))
+            except TypeError:
+                raise ValidationError('Unknown data type: %s' % self.dtype, field_name='dtype')
+
+    def get_dtype(self):
+        """Get the data type of the column produced by this flattener
+
+        :return: string, name of the data type. None if the type should be inferred"""
+        return self.dtype if self.dtype is not None else self.output_dtype
+
+    def get_fingerprint(self):
+        """Get a hash of the settings of this flattener. Flatteners with the same fingerprint produce the same column
+
+        :return: string, hash of the type and settings of the flattener, except for the name and description"""
+        settings = self.to_mongo().to_dict()
+        for field in ['name', 'description']:
+            settings.pop(field, None)
+        return hashlib.sha1(json.dumps(settings, sort_keys=True, default=str)).hexdigest()
+
 
 class ExtractorFlattener(EntryFlattener):
     """Flattener that pulls data simply pulls from the MDCS record
@@ -133,6 +172,8 @@ class PhysicalQuantityExtractorFlattener(ExtractorFlattener):
     
     Has the ability to convert a quantity to a certain unit
     """
+
+    output_dtype = 'float64'
     
     units = StringField(required=False)
     """Desired units for the property value"""
@@ -174,6 +215,8 @@ class ElementFractionFlattener(ExtractorFlattener):
     Assumes that the provided data is formatted according to material-composition.xsd
     """
 
+    output_dtype = 'float64'
+
     element=StringField(max_length=2, required=True)
     """Element to be extracted"""
 
@@ -300,6 +343,76 @@ class CompositionPrinterFlattener(ExtractorFlattener):
             )
 
 
+def _to_array(values, dtype):
+    """Store values in an array of a certain data type, if that does not change any of the values
+
+    Missing values are stored as NaN, so numeric columns with missing values are converted to floats. Otherwise,
+    the values are kept as objects if any would be altered by the conversion (e.g., 2.7 stored as an integer) or
+    are not numbers but the type is numeric (e.g., strings are not parsed). Floating-point types may round values.
+
+    :param values: list, values to be stored. None marks a missing value
+    :param dtype: string, name of the data type. None or 'category' to store the values as objects
+    :return: ndarray, values
+    """
+
+    output = np.empty(len(values), dtype=object)
+    for i, value in enumerate(values):
+        output[i] = value
+    if dtype is None or dtype == 'category':
+        return output
+    dtype = np.dtype(str(dtype))
+    if dtype.kind == 'O':
+        return output
+
+    # Store missing values as NaN
+    missing = [v is None or (isinstance(v, float) and np.isnan(v)) for v in values]
+    if any(missing):
+        if dtype.kind not in 'iuf':
+            return output
+        if dtype.kind != 'f':
+            dtype = np.dtype(np.float64)
+
+    # Only numbers can be stored in numeric types
+    present = [v for v, m in zip(values, missing) if not m]
+    if dtype.kind in 'biuf' and not all(isinstance(v, (numbers.Number, np.number, np.bool_)) for v in present):
+        return output
+
+    try:
+        converted = np.array([np.nan if m else v for v, m in zip(values, missing)], dtype=dtype)
+    except (TypeError, ValueError, OverflowError):
+        return output
+
+    # Other than floats, the array must hold each value exactly
+    if dtype.kind != 'f' and not all(c == v for c, v in zip(converted, values)):
+        return output
+    return converted
+
+
+def _flatten_records(args):
+    """Run a set of flatteners on a group of records. Used to flatten records on a process pool
+
+    Values are stored in an array with the data type declared by each flattener, if they can be converted without
+    changing them. See `_to_array`
+
+    :param args: tuple, (flatteners, entries)
+    :return: list of ndarray, values from each flattener for each entry
+    """
+
+    flatteners, entries = args
+    output = []
+    for flattener in flatteners:
+        values = []
+        for entry in entries:
+            try:
+                values.append(flattener.extract_data(entry))
+            except:
+                values.append(None)
+
+        # Categories are assigned once the values from every entry are known
+        output.append(_to_array(values, flattener.get_dtype()))
+    return output
+
+
 class MDCSExtractor(BaseExtractor):
     """A tool for extracting data from the MDCS and flattening it
     into a tabular format"""
@@ -319,34 +432,167 @@ class MDCSExtractor(BaseExtractor):
         
     flatteners = ListField(EmbeddedDocumentField(EntryFlattener))
     """Tools used to flatten records from MDCS into a table"""
-        
-    def _run_extraction(self):
+
+    n_jobs = IntField(default=1, min_value=1)
+    """Number of processes used to flatten records"""
+
+    template_id = StringField()
+    """ID of the template on the MDCS host. Found when records are first downloaded"""
+
+    template_id_title = StringField()
+    """Name of the template `template_id` was found for. Used to detect when `template` has changed"""
+
+    use_record_cache = BooleanField(default=True)
+    """Whether to store records on the local disk, so they need not be downloaded again when the flatteners change"""
+
+    revalidate_records = BooleanField(default=False)
+    """Whether to download the records again on each extraction, updating any that have changed. Otherwise, records
+    are only downloaded again when `get_data` is called with `revalidate`"""
+
+    records_version = StringField()
+    """Hash of the set of records used in the last extraction"""
+
+    column_fingerprints = ListField(ListField(StringField()))
+    """Fingerprint of the flattener used to make each column in the last extraction. Each entry is a pair
+    (column name, fingerprint). Not stored as a dict, as column names may contain characters not allowed in keys"""
+
+    _records_version = None
+    """Hash of the set of records from the last call to `get_records`"""
+
+    _previous_data = None
+    """Data from before the cache was last cleared. Used to reuse columns whose flattener has not changed"""
+
+    _revalidate = False
+    """Whether the next extraction should download the records, even if they are stored locally"""
+
+    def get_data(self, ignore_cache=False, save_results=False, run_subsequent=False, revalidate=False):
+        """Extract the data, reusing the stored records and any columns whose flattener has not changed
+
+        :param ignore_cache: boolean, whether to flatten the records again rather than using the saved result
+        :param save_results: boolean, whether to save the extractor
+        :param run_subsequent: boolean, whether to run subsequent tool
+        :param revalidate: boolean, whether to download the records again, even if they are stored locally.
+            Implies `ignore_cache`
+        :return: PandasArtifact, extracted data"""
+
+        ignore_cache = ignore_cache or revalidate
+        self._revalidate = revalidate
+
+        # Hold on to the old data, so that unchanged columns can be reused
+        if ignore_cache:
+            if self._data_cache is not None:
+                self._previous_data = self._data_cache
+            elif self.result is not None:
+                self._previous_data = pickle.loads(self.result)
+        try:
+            return super(MDCSExtractor, self).get_data(ignore_cache=ignore_cache, save_results=save_results,
+                                                       run_subsequent=run_subsequent)
+        finally:
+            self._revalidate = False
+
+    def get_records(self, revalidate=False):
+        """Get the records for the template of this extractor, from the local cache if possible
+
+        :param revalidate: boolean, whether to download the records even if a local copy is available
+        :return: list, MDCS data records"""
+
+        # Use the local copy, if available
+        if self.use_record_cache and not (revalidate or self.revalidate_records) and self.template_id is not None \
+                and self.template_id_title == self.template \
+                and record_cache.has_records(self.host, self.template_id):
+            self._records_version = record_cache.get_version(self.host, self.template_id)
+            return record_cache.load(self.host, self.template_id)
+
         # Get the schema ID for the data to be extracted
-        schema_id = mdcs.templates.current_id(self.host,
-                                              self.username,
-                                              self.password,
-                                              title=self.template)
-            
+        self.template_id = mdcs.templates.current_id(self.host,
+                                                     self.username,
+                                                     self.password,
+                                                     title=self.template)
+        self.template_id_title = self.template
+
         # Get the data records for this template
         entries = mdcs.explore.select(self.host,
                                       self.username,
                                       self.password,
-                                      template=schema_id,
+                                      template=self.template_id,
                                       format='json')
-            
+
+        # Store them locally
+        if self.use_record_cache:
+            record_cache.update(self.host, self.template_id, entries)
+            self._records_version = record_cache.get_version(self.host, self.template_id)
+        else:
+            self._records_version = get_records_version([get_record_hash(e) for e in entries])
+        return entries
+
+    def flatten_entries(self, entries, previous=None):
+        """Flatten MDCS records into a table
+
+        :param entries: list, MDCS data records
+        :param previous: DataFrame, result of flattening the same records previously. Columns made by flatteners
+            whose settings have not changed (see `column_fingerprints`) are copied from this result
+        :return: DataFrame, where each column is the output of a flattener
+        """
+
+        entries = list(entries)
+
+        # Find the columns that can be reused
+        fingerprints = [f.get_fingerprint() for f in self.flatteners]
+        reusable = dict()
+        if previous is not None and len(previous) == len(entries):
+            reusable = dict((fp, name) for name, fp in self.column_fingerprints if name in previous.columns)
+        flatteners = [f for f, fp in zip(self.flatteners, fingerprints) if fp not in reusable]
+
+        if len(flatteners) == 0:
+            columns = []
+        elif self.n_jobs > 1 and len(entries) > 1:
+            # Split the entries into a few shards per process, to keep the load balanced
+            shard_size = max(1, len(entries) // (self.n_jobs * 4))
+            shards = [(flatteners, entries[i:i + shard_size]) for i in range(0, len(entries), shard_size)]
+
+            pool = Pool(self.n_jobs)
+            try:
+                results = pool.map(_flatten_records, shards)
+            finally:
+                pool.close()
+
+            # Join the values from each shard
+            columns = [np.concatenate([r[i] for r in results]) for i in range(len(flatteners))]
+        else:
+            columns = _flatten_records((flatteners, entries))
+
+        # Gather the new and reused columns
+        columns = iter(columns)
+        all_columns = []
+        for fp in fingerprints:
+            if fp in reusable:
+                all_columns.append(previous[reusable[fp]].values)
+            else:
+                all_columns.append(next(columns))
+        self.column_fingerprints = [[f.name, fp] for f, fp in zip(self.flatteners, fingerprints)]
+
+        # Make the DataFrame in a single step
+        data = OrderedDict()
+        for flattener, values in zip(self.flatteners, all_columns):
+            dtype = flattener.get_dtype()
+            if dtype is None:
+                data[flattener.name] = values.tolist()
+            elif dtype == 'category':
+                data[flattener.name] = pd.Categorical(values)
+            else:
+                data[flattener.name] = values
+        return pd.DataFrame(data, columns=list(data.keys()))
+        
+    def _run_extraction(self):
+        # Get the data records for this template
+        entries = self.get_records(revalidate=self._revalidate)
+
+        # Columns can only be reused if the records have not changed
+        previous = self._previous_data
+        if self._records_version is None or self._records_version != self.records_version:
+            previous = None
+        self.records_version = self._records_version
+        self._previous_data = None
+
         # Extract data from the records
-        data = pd.DataFrame()
-        for flattener in self.flatteners:
-            # Run the flatteners
-            values = []
-            for entry in entries:
-                try:
-                    values.append(flattener.extract_data(entry))
-                except:
-                    values.append(None)
-            
-            # Store in the DataFrame
-            data[flattener.name] = values
-            
-        # Output the dataset
-        return data
+        return self.flatten_entries(entries, previous=previous)
@@ -0,0 +1,266 @@
+"""Counters and histograms describing the work done by pinyon
+
+Metrics are held in memory by each process and rendered in the Prometheus text exposition format, so they can be
+scraped from the web application (see `pinyon.web.metrics`) without running any other service. Values are reset
+when the process restarts, and each worker of a multi-process server reports its own values.
+"""
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import Lock
+
+__author__ = 'Logan Ward'
+
+request_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+"""Upper bounds of the histogram buckets for web requests, in seconds"""
+
+run_buckets = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+"""Upper bounds of the histogram buckets for tool, extractor and notebook runs, in seconds"""
+
+
+def _format_value(value):
+    """Render a number in the exposition format"""
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def _format_labels(labels):
+    """Render a set of labels in the exposition format
+
+    :param labels: list of (name, value) pairs
+    :return: string, e.g. '{name="value"}'. Empty if there are no labels
+    """
+    if len(labels) == 0:
+        return ''
+    escaped = [(n, unicode(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for n, v in labels]
+    return '{%s}' % ','.join('%s="%s"' % (n, v) for n, v in escaped)
+
+
+class Registry(object):
+    """Collection of metrics that are rendered together"""
+
+    def __init__(self):
+        self.metrics = OrderedDict()
+        self.caches = OrderedDict()
+
+    def register(self, metric):
+        """Add a metric to the registry
+
+        :param metric: Metric, metric to be added
+        """
+        if metric.name in self.metrics:
+            raise ValueError('Metric already registered: %s' % metric.name)
+        self.metrics[metric.name] = metric
+
+    def register_cache(self, name, cache):
+        """Report the hits, misses and size of a cache
+
+        :param name: string, name of the cache
+        :param cache: LRUCache, cache to be reported
+        """
+        self.caches[name] = cache
+
+    def _render_caches(self):
+        """Render the statistics of the registered caches
+
+        :return: list of string, lines describing the caches"""
+        output = []
+        for metric, type_name, documentation, get_value in [
+            ('pinyon_cache_hits_total', 'counter', 'Number of lookups that found an entry', lambda c: c.hits),
+            ('pinyon_cache_misses_total', 'counter', 'Number of lookups that did not find an entry',
+             lambda c: c.misses),
+            ('pinyon_cache_entries', 'gauge', 'Number of entries held by the cache', len)
+        ]:
+            output.append('# HELP %s %s' % (metric, documentation))
+            output.append('# TYPE %s %s' % (metric, type_name))
+            for name, cache in self.caches.items():
+                output.append('%s%s %s' % (metric, _format_labels([('cache', name)]),
+                                           _format_value(get_value(cache))))
+        return output
+
+    def render(self):
+        """Render all metrics in the exposition format
+
+        :return: string, text to be served to the scraper
+        """
+        output = []
+        for metric in self.metrics.values():
+            output.extend(metric.render())
+        if len(self.caches) > 0:
+            output.extend(self._render_caches())
+        return '\n'.join(output) + '\n'
+
+
+registry = Registry()
+"""Registry holding the metrics of this process"""
+
+
+class Metric(object):
+    """Base class for a metric, which holds a value for each combination of labels"""
+
+    type_name = None
+    """Type of the metric, as shown in the exposition format"""
+
+    def __init__(self, name, documentation, labelnames=(), registry=registry):
+        """
+        :param name: string, name of the metric
+        :param documentation: string, description of the metric
+        :param labelnames: list of string, names of the labels
+        :param registry: Registry, where to register this metric. Use None to not register the metric
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = OrderedDict()
+        self._lock = Lock()
+
+        if registry is not None:
+            registry.register(self)
+
+    def _get_key(self, labels):
+        """Get the key for a certain combination of labels
+
+        :param labels: dict, value of each label
+        :return: tuple, values of the labels in the order of `labelnames`
+        """
+        if set(labels.keys()) != set(self.labelnames):
+            raise ValueError('%s requires labels: %s' % (self.name, ', '.join(self.labelnames)))
+        return tuple(unicode(labels[n]) for n in self.labelnames)
+
+    def _render_samples(self):
+        """Render the value of each combination of labels
+
+        :return: list of string, one line for each sample"""
+        raise NotImplementedError()
+
+    def render(self):
+        """Render this metric in the exposition format
+
+        :return: list of string, lines describing this metric
+        """
+        output = ['# HELP %s %s' % (self.name, self.documentation.replace('\\', '\\\\').replace('\n', '\\n')),
+                  '# TYPE %s %s' % (self.name, self.type_name)]
+        with self._lock:
+            output.extend(self._render_samples())
+        return output
+
+
+class Counter(Metric):
+    """Metric that only increases (e.g., number of runs)"""
+
+    type_name = 'counter'
+
+    def inc(self, amount=1, **labels):
+        """Increase the value of the counter
+
+        :param amount: float, how much to increase the value
+        :param labels: value of each label
+        """
+        if amount < 0:
+            raise ValueError('Counters can only be increased')
+        key = self._get_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        """Get the value of the counter
+
+        :param labels: value of each label
+        :return: float, current value
+        """
+        return self._values.get(self._get_key(labels), 0)
+
+    def _render_samples(self):
+        return ['%s%s %s' % (self.name, _format_labels(zip(self.labelnames, key)), _format_value(value))
+                for key, value in self._values.items()]
+
+
+class Histogram(Metric):
+    """Metric that counts observations (e.g., durations) in buckets"""
+
+    type_name = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), registry=registry, buckets=request_buckets):
+        """
+        :param buckets: list of float, upper bounds of the buckets
+        """
+        super(Histogram, self).__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        """Record an observation
+
+        :param value: float, value being observed
+        :param labels: value of each label
+        """
+        key = self._get_key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """Record how long a block of code takes to run
+
+        :param labels: value of each label
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def get_count(self, **labels):
+        """Get the number of observations
+
+        :param labels: value of each label
+        :return: int, number of observations
+        """
+        return sum(self._values.get(self._get_key(labels), ([0], 0))[0])
+
+    def get_sum(self, **labels):
+        """Get the sum of the observations
+
+        :param labels: value of each label
+        :return: float, sum of all observed values
+        """
+        return self._values.get(self._get_key(labels), ([0], 0))[1]
+
+    def _render_samples(self):
+        output = []
+        for key, (counts, total) in self._values.items():
+            labels = zip(self.labelnames, key)
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                output.append('%s_bucket%s %d' % (self.name, _format_labels(labels + [('le', _format_value(bound))]),
+                                                  cumulative))
+            output.append('%s_sum%s %s' % (self.name, _format_labels(labels), _format_value(total)))
+            output.append('%s_count%s %d' % (self.name, _format_labels(labels), cumulative))
+        return output
+
+
+request_count = Counter('pinyon_http_requests_total', 'Number of web requests handled',
+                        ['route', 'method', 'status'])
+request_duration = Histogram('pinyon_http_request_duration_seconds', 'Time spent handling web requests',
+                             ['route', 'method'])
+
+tool_runs = Counter('pinyon_tool_runs_total', 'Number of tool runs', ['type', 'status'])
+tool_duration = Histogram('pinyon_tool_run_duration_seconds', 'Time spent running tools', ['type'],
+                          buckets=run_buckets)
+
+extractor_runs = Counter('pinyon_extractor_runs_total', 'Number of extractor runs', ['type', 'status'])
+extractor_duration = Histogram('pinyon_extractor_run_duration_seconds', 'Time spent running extractors', ['type'],
+                               buckets=run_buckets)
+
+notebook_runs = Counter('pinyon_notebook_executions_total', 'Number of notebook executions', ['status'])
+notebook_duration = Histogram('pinyon_notebook_execution_duration_seconds', 'Time spent executing notebooks', [],
+                              buckets=run_buckets)
+
+artifact_bytes = Counter('pinyon_artifact_bytes_total', 'Size of artifacts serialized and deserialized',
+                         ['type', 'operation'])
@@ -1,5 +1,7 @@
 import cPickle as pickle
+import cProfile
 import logging
+import time
 from copy import deepcopy
 from datetime import datetime
 
@@ -7,19 +9,39 @@ from mongoengine import Document, StringField, DateTimeField, ListField, Embedde
 from wtforms import Form
 import wtforms.fields as wtfields
 
-from pinyon import KnownClass
-from pinyon.artifacts import Artifact, PandasArtifact
+from pinyon import KnownClass, LazyClassMixin, LazyClassQuerySet, metrics
+from pinyon.artifacts import Artifact, PandasArtifact, BokehArtifact, ProfileArtifact
+from pinyon.events import publish_event
 from pinyon.utility import Note
 
 
-class WorkflowTool(Document):
+def _count_rows(data):
+    """Get the number of rows in a dataset, if it has a length
+
+    :param data: dataset
+    :return: int, number of rows. None if the dataset has no length"""
+    try:
+        return len(data)
+    except TypeError:
+        return None
+
+
+class WorkflowTool(LazyClassMixin, Document):
     """Abstract class that defines a workflow tool
 
     Stores name and description, any notes about the tool, and its dependencies. Provides a uniform interface to access
     these capabilities
     """
 
-    meta = {'allow_inheritance': True}
+    meta = {
+        'allow_inheritance': True,
+        'queryset_class': LazyClassQuerySet,
+        'index_cls': False,
+        'indexes': [
+            'previous_step',
+            ('toolchain', 'previous_step')
+        ]
+    }
 
     name = StringField(required=True, regex="^[^\\s+]*$", help_text='Short identifier of this tool')
     """Name of this tool. Cannot have whitespace"""
@@ -30,6 +52,9 @@ class WorkflowTool(Document):
     last_run = DateTimeField(help_text='When this tool was run last')
     """Last time this object was run"""
 
+    last_error = StringField(help_text='Error raised the last time this tool failed to run')
+    """Error from the last failed run. None if the last run succeeded"""
+
     notes = ListField(EmbeddedDocumentField(Note), help_text='Any notes about this method')
     """Any notes about this tool"""
 
@@ -47,6 +72,12 @@ class WorkflowTool(Document):
     result = MapField(EmbeddedDocumentField(Artifact), help_text='Results produced by this tool, or inherited by any previous tools')
     """Holds the pickled version of `result_cache`"""
 
+    prerender_formats = ListField(StringField(), help_text='Formats to render the outputs into after each run')
+    """Formats that are rendered after each run that saves its results, so that downloads need not wait for them"""
+
+    max_total_rendered_size = 8 * 1024 * 1024
+    """Largest total size of the rendered outputs stored with the results of this tool, in bytes"""
+
     def __init__(self, *args, **kwargs):
         super(WorkflowTool, self).__init__(*args, **kwargs)
 
@@ -76,6 +107,7 @@ class WorkflowTool(Document):
         output.result_cache = None
         output.result = None
         output.last_run = None
+        output.last_error = None
         output.notes = []
 
         return output
@@ -85,7 +117,8 @@ class WorkflowTool(Document):
 
         :return: dict of settings to be printed"""
         output = dict(self._data)
-        for nogo in ['id', 'name', 'description', 'notes', 'last_run', 'toolchain', 'result', 'previous_step']:
+        for nogo in ['id', 'name', 'description', 'notes', 'last_run', 'last_error', 'toolchain', 'result',
+                     'previous_step']:
             del output[nogo]
         return output
 
@@ -100,6 +133,10 @@ class WorkflowTool(Document):
         for choice in self.get_acceptable_previous_steps():
             previous_steps.append((str(choice.id), choice.name))
 
+        # Get the formats outputs can be rendered into
+        formats = set(PandasArtifact().available_formats().keys()) | set(BokehArtifact().available_formats().keys())
+        format_choices = [(f, f) for f in sorted(formats)]
+
         class EditForm(Form):
             name = wtfields.StringField('Tool Name', default=self.name,
                                         description='Simple name for this tool')
@@ -109,6 +146,10 @@ class WorkflowTool(Document):
             previous_step = wtfields.SelectField('Previous Step', choices=previous_steps,
                                                  default=str(self.previous_step.id) if self.previous_step else 'extractor',
                                                  description='Previous step in toolchain. Supplies inputs into this tool')
+            prerender_formats = wtfields.SelectMultipleField('Prerendered Formats', choices=format_choices,
+                                                             default=self.prerender_formats,
+                                                             description='Formats to render outputs into after '
+                                                                         'each run, so downloads are quick')
 
         return EditForm
 
@@ -122,6 +163,7 @@ class WorkflowTool(Document):
         # Make the changes
         self.name = form.name.data
         self.description = form.description.data
+        self.prerender_formats = form.prerender_formats.data
 
         # Get the previous step
         prev_step_choice = form.previous_step.data
@@ -214,7 +256,7 @@ class WorkflowTool(Document):
 
         return output
 
-    def run(self, ignore_results=False, save_results=False, run_subsequent=False):
+    def run(self, ignore_results=False, save_results=False, run_subsequent=False, profile=False):
         """Run an analysis tool
 
         If the tool has already been run, returns cached result
@@ -223,6 +265,8 @@ class WorkflowTool(Document):
             :param ignore_results: boolean, whether to redo calculation
             :param save_results: boolean, whether to save results
             :param run_subsequent: boolean, whether to run subsequent tool
+            :param profile: boolean, whether to store a CPU profile of gathering the inputs and running this tool
+                in the 'profile' output. Only used if the tool is actually run
         Output:
             :return: dict, result from the tool as Artifact objects
         """
@@ -235,23 +279,56 @@ class WorkflowTool(Document):
         if self.last_run is None:
             # Inform the logger
             logging.info("Running %s"%self.name)
-
-            # Get the inputs
-            inputs = self.get_inputs(save_results=save_results)
-            if 'data' not in inputs:
-                raise Exception('Input does not include data field')
-
-            # Remove data from its holder (to be easier to work with)
-            data_artifact = inputs['data']
-            data = data_artifact.get_object()
-            del inputs['data']
-
-            # Run the transformer
-            data, outputs = self._run(data, inputs)
+            self.publish_event('started')
+            start_time = time.time()
+            profiler = cProfile.Profile() if profile else None
+
+            try:
+                if profiler is not None:
+                    profiler.enable()
+                try:
+                    # Get the inputs
+                    inputs = self.get_inputs(save_results=save_results)
+                    if 'data' not in inputs:
+                        raise Exception('Input does not include data field')
+
+                    # Remove data from its holder (to be easier to work with)
+                    data_artifact = inputs['data']
+                    data = data_artifact.get_object()
+                    del inputs['data']
+                    rows_in = _count_rows(data)
+
+                    # Run the transformer
+                    data, outputs = self._run(data, inputs)
+                finally:
+                    if profiler is not None:
+                        profiler.disable()
+            except Exception, e:
+                # Mark the tool as failed
+                self.last_error = '%s: %s' % (e.__class__.__name__, e)
+                if save_results:
+                    self.save()
+                duration = time.time() - start_time
+                metrics.tool_runs.inc(type=self.__class__.__name__, status='failed')
+                metrics.tool_duration.observe(duration, type=self.__class__.__name__)
+                self.publish_event('failed', duration=duration, error=self.last_error)
+                raise
+            self.last_error = None
+            duration = time.time() - start_time
+            metrics.tool_runs.inc(type=self.__class__.__name__, status='finished')
+            metrics.tool_duration.observe(duration, type=self.__class__.__name__)
+            self.publish_event('finished', duration=duration, rows_in=rows_in, rows_out=_count_rows(data))
 
             # Put data back into the results object as a non-artifact
             outputs['data'] = data_artifact
             outputs['data'].set_object(data)
+
+            # Store the profile next to the other outputs
+            if profiler is not None:
+                outputs['profile'] = ProfileArtifact(name='profile', description='CPU profile of the last run of '
+                                                                                 'this tool, including gathering '
+                                                                                 'its inputs')
+                outputs['profile'].set_object(profiler)
             self.result = outputs
 
             # Update the last run time
@@ -261,6 +338,10 @@ class WorkflowTool(Document):
             if save_results:
                 self.save()
 
+                # Render the outputs before the next steps use them
+                if len(self.prerender_formats) > 0:
+                    self.prerender_outputs(save_results=True)
+
             # Now, clear or re-run subsequent calculations (which are now out of date)
             for tool in self.get_next_steps():
                 if run_subsequent:
@@ -271,6 +352,91 @@ class WorkflowTool(Document):
 
         return self.result
 
+    def publish_event(self, event, **kwargs):
+        """Record a change in the status of this tool, so that it can be streamed to users watching the toolchain
+
+        Events are only recorded for tools that belong to a saved toolchain
+
+        :param event: string, what happened ('started', 'finished' or 'failed')
+        :param kwargs: other fields of the event (see `pinyon.events.RunEvent`)
+        """
+        toolchain_id = self._get_toolchain_id()
+        if toolchain_id is None:
+            return
+        publish_event([toolchain_id], 'tool', self.id, self.name, event, **kwargs)
+
+    def prerender_outputs(self, formats=None, save_results=False):
+        """Render the outputs of this tool ahead of time, so that downloads can be served without rendering
+
+        :param formats: list of string, formats to render. Defaults to `prerender_formats`
+        :param save_results: boolean, whether to store the rendered outputs in the database
+        :return: int, number of outputs that were rendered
+        """
+
+        if formats is None:
+            formats = self.prerender_formats
+
+        count = 0
+        for artifact in self.result.values():
+            for target_format in formats:
+                if target_format in artifact.available_formats() and not artifact.is_rendered(target_format):
+                    try:
+                        artifact.render_output(target_format)
+                        count += 1
+                    except Exception:
+                        logging.exception('Failed to render %s as %s' % (artifact.name, target_format))
+
+        if save_results and count > 0:
+            self.save_rendered()
+        return count
+
+    def save_rendered(self, names=None):
+        """Save only the rendered outputs of the artifacts to the database
+
+        Does not change other fields. Nothing is saved if the tool has been run again since these outputs were made
+
+        :param names: list of string, names of the artifacts to save. Defaults to all artifacts
+        """
+
+        if self.last_run is None:
+            return
+        if names is None:
+            names = self.result.keys()
+        self.limit_rendered()
+
+        # Make the update
+        result_field = self._fields['result'].db_field
+        updates = dict()
+        for name in names:
+            artifact = self.result[name]
+            field = artifact._fields['rendered']
+            updates['%s.%s.%s' % (result_field, name, field.db_field)] = field.to_mongo(artifact.rendered)
+
+        # The database stores times to the millisecond
+        last_run = self.last_run.replace(microsecond=self.last_run.microsecond // 1000 * 1000)
+        self._get_collection().update_one({'_id': self.id, 'last_run': last_run}, {'$set': updates})
+
+    def limit_rendered(self):
+        """Discard rendered outputs, largest first, until their total size is at most `max_total_rendered_size`
+
+        Rendered outputs are stored in the tool document, which is limited in size by MongoDB, and are copied along
+        with any artifacts passed on to the next steps"""
+
+        if not self.result:
+            return
+
+        rendered = []
+        for artifact in self.result.values():
+            if artifact.rendered:
+                rendered.extend((len(value), artifact, key) for key, value in artifact.rendered.items())
+
+        total = sum(size for size, _, _ in rendered)
+        for size, artifact, key in sorted(rendered, key=lambda x: -x[0]):
+            if total <= self.max_total_rendered_size:
+                break
+            del artifact.rendered[key]
+            total -= size
+
     def _run(self, data, other_inputs):
         """Do the actual running
 
@@ -310,16 +476,79 @@ class WorkflowTool(Document):
             for tool in self.get_next_steps():
                 tool.clear_results(clear_next_steps=True, save=save)
 
+    def save(self, *args, **kwargs):
+        """Save this tool, and update the summary stored with its toolchain
+
+        The whole summary is only recomputed if the tool is new or its position in the toolchain or name changed.
+        Otherwise, only the status of this tool is updated
+
+        :param update_summary: boolean, whether to update the summary of the toolchain"""
+
+        update_summary = kwargs.pop('update_summary', True)
+        self.limit_rendered()
+
+        # Determine whether the structure of the toolchain changes
+        changed = set(f.split('.')[0] for f in self._get_changed_fields())
+        rebuild = self.id is None or self._created or len(changed & {'name', 'previous_step', 'toolchain'}) > 0
+        old_toolchain = None
+        if 'toolchain' in changed and self.id is not None:
+            stored = self._get_collection().find_one({'_id': self.id}, {'toolchain': 1}) or {}
+            old_toolchain = stored.get('toolchain')
+
+        output = super(WorkflowTool, self).save(*args, **kwargs)
+
+        if update_summary:
+            if old_toolchain is not None:
+                self.update_toolchain_summary(old_toolchain)
+            if rebuild or not self.update_toolchain_status():
+                self.update_toolchain_summary()
+        return output
+
+    def _get_toolchain_id(self):
+        """Get the ID of the toolchain, without loading it
+
+        :return: ObjectId, ID of the toolchain"""
+        ref = self._data.get('toolchain')
+        return getattr(ref, 'id', ref)
+
+    def update_toolchain_summary(self, toolchain_id=None):
+        """Recompute the statistics, hierarchy and tool status stored with the toolchain of this tool
+
+        :param toolchain_id: ObjectId, ID of the toolchain to update. Defaults to the toolchain of this tool"""
+        from pinyon.toolchain import ToolChain
+
+        if toolchain_id is None:
+            toolchain_id = self._get_toolchain_id()
+        toolchain = ToolChain.objects(id=toolchain_id).only('extractor').first()
+        if toolchain is not None:
+            toolchain.update_summary()
+
+    def update_toolchain_status(self):
+        """Update the status of only this tool in the summary stored with its toolchain
+
+        The update is a single atomic operation, so tools being saved at the same time do not overwrite each other
+
+        :return: boolean, whether the summary held an entry for this tool"""
+        from pinyon.toolchain import ToolChain
+
+        field = ToolChain._fields['tool_status'].db_field
+        result = ToolChain._get_collection().update_one(
+            {'_id': self._get_toolchain_id(), '%s.id' % field: str(self.id)},
+            {'$set': {'%s.$.last_run' % field: self.last_run, '%s.$.last_error' % field: self.last_error}})
+        return result.matched_count > 0
+
     def delete(self, update_dependencies=True, **write_concern):
         """Delete this object.
 
         :param update_dependencies: boolean, whether to take subsequent tool in a chain and attach them to the previous tool"""
 
+        # The summary of the toolchain is recomputed once, after every change is made
         if update_dependencies:
             for tool in self.get_next_steps():
                 tool.previous_step = self.previous_step
-                tool.save()
+                tool.save(update_summary=False)
 
         logging.info("Deleting %s" % self.name)
 
-        super(WorkflowTool, self).delete(**write_concern)
\ No newline at end of file
+        super(WorkflowTool, self).delete(**write_concern)
+        self.update_toolchain_summary()
\ No newline at end of file
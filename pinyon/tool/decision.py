@@ -1,16 +1,67 @@
 import cPickle as pickle
+import hashlib
 import inspect
 import json
+import logging
 import os
+from multiprocessing.pool import ThreadPool
+
 from bs4 import BeautifulSoup
 
 from jinja2 import Environment, DictLoader
+from mongoengine import Document
 from mongoengine.fields import *
 from wtforms import fields as wtfields
+from wtforms import validators as wtvalidators
 
+from pinyon.compression import CompressedBinaryField
 from pinyon.tool import WorkflowTool
-from pinyon.tool.jupyter import JupyterNotebookTransformer
-from pinyon.tool.jupyter import run_notebook
+from pinyon.tool.jupyter import JupyterNotebookTransformer, NotebookLimitsMixin
+from pinyon.tool.jupyter import run_notebook, run_notebook_batch, notebook_cache
+
+
+def _render_entries(args):
+    """Run a visualization notebook for several entries in a single kernel. Used to prerender plots on a thread pool
+
+    :param args: tuple, (notebook, inputs, jobs, limits), where jobs is a list of tuples
+        (entry key, entry, settings for that entry) and limits is a dict of limits passed to `run_notebook_batch`
+    :return: dict, key is the entry key and value is the plot data
+    """
+
+    notebook, inputs, jobs, limits = args
+    if len(jobs) == 0:
+        return dict()
+
+    try:
+        results = run_notebook_batch(notebook, [dict(entry=entry) for _, entry, _ in jobs],
+                                     [settings for _, _, settings in jobs], shared_inputs=inputs, **limits)
+    except Exception:
+        logging.exception('Failed to render entries')
+        return dict()
+
+    return dict((key, result) for (key, _, _), result in zip(jobs, results) if result is not None)
+
+
+class PrerenderedPlot(Document):
+    """Plot for a single entry of a `SingleEntryBokehHTMLDecisionTracker`, rendered in advance
+
+    Each plot is held in its own document, so the number of entries is not limited by the maximum document size"""
+
+    meta = {
+        'indexes': [{'fields': ['tool', 'entry_key'], 'unique': True}]
+    }
+
+    tool = ObjectIdField(required=True)
+    """ID of the tool that made this plot"""
+
+    entry_key = StringField(required=True)
+    """Key of the entry, as a string"""
+
+    fingerprint = StringField(required=True)
+    """Fingerprint of the notebook, data and decisions used to make the plot. See `get_entry_fingerprint`"""
+
+    plot = CompressedBinaryField(required=True)
+    """Pickled form of the plot data"""
 
 
 class HTMLDecisionTracker(WorkflowTool):
@@ -44,7 +95,7 @@ class HTMLDecisionTracker(WorkflowTool):
         notes -> Any notes about the decision
     """
 
-    decisions = BinaryField(required=True)
+    decisions = CompressedBinaryField(required=True)
     """Holds the pickled form of a dictionary holding the changes that were made."""
 
     html_template = BinaryField(required=True, default=open(os.path.join(
@@ -121,15 +172,17 @@ class HTMLDecisionTracker(WorkflowTool):
 
         return info
 
-    def get_entry(self, entry_key):
+    def get_entry(self, entry_key, data=None):
         """Get a certain entry in the input dataset
 
         :param entry_key: int or String, either the entry ID or a string that shoudl match `self.entry_key`
+        :param data: DataFrame, input dataset. If None, will be retrieved from the previous step
         :return: Series, entry in question
         """
         # Get the input dataset
-        inputs = self.get_inputs()
-        data = inputs['data'].get_object()
+        if data is None:
+            inputs = self.get_inputs()
+            data = inputs['data'].get_object()
 
         # Get the entry
         if self.entry_key is not None:
@@ -160,14 +213,14 @@ class HTMLDecisionTracker(WorkflowTool):
     def get_decisions_for_entry(self, entry_key):
         """Get all the decisions related to a certain entry
 
-        :param entry_key: int or string, key to entry of interest
+        :param entry_key: int or string, key to entry of interest. Keys are compared as strings, as keys from the
+            web pages are strings even when entries are identified by their row number
         :return: dict, where key is the column being changed, and the value is the decision parameters
         """
 
         output = dict()
         for dec_key, value in self.get_decisions().iteritems():
-            print dec_key[0], entry_key
-            if dec_key[0] != entry_key:
+            if str(dec_key[0]) != str(entry_key):
                 continue
 
             output[dec_key[1]] = value
@@ -323,12 +376,12 @@ class HTMLDecisionTracker(WorkflowTool):
         super(HTMLDecisionTracker, self).save()
 
 
-class BokehHTMLDecisionTracker(HTMLDecisionTracker):
+class BokehHTMLDecisionTracker(NotebookLimitsMixin, HTMLDecisionTracker):
     """A decision tracker that includes a Bokeh decision tracker
 
     Uses a Jupyter notebook in the background to generate the scripts and other data required to run the Bokeh plot"""
 
-    notebook = BinaryField(required=True, default=open(os.path.join(
+    notebook = CompressedBinaryField(required=True, default=open(os.path.join(
                 os.path.dirname(__file__),
                 'jupyter_templates',
                 'bokeh_example.ipynb'
@@ -361,7 +414,8 @@ class BokehHTMLDecisionTracker(HTMLDecisionTracker):
 
     def get_html_tool(self, **kwargs):
         # First, run the underlying notebook to get the Bokeh plot information
-        self.notebook, plot_data = run_notebook(self.notebook, self.get_inputs(), {})
+        _, plot_data = run_notebook(self.notebook, self.get_inputs(), {}, cache=notebook_cache,
+                                    **self.get_notebook_options())
 
         # Pass it on the tool renderer
         return super(BokehHTMLDecisionTracker, self).get_html_tool(**plot_data)
@@ -439,11 +493,15 @@ class SingleEntryHTMLDecisionTracker(HTMLDecisionTracker):
 
         return super(SingleEntryHTMLDecisionTracker, self).get_html_tool()
 
-    def get_entry_editing_tool(self, entry_key, **kwargs):
-        """Generate a page for editing certain entry"""
+    def get_entry_editing_tool(self, entry_key, entry=None, **kwargs):
+        """Generate a page for editing certain entry
+
+        :param entry_key: key of the entry to be edited
+        :param entry: Series, entry to be edited. If None, will be retrieved from the input dataset"""
 
         # Get the input data to this tool
-        entry = self.get_entry(entry_key)
+        if entry is None:
+            entry = self.get_entry(entry_key)
 
         # Get the template
         env = Environment(loader=DictLoader({'my_template': self.entry_html_template}))
@@ -492,16 +550,20 @@ class SingleEntryHTMLDecisionTracker(HTMLDecisionTracker):
             self.save()
 
 
-class SingleEntryBokehHTMLDecisionTracker(SingleEntryHTMLDecisionTracker):
+class SingleEntryBokehHTMLDecisionTracker(NotebookLimitsMixin, SingleEntryHTMLDecisionTracker):
     """Single entry editor that generates a Bokeh figure for the entry-editing pages"""
 
-    notebook = BinaryField(required=True, default=open(os.path.join(
+    notebook = CompressedBinaryField(required=True, default=open(os.path.join(
                 os.path.dirname(__file__),
                 'jupyter_templates',
                 'singleentry_visualization.ipynb'
             )).read())
     """Notebook used to generate the visualization"""
 
+    _prerendered_cache = None
+    """Plots rendered in advance that have not been saved. Key is the entry key, value is a tuple
+    (fingerprint, plot data)"""
+
     def get_settings(self):
         last = super(SingleEntryBokehHTMLDecisionTracker, self).get_settings()
 
@@ -536,22 +598,149 @@ class SingleEntryBokehHTMLDecisionTracker(SingleEntryHTMLDecisionTracker):
         if not type(request.POST['notebook']) == unicode:
             self.notebook = str(request.POST['notebook'].file.read())
 
+    def get_prerendered_plot(self, entry_key):
+        """Get the plot rendered in advance for a certain entry
+
+        :param entry_key: key of the entry
+        :return: tuple (fingerprint, plot data), or None if the plot has not been rendered"""
+
+        if self._prerendered_cache is not None and str(entry_key) in self._prerendered_cache:
+            return self._prerendered_cache[str(entry_key)]
+        if self.id is None:
+            return None
+
+        doc = PrerenderedPlot.objects(tool=self.id, entry_key=str(entry_key)).first()
+        if doc is None:
+            return None
+        return doc.fingerprint, pickle.loads(doc.plot)
+
+    def get_entry_fingerprint(self, data_hash, entry_key, decisions):
+        """Get a fingerprint of everything that affects the plot for a certain entry
+
+        :param data_hash: string, hash of the input data
+        :param entry_key: key of the entry
+        :param decisions: dict, decisions made about this entry
+        :return: string, fingerprint
+        """
+
+        fingerprint = hashlib.sha1(self.notebook)
+        fingerprint.update(data_hash)
+        fingerprint.update(pickle.dumps((str(entry_key), decisions), pickle.HIGHEST_PROTOCOL))
+        return fingerprint.hexdigest()
+
+    def prerender_entries(self, entry_keys=None, start=None, stop=None, n_jobs=1, batch_size=100,
+                          save_results=False):
+        """Render the plots for many entries in advance
+
+        Plots are stored along with a fingerprint of the input data, notebook, and decisions for that entry, so that
+        they are only used if none of those have changed.
+
+        :param entry_keys: list, keys of entries to render. None to render all entries
+        :param start: int, index of first row of the dataset to render
+        :param stop: int, index of the row of the dataset after the last to render
+        :param n_jobs: int, number of notebooks run at the same time. Each notebook runs in its own kernel process
+        :param batch_size: int, maximum number of entries rendered by a single notebook kernel
+        :param save_results: boolean, whether to save the plots to the database
+        :return: int, number of entries rendered
+        """
+
+        # Get the input data
+        inputs = self.get_inputs()
+        data = inputs['data'].get_object()
+        data_hash = hashlib.sha1(inputs['data'].object).hexdigest()
+
+        # Group the decisions by entry
+        decisions = dict()
+        for (key, column), decision in self.get_decisions().iteritems():
+            decisions.setdefault(str(key), dict())[column] = decision
+
+        # Make the list of entries to be rendered
+        if entry_keys is not None:
+            entry_keys = set(str(x) for x in entry_keys)
+        jobs = []
+        fingerprints = dict()
+        for rid, entry in data.iloc[start:stop].iterrows():
+            key = str(rid if self.entry_key is None else entry[self.entry_key])
+            if entry_keys is not None and key not in entry_keys:
+                continue
+            entry_decisions = decisions.get(key, dict())
+            jobs.append((key, entry, dict(entry_key=key, decisions=entry_decisions)))
+            fingerprints[key] = self.get_entry_fingerprint(data_hash, key, entry_decisions)
+
+        # Split them into batches, each run in a single kernel
+        limits = dict(timeout=self.timeout, memory_limit=self.memory_limit)
+        chunks = [(self.notebook, inputs, jobs[i:i + batch_size], limits) for i in range(0, len(jobs), batch_size)]
+        n_jobs = max(1, min(n_jobs, len(chunks)))
+        if n_jobs == 1:
+            results = map(_render_entries, chunks)
+        else:
+            # Threads suffice, as the notebooks run in separate kernel processes
+            pool = ThreadPool(n_jobs)
+            try:
+                results = pool.map(_render_entries, chunks)
+            finally:
+                pool.close()
+
+        # Store the results
+        if self._prerendered_cache is None:
+            self._prerendered_cache = dict()
+        plots = self._prerendered_cache
+        count = 0
+        for result in results:
+            for key, plot_data in result.iteritems():
+                plots[key] = (fingerprints[key], plot_data)
+                count += 1
+
+        if save_results:
+            self.save_prerendered_plots()
+        return count
+
+    def save_prerendered_plots(self):
+        """Save the plots rendered by `prerender_entries` to the database
+
+        Does not change the tool document, so that decisions made while the plots were being rendered are not lost"""
+
+        if not self._prerendered_cache:
+            return
+
+        collection = PrerenderedPlot._get_collection()
+        for key, (fingerprint, plot_data) in self._prerendered_cache.iteritems():
+            doc = PrerenderedPlot(tool=self.id, entry_key=key, fingerprint=fingerprint,
+                                  plot=pickle.dumps(plot_data, pickle.HIGHEST_PROTOCOL))
+            son = doc.to_mongo()
+            son.pop('_id', None)
+            collection.replace_one({'tool': self.id, 'entry_key': key}, son, upsert=True)
+        self._prerendered_cache = None
+
+    def delete(self, *args, **kwargs):
+        super(SingleEntryBokehHTMLDecisionTracker, self).delete(*args, **kwargs)
+        PrerenderedPlot.objects(tool=self.id).delete()
+
     def get_entry_editing_tool(self, entry_key, **kwargs):
         # Get the entry in question
-        entry = self.get_entry(entry_key)
-
-        # First, run the underlying notebook to get the Bokeh plot information
         inputs = self.get_inputs()
-        inputs['entry'] = entry
+        entry = self.get_entry(entry_key, data=inputs['data'].get_object())
 
         # Get other necessary data
         other_data = dict(entry_key=entry_key, decisions=self.get_decisions_for_entry(entry_key))
 
-        # Make the figure
-        self.notebook, plot_data = run_notebook(self.notebook, inputs, other_data)
+        # Use the prerendered plot, if it is still current
+        plot_data = None
+        prerendered = self.get_prerendered_plot(entry_key)
+        if prerendered is not None:
+            data_hash = hashlib.sha1(inputs['data'].object).hexdigest()
+            if prerendered[0] == self.get_entry_fingerprint(data_hash, entry_key, other_data['decisions']):
+                plot_data = prerendered[1]
+
+        # Otherwise, run the underlying notebook to get the Bokeh plot information
+        if plot_data is None:
+            inputs['entry'] = entry
+            _, plot_data = run_notebook(self.notebook, inputs, other_data, cache=notebook_cache,
+                                        **self.get_notebook_options())
 
         # Send the plot
         return super(SingleEntryBokehHTMLDecisionTracker, self).get_entry_editing_tool(
             entry_key=entry_key,
+            entry=entry,
             **plot_data
         )
\ No newline at end of file
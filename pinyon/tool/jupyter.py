@@ -1,36 +1,287 @@
 import cPickle as pickle
+import hashlib
 import inspect
+import json
+import logging
+import math
 import os
+import time
+from copy import deepcopy
+from threading import Lock
 
 import nbformat
-from mongoengine import BinaryField, DictField
+from mongoengine import BinaryField, DictField, IntField, StringField
 from nbconvert.preprocessors import ExecutePreprocessor
 
+from pinyon import metrics
+from pinyon.compression import CompressedBinaryField
 from pinyon.tool import WorkflowTool
+from pinyon.utility import LRUCache
 from wtforms import fields as wtfields
+from wtforms import validators as wtvalidators
 
 
-def run_notebook(notebook, inputs, settings):
+notebook_cache = LRUCache(max_entries=32, ttl=3600)
+"""Results of recent notebook runs, used by tools that re-run the same notebook often (e.g., to render web pages)"""
+metrics.registry.register_cache('notebook', notebook_cache)
+
+_running_notebooks = {}
+"""Notebooks currently being executed by this process. Key is the execution ID, value is the executor"""
+
+_running_lock = Lock()
+"""Lock used when changing `_running_notebooks`"""
+
+
+class NotebookCancelled(Exception):
+    """Raised when the execution of a notebook is cancelled"""
+    pass
+
+
+class NotebookTimeout(Exception):
+    """Raised when a notebook runs longer than its time limit"""
+    pass
+
+
+class LimitedExecutePreprocessor(ExecutePreprocessor):
+    """Executes a notebook, stopping if it runs longer than a time limit or is cancelled"""
+
+    def __init__(self, wall_time=None, **kwargs):
+        """
+        :param wall_time: float, maximum time to run the whole notebook, in seconds. None for no limit
+        """
+        super(LimitedExecutePreprocessor, self).__init__(**kwargs)
+        self.deadline = None if wall_time is None else time.time() + wall_time
+        self.cancelled = False
+
+    def preprocess_cell(self, cell, resources, cell_index):
+        if self.cancelled:
+            raise NotebookCancelled('Notebook execution was cancelled')
+
+        # Only allow the cell to run until the notebook's deadline
+        if self.deadline is not None:
+            remaining = self.deadline - time.time()
+            if remaining <= 0:
+                raise NotebookTimeout('Notebook exceeded its time limit')
+            self.timeout = int(math.ceil(remaining))
+
+        try:
+            return super(LimitedExecutePreprocessor, self).preprocess_cell(cell, resources, cell_index)
+        except Exception:
+            if self.cancelled:
+                raise NotebookCancelled('Notebook execution was cancelled')
+            if self.deadline is not None and time.time() >= self.deadline:
+                raise NotebookTimeout('Notebook exceeded its time limit')
+            raise
+
+    def cancel(self):
+        """Stop the execution of the notebook"""
+        self.cancelled = True
+        km = getattr(self, 'km', None)
+        if km is not None:
+            km.interrupt_kernel()
+
+
+def cancel_notebook(execution_id):
+    """Cancel a notebook being run by this process
+
+    :param execution_id: string, ID of the execution (e.g., ID of the tool running the notebook)
+    :return: boolean, whether a notebook with that ID was running
+    """
+
+    with _running_lock:
+        executor = _running_notebooks.get(execution_id)
+    if executor is None:
+        return False
+    executor.cancel()
+    return True
+
+
+def execute_notebook(nb, timeout=None, memory_limit=None, execution_id=None, allow_errors=False):
+    """Execute a notebook, with optional limits on its run time and memory usage
+
+    :param nb: NotebookNode, notebook to be executed. Third cell must be the first code cell
+    :param timeout: float, maximum time to run the notebook, in seconds. None for no limit
+    :param memory_limit: int, maximum memory used by the kernel, in MB. None for no limit
+    :param execution_id: string, ID used to cancel this execution. None if it cannot be cancelled
+    :param allow_errors: boolean, whether to continue running if a cell raises an error
+    """
+
+    # Set the memory limit as the first step in the notebook
+    if memory_limit is not None:
+        limit = int(memory_limit) * 1024 * 1024
+        nb.cells[2]['source'] = "import resource\n" \
+                                + ("resource.setrlimit(resource.RLIMIT_AS, (%d, %d))\n" % (limit, limit)) \
+                                + nb.cells[2]['source']
+
+    # Run the notebook
+    ep = LimitedExecutePreprocessor(wall_time=timeout, timeout=-1, allow_errors=allow_errors)
+    if execution_id is not None:
+        with _running_lock:
+            _running_notebooks[execution_id] = ep
+    status = 'failed'
+    try:
+        with metrics.notebook_duration.time():
+            ep.preprocess(nb, {})
+        status = 'finished'
+    except NotebookTimeout:
+        status = 'timeout'
+        raise
+    except NotebookCancelled:
+        status = 'cancelled'
+        raise
+    finally:
+        metrics.notebook_runs.inc(status=status)
+        if execution_id is not None:
+            with _running_lock:
+                _running_notebooks.pop(execution_id, None)
+
+
+def get_notebook_key(nb, inputs, settings):
+    """Get a key that identifies a certain notebook run
+
+    :param nb: NotebookNode, notebook being run
+    :param inputs: dict, input data to be sent to the notebook
+    :param settings: dict, settings for the calculations
+    :return: string, hash of the code in the notebook, the inputs and the settings
+    """
+
+    key = hashlib.sha1()
+
+    # Code cells, except the ones holding the inputs and outputs
+    for cell in nb.cells[3:-1]:
+        if cell['cell_type'] == 'code':
+            key.update(cell['source'].encode('utf-8'))
+            key.update('\0')
+
+    # Inputs and settings
+    key.update(pickle.dumps(inputs, pickle.HIGHEST_PROTOCOL))
+    key.update(pickle.dumps(settings, pickle.HIGHEST_PROTOCOL))
+    return key.hexdigest()
+
+
+def run_notebook(notebook, inputs, settings, cache=None, timeout=None, memory_limit=None, execution_id=None):
     """Run the notebook
 
     :param notebook: string, notebook file contents
     :param inputs: dict, input data to be sent to the notebook
-    :return: Output from notebook
+    :param settings: dict, settings for the calculation
+    :param cache: LRUCache, cache of previous results. If provided, the notebook is only run if the same notebook has
+        not been run with the same inputs and settings recently. Only the outputs are cached, as the executed
+        notebook holds a copy of all of the inputs
+    :param timeout: float, maximum time to run the notebook, in seconds. None for no limit
+    :param memory_limit: int, maximum memory used by the kernel, in MB. None for no limit
+    :param execution_id: string, ID used to cancel this run with `cancel_notebook`
+    :return: (NotebookNode, dict), executed notebook and the outputs from the notebook. The notebook is None if the
+        outputs were taken from the cache
     """
 
     # Parse the notebook
     nb = nbformat.reads(notebook, nbformat.NO_CONVERT)
+
+    # Check if it has been run already
+    if cache is not None:
+        key = get_notebook_key(nb, inputs, settings)
+        result = cache.get(key)
+        if result is not None:
+            return None, pickle.loads(result)
+
     add_data(nb, inputs, settings)
 
     # Run the notebook
-    ep = ExecutePreprocessor(timeout=-1)
-    ep.preprocess(nb, {})
+    execute_notebook(nb, timeout=timeout, memory_limit=memory_limit, execution_id=execution_id)
 
     # Get the results
-    outputs = pickle.loads(eval(nb.cells[-1]['outputs'][0]['data']['text/plain']))
+    outputs = read_output(nb.cells[-1])
+
+    # Store them, in pickled form so that callers cannot change the stored copy
+    if cache is not None:
+        cache.set(key, pickle.dumps(outputs, pickle.HIGHEST_PROTOCOL))
     return nb, outputs
 
 
+def run_notebook_batch(notebook, inputs_list, settings_list, shared_inputs=None, timeout=None, memory_limit=None,
+                       execution_id=None):
+    """Run a notebook for many different inputs using a single kernel
+
+    The code cells of the notebook are repeated once for each set of inputs, and then the whole notebook is executed
+    at once. This avoids starting a new kernel and re-importing libraries for each set of inputs.
+
+    Inputs that are common to every run (e.g., the whole dataset) can be passed as `shared_inputs`, so that they are
+    only stored in the notebook once. Each run receives a fresh copy of them.
+
+    :param notebook: string, notebook file contents
+    :param inputs_list: list of dict, inputs for each run
+    :param settings_list: list of dict, settings for each run. Can also be a single dict used for all runs
+    :param shared_inputs: dict, inputs shared by all runs. Values in `inputs_list` take precedence
+    :param timeout: float, maximum time to run all of the inputs, in seconds. None for no limit
+    :param memory_limit: int, maximum memory used by the kernel, in MB. None for no limit
+    :param execution_id: string, ID used to cancel this run with `cancel_notebook`
+    :return: list, outputs from each run. None for runs where the notebook raised an error
+    """
+
+    if isinstance(settings_list, dict):
+        settings_list = [settings_list] * len(inputs_list)
+    if len(settings_list) != len(inputs_list):
+        raise Exception('Number of settings does not match number of inputs')
+
+    # Parse the notebook
+    nb = nbformat.reads(notebook, nbformat.NO_CONVERT)
+    check_notebook(nb)
+    body = nb.cells[3:-1]
+
+    # Make a cell that holds the shared inputs
+    shared_cell = deepcopy(nb.cells[2])
+    shared_cell['source'] = "import cPickle as pickle\n" \
+                            + ("_pinyon_shared = %s" % repr(pickle.dumps(shared_inputs or dict())))
+    shared_cell['outputs'] = []
+    cells = nb.cells[:2] + [shared_cell]
+
+    # Add the code for each run
+    segments = []
+    for inputs, settings in zip(inputs_list, settings_list):
+        start = len(cells)
+
+        import_cell = deepcopy(nb.cells[2])
+        import_cell['source'] = "pinyon = pickle.loads(_pinyon_shared)\n" \
+                                + ("pinyon.update(pickle.loads(%s))\n" % repr(pickle.dumps(inputs))) \
+                                + ("settings = pickle.loads(%s)" % repr(pickle.dumps(settings)))
+        import_cell['outputs'] = []
+        cells.append(import_cell)
+        cells.extend(deepcopy(body))
+
+        export_cell = deepcopy(nb.cells[-1])
+        export_cell['source'] = "pickle.dumps(pinyon)"
+        export_cell['outputs'] = []
+        cells.append(export_cell)
+
+        segments.append((start, len(cells)))
+    nb.cells = cells
+
+    # Run the notebook, continuing past errors so that one bad run does not stop the others
+    execute_notebook(nb, timeout=timeout, memory_limit=memory_limit, execution_id=execution_id, allow_errors=True)
+
+    # Get the results from each run
+    output = []
+    for start, end in segments:
+        errors = [o for cell in nb.cells[start:end] if cell['cell_type'] == 'code'
+                  for o in cell['outputs'] if o['output_type'] == 'error']
+        if len(errors) > 0:
+            logging.error('Notebook failed for run %d: %s: %s' % (len(output), errors[0]['ename'], errors[0]['evalue']))
+            output.append(None)
+        else:
+            output.append(read_output(nb.cells[end - 1]))
+    return output
+
+
+def read_output(cell):
+    """Read the outputs of a notebook from the cell used to export them
+
+    :param cell: NotebookNode, executed export cell
+    :return: dict, outputs of the notebook"""
+
+    return pickle.loads(eval(cell['outputs'][0]['data']['text/plain']))
+
+
 def add_data(nb, inputs, settings, use_placeholder=False):
     """Update the code used to import and export data into this notebook
 
@@ -61,15 +312,90 @@ def add_data(nb, inputs, settings, use_placeholder=False):
     nb.cells[-1]['outputs'] = []
 
 
+def strip_notebook(nb, max_output_size=None):
+    """Remove the data added to a notebook before execution, and optionally truncate large outputs
+
+    :param nb: NotebookNode, executed notebook. Will be modified
+    :param max_output_size: int, maximum size of any single output, in bytes. None for no limit
+    :return: NotebookNode, the stripped notebook
+    """
+
+    # Remove the pickled inputs and outputs
+    add_data(nb, None, None, use_placeholder=True)
+
+    # Truncate the large outputs
+    if max_output_size is not None:
+        for cell in nb.cells:
+            if cell['cell_type'] != 'code':
+                continue
+            for i, output in enumerate(cell['outputs']):
+                size = len(json.dumps(output))
+                if size > max_output_size:
+                    cell['outputs'][i] = nbformat.v4.new_output('stream', name='stdout',
+                                                                text='[Output of %d bytes truncated]\n' % size)
+    return nb
+
+
 def check_notebook(nb):
     if "Input Cell" not in nb.cells[1]['source'] or "Output Cell" not in nb.cells[-2]['source']:
         raise Exception('Notebook not in expected format. Please use the template')
 
 
-class JupyterNotebookTransformer(WorkflowTool):
+class NotebookLimitsMixin(object):
+    """Limits on the time and memory used by the notebooks a tool runs, and the ability to cancel them
+
+    Must be listed before `WorkflowTool` in the bases of a tool. Pass `get_notebook_options()` to `run_notebook`"""
+
+    timeout = IntField(min_value=1)
+    """Maximum time to run the notebook, in seconds. None for no limit"""
+
+    memory_limit = IntField(min_value=1)
+    """Maximum memory used by the notebook, in MB. None for no limit"""
+
+    def get_execution_id(self):
+        """Get the ID used to cancel the notebooks run by this tool
+
+        :return: string, ID of the tool. Tools that have not been saved get an ID unique to this object"""
+        return str(self.id) if self.id is not None else 'unsaved-%d' % id(self)
+
+    def get_notebook_options(self):
+        """Get the options for `run_notebook` that limit and identify the execution
+
+        :return: dict, keyword arguments for `run_notebook`"""
+        return dict(timeout=self.timeout, memory_limit=self.memory_limit, execution_id=self.get_execution_id())
+
+    def get_form(self):
+        super_form = super(NotebookLimitsMixin, self).get_form()
+
+        class MyForm(super_form):
+            timeout = wtfields.IntegerField('Time limit', default=self.timeout,
+                                            validators=[wtvalidators.Optional()],
+                                            description='Maximum time to run the notebook, in seconds. '
+                                                        'Leave blank for no limit')
+            memory_limit = wtfields.IntegerField('Memory limit', default=self.memory_limit,
+                                                 validators=[wtvalidators.Optional()],
+                                                 description='Maximum memory used by the notebook, in MB. '
+                                                             'Leave blank for no limit')
+
+        return MyForm
+
+    def process_form(self, form, request):
+        super(NotebookLimitsMixin, self).process_form(form, request)
+
+        self.timeout = form.timeout.data
+        self.memory_limit = form.memory_limit.data
+
+    def cancel(self):
+        """Stop the notebook of this tool, if it is being run by this process
+
+        :return: boolean, whether the notebook was running"""
+        return cancel_notebook(self.get_execution_id())
+
+
+class JupyterNotebookTransformer(NotebookLimitsMixin, WorkflowTool):
     """Uses Jupyter notebook to perform a certain optimization step"""
 
-    notebook = BinaryField(required=True, default=open(os.path.join(
+    notebook = CompressedBinaryField(required=True, default=open(os.path.join(
                 os.path.dirname(__file__),
                 'jupyter_templates',
                 'python2_template.ipynb'
@@ -79,6 +405,19 @@ class JupyterNotebookTransformer(WorkflowTool):
     calc_settings = DictField()
     """Any settings for the calculation"""
 
+    notebook_storage = StringField(default='inline', choices=['inline', 'separate'])
+    """How to store the notebook after it is executed.
+
+        inline -> Executed notebook, including the inputs and all outputs, replaces `notebook`
+        separate -> `notebook` is left unchanged, and a copy of the executed notebook without the inputs is stored in
+            `execution_record`"""
+
+    execution_record = CompressedBinaryField()
+    """Executed notebook from the last run, without the inputs. Only stored if `notebook_storage` is separate"""
+
+    max_output_size = IntField(min_value=0)
+    """Maximum size, in bytes, of any single output in `execution_record`. None for no limit"""
+
     def __init__(self,*args,**kwargs):
         super(JupyterNotebookTransformer, self).__init__(*args, **kwargs)
 
@@ -108,6 +447,7 @@ class JupyterNotebookTransformer(WorkflowTool):
 
         # Don't print the whole notebook
         del settings['notebook']
+        del settings['execution_record']
 
         # Make the settings a little prettier
         del settings['calc_settings']
@@ -130,6 +470,15 @@ class JupyterNotebookTransformer(WorkflowTool):
                                         description='Jupyter notebook to be executed. Must be formatted in the Pinyon '
                                                     'file style (see examples). Leave this blank to keep current notebook',
                                         render_kw={'class': 'form-control-file'})
+            notebook_storage = wtfields.SelectField('Notebook storage', default=self.notebook_storage,
+                                                    choices=[('inline', 'Store executed notebook with the tool'),
+                                                             ('separate', 'Keep the source notebook and store a '
+                                                                          'record of the execution separately')],
+                                                    description='How to store the notebook after it is run')
+            max_output_size = wtfields.IntegerField('Maximum output size', default=self.max_output_size,
+                                                    validators=[wtvalidators.Optional()],
+                                                    description='Largest output, in bytes, kept in the execution '
+                                                                'record. Leave blank for no limit')
 
         # Add other fields
         return MyForm
@@ -142,6 +491,10 @@ class JupyterNotebookTransformer(WorkflowTool):
             nbfile = request.POST['nbfile'].file
             self.notebook = str(nbfile.read())
 
+        # Read the storage options
+        self.notebook_storage = form.notebook_storage.data
+        self.max_output_size = form.max_output_size.data
+
         # Read in the calculation settings
         for name in self.calc_settings.keys():
             self.calc_settings[name] = form[name].data
@@ -150,6 +503,9 @@ class JupyterNotebookTransformer(WorkflowTool):
         info = super(JupyterNotebookTransformer, self).get_file_information()
 
         info['notebook'] = dict(description='Jupyter notebook being run by this calculation', extension='ipynb')
+        if self.execution_record is not None:
+            info['execution_record'] = dict(description='Notebook from the last run of this calculation',
+                                            extension='ipynb')
 
         return info
 
@@ -159,12 +515,16 @@ class JupyterNotebookTransformer(WorkflowTool):
         inputs['data'] = data
 
         # Run the notebook
-        nb, outputs = run_notebook(self.notebook, inputs, self.calc_settings)
+        nb, outputs = run_notebook(self.notebook, inputs, self.calc_settings, **self.get_notebook_options())
         data = outputs['data']
         del outputs['data']
 
         # Save the notebook
-        self.notebook = str(nbformat.writes(nb))
+        if self.notebook_storage == 'separate':
+            strip_notebook(nb, self.max_output_size)
+            self.execution_record = str(nbformat.writes(nb))
+        else:
+            self.notebook = str(nbformat.writes(nb))
         return data, outputs
 
     def load_workbook(self, f):
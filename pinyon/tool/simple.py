@@ -1,11 +1,74 @@
+import logging
+
 from mongoengine import StringField, ListField
 from pandas import Series
 from wtforms import fields as wtfields
 
 from pinyon.tool import WorkflowTool
+from pinyon.utility import LRUCache
+
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
 
 __author__ = 'Logan Ward'
 
+engine_choices = [('numexpr', 'numexpr (multi-threaded)'), ('python', 'Python (slow, supports any expression)')]
+"""Engines available for evaluating expressions with Pandas"""
+
+_engine_cache = LRUCache(max_entries=1024)
+"""Engine that last succeeded for each expression. Key is a tuple (method, expression, requested engine)"""
+
+_unsupported_errors = (NotImplementedError, TypeError, ValueError)
+"""Errors raised when numexpr cannot handle an expression (e.g., unsupported operations or data types). Other
+errors, such as syntax errors or unknown column names, are raised by both engines and are not retried"""
+
+
+def evaluate(data, method, expression, engine='numexpr', fallback=True, **kwargs):
+    """Evaluate an expression on a DataFrame, falling back to the Python engine if needed
+
+    The engine that works for each expression is cached, so that expressions numexpr cannot handle
+    are not re-parsed by numexpr on every run. Falling back to the Python engine is reported
+    to the logger, as it can be much slower on large datasets
+
+    :param data: DataFrame, data to be evaluated
+    :param method: string, name of DataFrame method to use (e.g., 'query', 'eval')
+    :param expression: string, expression to be evaluated
+    :param engine: string, desired engine ('numexpr' or 'python')
+    :param fallback: boolean, whether to use the Python engine if the desired engine cannot handle the expression.
+        If False, only the desired engine is used and its errors are raised
+    :return: result of the evaluation
+    """
+
+    if not fallback:
+        return getattr(data, method)(expression, engine=engine, **kwargs)
+
+    key = (method, expression, engine)
+    chosen = _engine_cache.get(key, engine)
+    if chosen != engine:
+        logging.info('Evaluating "%s" with the %s engine, as %s could not handle it previously'
+                     % (expression, chosen, engine))
+
+    # Check that numexpr is available
+    if chosen == 'numexpr' and numexpr is None:
+        logging.warning('numexpr is not installed. Evaluating "%s" with the python engine' % expression)
+        chosen = 'python'
+
+    # Run the evaluation
+    try:
+        result = getattr(data, method)(expression, engine=chosen, **kwargs)
+    except _unsupported_errors:
+        if chosen == 'python':
+            raise
+        logging.warning('Expression "%s" not supported by %s. Falling back to the python engine' % (expression, chosen))
+        chosen = 'python'
+        result = getattr(data, method)(expression, engine=chosen, **kwargs)
+
+    # Store the engine that worked
+    _engine_cache.set(key, chosen)
+    return result
+
 
 class FilterTransformer(WorkflowTool):
     """Get only entries that pass a certain query
@@ -17,8 +80,11 @@ class FilterTransformer(WorkflowTool):
     query = StringField(required=True, default="")
     """Query used to define filter"""
 
+    engine = StringField(required=True, default='numexpr', choices=[x for x, _ in engine_choices])
+    """Engine used to evaluate the query"""
+
     def _run(self, data, inputs):
-        return data.query(self.query), dict(inputs)
+        return evaluate(data, 'query', self.query, self.engine), dict(inputs)
 
     def get_form(self):
         super_form = super(FilterTransformer, self).get_form()
@@ -26,6 +92,8 @@ class FilterTransformer(WorkflowTool):
         class MyForm(super_form):
             query = wtfields.StringField('Query String', default=self.query,
                                          description='Query string passed to Pandas')
+            engine = wtfields.SelectField('Engine', choices=engine_choices, default=self.engine,
+                                          description='Engine used to evaluate the query')
 
         return MyForm
 
@@ -33,6 +101,7 @@ class FilterTransformer(WorkflowTool):
         super(FilterTransformer, self).process_form(form, request)
 
         self.query = form.query.data
+        self.engine = form.engine.data
 
 
 class RequiredFieldTransformer(WorkflowTool):
@@ -95,8 +164,11 @@ class SimpleEvalTransformer(WorkflowTool):
 
     eval_string = StringField(required=True, default="")
 
+    engine = StringField(required=True, default='numexpr', choices=[x for x, _ in engine_choices])
+    """Engine used to evaluate the expression"""
+
     def _run(self, data, other_inputs):
-        return data.eval(self.eval_string, inplace=False), other_inputs
+        return evaluate(data, 'eval', self.eval_string, self.engine, inplace=False), other_inputs
 
     def get_form(self):
         super_form = super(SimpleEvalTransformer, self).get_form()
@@ -104,10 +176,13 @@ class SimpleEvalTransformer(WorkflowTool):
         class MyForm(super_form):
             eval_string = wtfields.StringField('Function', default=self.eval_string,
                                                description='String to be evaluated by Pandas DataFrame.eval function')
+            engine = wtfields.SelectField('Engine', choices=engine_choices, default=self.engine,
+                                          description='Engine used to evaluate the expression')
 
         return MyForm
 
     def process_form(self, form, request):
         super(SimpleEvalTransformer, self).process_form(form, request)
 
-        self.eval_string = form.eval_string.data
\ No newline at end of file
+        self.eval_string = form.eval_string.data
+        self.engine = form.engine.data
\ No newline at end of file
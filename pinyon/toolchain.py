@@ -1,5 +1,8 @@
 """Holds operations and classes useful for constructing model building tool chains"""
+import json
+import logging
 from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 from extract import BaseExtractor
 from mongoengine import Document
@@ -13,6 +16,8 @@ import networkx as nx
 class ToolChain(Document):
     """Stores all elements of an analysis tool chain"""
 
+    meta = {'indexes': ['extractor']}
+
     name = StringField(required=True, regex='^[^\\s]+$', unique=True)
     """Name of the analysis toolchain.
 
@@ -27,6 +32,18 @@ class ToolChain(Document):
     extractor = ReferenceField(BaseExtractor, required=True)
     """Tool used to extract data from database"""
 
+    stats = DictField()
+    """Statistics about the tool network. See `get_stats`. Updated whenever a tool is saved or deleted"""
+
+    hierarchy = StringField()
+    """JSON form of the tool hierarchy. See `get_tool_hierarchy`. Updated whenever a tool is saved or deleted"""
+
+    tool_status = ListField(DictField())
+    """Name, type, and status of each tool. See `get_tool_status`. Updated whenever a tool is saved or deleted"""
+
+    extractor_summary = DictField()
+    """Name, description, and type of the extractor"""
+
     def __init__(self, *args, **kwargs):
         super(ToolChain, self).__init__(*args, **kwargs)
 
@@ -34,11 +51,115 @@ class ToolChain(Document):
         if 'skip_register' in kwargs and not kwargs['skip_register']:
             KnownClass.register_class(self)
 
+    def save(self, *args, **kwargs):
+        self.update_summary(save=False)
+        return super(ToolChain, self).save(*args, **kwargs)
+
+    def _get_extractor_id(self):
+        """Get the ID of the extractor, without loading it
+
+        :return: ObjectId, ID of the extractor"""
+        ref = self._data.get('extractor')
+        return getattr(ref, 'id', ref)
+
+    def update_summary(self, save=True):
+        """Recompute the statistics, tool hierarchy and tool status stored with this toolchain
+
+        Reads the extractor and tools with one query each, without loading any of their stored data
+
+        :param save: boolean, whether to store the new summary in the database
+        """
+
+        # Get the extractor
+        ref = self._data.get('extractor')
+        if isinstance(ref, BaseExtractor):
+            extractor = dict(name=ref.name, description=ref.description, _cls=ref._cls)
+        else:
+            extractor = BaseExtractor._get_collection().find_one({'_id': self._get_extractor_id()},
+                                                                 {'name': 1, 'description': 1, '_cls': 1}) or {}
+        extractor_cls = extractor.get('_cls', 'BaseExtractor')
+        self.extractor_summary = dict(name=extractor.get('name'), description=extractor.get('description'),
+                                      type=extractor_cls.split('.')[-1], class_hierarchy=extractor_cls)
+
+        # Get the tools
+        tools = []
+        if self.id is not None:
+            tools = list(WorkflowTool._get_collection().find({'toolchain': self.id},
+                                                             {'name': 1, 'previous_step': 1, 'last_run': 1,
+                                                              'last_error': 1, '_cls': 1}))
+        self.tool_status = [dict(id=str(t['_id']), name=t['name'], type=t['_cls'].split('.')[-1],
+                                 class_hierarchy=t['_cls'], last_run=t.get('last_run'),
+                                 last_error=t.get('last_error')) for t in tools]
+
+        # Compute the statistics
+        edges = [(t['_id'], t.get('previous_step')) for t in tools]
+        self.stats = get_tree_stats(edges)
+        self.stats['tool_count'] = len(tools)
+
+        # Make the hierarchy
+        children = dict()
+        for (tool, previous), status in zip(edges, self.tool_status):
+            children.setdefault(previous, []).append((tool, status))
+
+        def get_tree(node, status):
+            output = OrderedDict()
+            output["name"] = status['name']
+            output["id"] = str(node)
+            output["type"] = status['type']
+            output["class_hierarchy"] = status['class_hierarchy']
+            output["children"] = [get_tree(x, s) for x, s in children.get(node, [])]
+            return output
+        root = get_tree(self._get_extractor_id(), self.extractor_summary)
+        root['children'] = [get_tree(x, s) for x, s in children.get(None, [])]
+        self.hierarchy = json.dumps(root)
+
+        # Store the results
+        if save and self.id is not None:
+            ToolChain.objects(id=self.id).update_one(set__stats=self.stats, set__hierarchy=self.hierarchy,
+                                                     set__tool_status=self.tool_status,
+                                                     set__extractor_summary=self.extractor_summary)
+
+    def get_tool_status(self):
+        """Get the name, type and status of each tool
+
+        :return: list of dict, each with keys: id, name, type, class_hierarchy, last_run, last_error"""
+        if self.hierarchy is None:
+            self.update_summary()
+        return self.tool_status
+
+    def get_extractor_summary(self):
+        """Get the name, description and type of the extractor, without loading it
+
+        :return: dict, with keys: name, description, type, class_hierarchy"""
+        if self.hierarchy is None:
+            self.update_summary()
+        return self.extractor_summary
+
     def get_all_tools(self):
         """Get all `WorkflowTool` objects associated with this workflow"""
 
         return WorkflowTool.objects.filter(toolchain=self)
 
+    def get_first_tools(self):
+        """Get the tools that pull data directly from the extractor
+
+        :return: list of WorkflowTool"""
+
+        return list(WorkflowTool.objects(toolchain=self, previous_step__exists=False))
+
+    def run(self, n_jobs=1, rerun_extractor=True):
+        """Re-run every tool in this toolchain, and save the results
+
+        :param n_jobs: int, number of tools to run in parallel
+        :param rerun_extractor: boolean, whether to re-extract the data before running the tools
+        :return: dict, tools that failed to run and the exception they raised"""
+
+        # Get new data, which clears the results of all tools using this extractor
+        if rerun_extractor:
+            self.extractor.get_data(ignore_cache=True, save_results=True)
+
+        return run_tool_tree(self.get_first_tools(), n_jobs=n_jobs)
+
     def get_tool_network(self):
         """Get a network representing current tool"""
 
@@ -64,21 +185,9 @@ class ToolChain(Document):
 
         :return: dict, tool hierarchy"""
 
-        # Define the recursive function used to do this
-        def get_tree(node):
-            # Capture the information about this note
-            output = OrderedDict()
-            output["name"] = node.name
-            output["id"] = str(node.id)
-            output["type"] = node.__class__.__name__
-            output["class_hierarchy"] = node._cls
-            output["children"] = [get_tree(x) for x in node.get_next_steps()]
-            return output
-
-        # Get the first node
-        start = self.extractor
-
-        return get_tree(start)
+        if self.hierarchy is None:
+            self.update_summary()
+        return json.loads(self.hierarchy, object_pairs_hook=OrderedDict)
 
     def get_stats(self):
         """Get statistics about the toolchain
@@ -87,24 +196,130 @@ class ToolChain(Document):
 
         :return: dict, where keys are:
             depth -> int, longest chain of tools
-            width -> int, number of terminal nodes"""
+            width -> int, number of terminal nodes
+            tool_count -> int, number of tools"""
 
-        # Get the depth
-        def depth_func(node):
-            next_steps = node.get_next_steps()
-            if len(next_steps) == 0:
-                return 1
-            else:
-                return 1 + max([depth_func(x) for x in next_steps])
-        depth = depth_func(self.extractor)
-
-        # Get the number of terminal nodes
-        def leaf_count(node):
-            next_steps = node.get_next_steps()
-            if len(next_steps) == 0:
-                return 1
-            else:
-                return sum([leaf_count(x) for x in next_steps])
-        width = leaf_count(self.extractor)
+        if self.hierarchy is None:
+            self.update_summary()
+        return dict(self.stats)
+
+    @classmethod
+    def get_summaries(cls):
+        """Get a short summary of every toolchain
+
+        Uses the statistics and tool status stored with each toolchain (see `update_summary`), so only the
+        toolchains and extractors are read. Summaries are computed for toolchains that have not stored one
+
+        :return: list of dict, sorted by toolchain name. Keys:
+            name -> string, name of the toolchain
+            description -> string, description of the toolchain
+            extractor -> string, name of the extractor
+            last_exported -> datetime, when the extractor was last run
+            tool_count -> int, number of tools
+            depth -> int, longest chain of tools, counting the extractor
+            width -> int, number of terminal nodes
+            last_run -> datetime, when a tool was last run. None if no tools have been run
+            error_count -> int, number of tools that failed the last time they were run"""
+
+        # Get the toolchains and their stored summaries, without dereferencing the extractors
+        toolchains = list(cls._get_collection().find({}, {'name': 1, 'description': 1, 'extractor': 1, 'stats': 1,
+                                                          'hierarchy': 1, 'tool_status': 1}))
+
+        # Get the extractors, without their data
+        extractors = BaseExtractor._get_collection().find({'_id': {'$in': [tc.get('extractor') for tc in toolchains]}},
+                                                          {'name': 1, 'last_exported': 1})
+        extractors = dict((e['_id'], e) for e in extractors)
+
+        # Make the summaries
+        output = []
+        for tc in toolchains:
+            stats = tc.get('stats')
+            tool_status = tc.get('tool_status', [])
+            if tc.get('hierarchy') is None:
+                toolchain = cls.objects(id=tc['_id']).only('extractor').first()
+                toolchain.update_summary()
+                stats, tool_status = toolchain.stats, toolchain.tool_status
+
+            extractor = extractors.get(tc.get('extractor'), {})
+            run_times = [t['last_run'] for t in tool_status if t.get('last_run') is not None]
+            output.append(dict(
+                name=tc['name'],
+                description=tc['description'],
+                extractor=extractor.get('name'),
+                last_exported=extractor.get('last_exported'),
+                tool_count=stats['tool_count'],
+                depth=stats['depth'],
+                width=stats['width'],
+                last_run=max(run_times) if len(run_times) > 0 else None,
+                error_count=len([t for t in tool_status if t.get('last_error')])
+            ))
+        return sorted(output, key=lambda x: x['name'])
+
+
+def get_tree_stats(edges):
+    """Compute the depth and width of a tree of tools
+
+    :param edges: list of tuples, (tool ID, ID of previous step). Previous step is None for tools that
+        pull from the extractor
+    :return: dict, where keys are:
+        depth -> int, longest chain of tools, counting the extractor
+        width -> int, number of terminal nodes"""
+
+    # Get the children of each node
+    children = dict()
+    for tool, previous in edges:
+        children.setdefault(previous, []).append(tool)
+
+    # Walk down the tree, starting from the extractor
+    depth = width = 0
+    frontier = [(None, 1)]
+    while len(frontier) > 0:
+        node, level = frontier.pop()
+        depth = max(depth, level)
+        if node not in children:
+            width += 1
+        else:
+            frontier.extend((child, level + 1) for child in children[node])
+    return dict(depth=depth, width=width)
+
+
+def run_tool_tree(tools, n_jobs=1):
+    """Re-run a set of tools and every tool after them, saving the results
+
+    Tools are run one level of the tree at a time. Tools in the same level do not depend on each other, so
+    they are run in parallel using `n_jobs` threads. If a tool fails, the tools after it are not run.
+
+    :param tools: list of WorkflowTool, tools at the top of the trees to be run
+    :param n_jobs: int, number of tools to run in parallel
+    :return: dict, tools that failed to run and the exception they raised
+    """
+
+    failures = OrderedDict()
+
+    def run_tool(tool):
+        try:
+            tool.run(ignore_results=True, save_results=True)
+            return True
+        except Exception, e:
+            logging.exception("Failed to run %s" % tool.name)
+            failures[tool] = e
+            return False
+
+    pool = ThreadPool(n_jobs) if n_jobs > 1 else None
+    try:
+        frontier = list(tools)
+        while len(frontier) > 0:
+            # Run this level of the tree
+            success = pool.map(run_tool, frontier) if pool is not None else map(run_tool, frontier)
+
+            # Gather the tools that follow those that succeeded
+            next_frontier = []
+            for tool, worked in zip(frontier, success):
+                if worked:
+                    next_frontier.extend(tool.get_next_steps())
+            frontier = next_frontier
+    finally:
+        if pool is not None:
+            pool.close()
 
-        return dict(depth=depth, width=width)
+    return failures
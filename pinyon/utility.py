@@ -1,4 +1,7 @@
+import time
+from collections import OrderedDict
 from datetime import datetime
+from threading import RLock
 
 from mongoengine.document import EmbeddedDocument
 from mongoengine.fields import StringField, DateTimeField
@@ -46,3 +49,92 @@ class Note(EmbeddedDocument):
         self._note = value
         # When this note was last edited
         self.edited = datetime.now()
+
+
+class LRUCache(object):
+    """Thread-safe cache that evicts the least-recently-used entries
+
+    Entries are also evicted once they are older than a certain age, or to keep the total size of the entries
+    below a limit"""
+
+    def __init__(self, max_entries=32, ttl=None, timer=time.time, max_size=None, sizeof=len):
+        """
+        :param max_entries: int, maximum number of entries to hold
+        :param ttl: float, maximum age of an entry, in seconds. None for no limit
+        :param timer: function, returns the current time in seconds
+        :param max_size: int, maximum total size of the entries (e.g., in bytes). None for no limit
+        :param sizeof: function, computes the size of an entry. Only used if `max_size` is set
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.timer = timer
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        missing = object()
+        return self.get(key, default=missing, count=False) is not missing
+
+    def get(self, key, default=None, count=True):
+        """Get an entry from the cache
+
+        :param key: key of the entry
+        :param default: value to return if the entry is not in the cache
+        :param count: boolean, whether to count this lookup as a hit or miss
+        :return: value of the entry, or `default`
+        """
+
+        with self._lock:
+            if key in self._entries:
+                created, value, size = self._entries.pop(key)
+                if self.ttl is None or self.timer() - created <= self.ttl:
+                    # Mark it as most recently used
+                    self._entries[key] = (created, value, size)
+                    if count:
+                        self.hits += 1
+                    return value
+                self.size -= size
+            if count:
+                self.misses += 1
+            return default
+
+    def set(self, key, value):
+        """Add an entry to the cache
+
+        :param key: key of the entry
+        :param value: value to be stored. Not stored if larger than `max_size`
+        """
+
+        size = 0 if self.max_size is None else self.sizeof(value)
+        with self._lock:
+            self.remove(key)
+            if self.max_size is not None and size > self.max_size:
+                return
+            self._entries[key] = (self.timer(), value, size)
+            self.size += size
+            while len(self._entries) > self.max_entries or (self.max_size is not None and self.size > self.max_size):
+                self.size -= self._entries.popitem(last=False)[1][2]
+
+    def remove(self, key):
+        """Remove an entry from the cache, if present
+
+        :param key: key of the entry"""
+
+        with self._lock:
+            if key in self._entries:
+                self.size -= self._entries.pop(key)[2]
+
+    def clear(self):
+        """Remove all entries"""
+
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
@@ -1,18 +1,21 @@
 from pyramid.config import Configurator
 
-from .. import connect_to_database, import_all_known_classes
+from .. import connect_to_database, ensure_indexes
 
 from ..extract import BaseExtractor
+from .profiling import install_listener, is_enabled as profiling_enabled
 
 
 def main(global_config, **settings):
     """Launch a Pyramid server. Used by PasteDeploy"""
 
-    # Connect to mongoDB
-    connect_to_database()
+    # Watch the database commands, if requested. Must be done before connecting
+    if profiling_enabled(settings):
+        install_listener()
 
-    # Make sure all known classes are registered
-    import_all_known_classes(debug=True)
+    # Connect to mongoDB. Tool classes are imported as they are loaded from the database
+    connect_to_database()
+    ensure_indexes()
 
     # Create the configuration tool
     config = Configurator(settings=settings)
@@ -26,6 +29,9 @@ def main(global_config, **settings):
     # Add in the routes
     config.include('.extract')
     config.include('.home')
+    config.include('.metrics')
+    if profiling_enabled(settings):
+        config.include('.profiling')
     config.include('.toolchain')
     config.include('.tool')
 
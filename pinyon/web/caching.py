@@ -0,0 +1,106 @@
+"""Utilities for HTTP caching of tool outputs and data downloads
+
+Responses carry an ETag and Last-Modified header derived from when the data was last generated, so that clients
+can make conditional requests and receive a "304 Not Modified" response when nothing has changed. Rendered
+outputs that are not stored with their artifact are also kept in a server-side cache, keyed by the contents of the
+artifact and the format.
+"""
+import calendar
+import hashlib
+import time
+
+from pyramid.httpexceptions import HTTPNotModified
+
+from pinyon import metrics
+from pinyon.utility import LRUCache
+
+render_cache = LRUCache(max_entries=32, max_size=64 * 1024 * 1024)
+"""Holds artifacts that have been rendered recently, up to 64 MB in total. Key is (artifact digest, format)"""
+metrics.registry.register_cache('render', render_cache)
+
+
+def make_etag(*parts):
+    """Make an entity tag from several values
+
+    :param parts: values that identify a certain version of an output (e.g., ID, time last run, format)
+    :return: string, entity tag
+    """
+    return hashlib.sha1('\n'.join(unicode(p).encode('utf-8') for p in parts)).hexdigest()
+
+
+def to_timestamp(when):
+    """Convert a local time, as stored by pinyon, to seconds since the epoch
+
+    :param when: datetime, local time
+    :return: int, seconds since the epoch
+    """
+    return int(time.mktime(when.timetuple()))
+
+
+def is_not_modified(request, etag, last_modified=None):
+    """Check whether a client already has the latest version of an output
+
+    :param request: Request, request from the client
+    :param etag: string, entity tag of the current version
+    :param last_modified: datetime, when the current version was created
+    :return: boolean, whether the client's copy is current
+    """
+
+    # If-None-Match takes precedence over If-Modified-Since
+    if request.if_none_match:
+        return etag in request.if_none_match
+    if last_modified is not None and request.if_modified_since is not None:
+        return to_timestamp(last_modified) <= calendar.timegm(request.if_modified_since.utctimetuple())
+    return False
+
+
+def set_cache_headers(response, etag, last_modified=None):
+    """Add the headers that allow clients to make conditional requests
+
+    :param response: Response, response to be modified
+    :param etag: string, entity tag of the output
+    :param last_modified: datetime, when the output was created
+    :return: Response, the modified response
+    """
+    response.etag = etag
+    if last_modified is not None:
+        response.last_modified = to_timestamp(last_modified)
+
+    # Clients may store the output, but must check whether it is current before using it
+    response.cache_control = 'no-cache'
+    return response
+
+
+def not_modified_response(etag, last_modified=None):
+    """Make a "304 Not Modified" response
+
+    :param etag: string, entity tag of the output
+    :param last_modified: datetime, when the output was created
+    :return: Response
+    """
+    return set_cache_headers(HTTPNotModified(), etag, last_modified)
+
+
+def render_artifact(artifact, target_format):
+    """Render an artifact, using a previously-rendered copy if available
+
+    Copies stored with the artifact (see `Artifact.rendered`) are used first, then those in `render_cache`. New
+    outputs are only stored in `render_cache`, so that each is held in memory once
+
+    :param artifact: Artifact, artifact to be rendered
+    :param target_format: string, desired format
+    :return: rendered artifact
+    """
+
+    if artifact.is_rendered(target_format):
+        return artifact.render_output(target_format)
+
+    # Name and description are included because some formats (e.g., HTML pages) display them
+    key = make_etag(artifact.get_digest(), artifact.__class__.__name__, artifact.name, artifact.description,
+                    target_format)
+    output = render_cache.get(key)
+    if output is None:
+        output = artifact._render_output(target_format)
+        if output is not None:
+            render_cache.set(key, output)
+    return output
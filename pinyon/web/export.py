@@ -0,0 +1,130 @@
+"""Tools for streaming large datasets to clients
+
+Text formats are produced a few thousand rows at a time, so the whole file is never held in memory. Parquet files
+are written once to a local cache directory and served from there until the data changes. Only the latest file for
+each dataset is kept.
+"""
+import hashlib
+import logging
+import os
+from tempfile import gettempdir, mkstemp
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+streamed_formats = dict(
+    csv=dict(extension='csv', content_type='text/csv', description='Comma-separated values file'),
+    jsonl=dict(extension='jsonl', content_type='application/x-ndjson', description='One JSON object per row'),
+    parquet=dict(extension='parquet', content_type='application/vnd.apache.parquet',
+                 description='Apache Parquet columnar file')
+)
+"""Formats that can be streamed. Key is the name of the format"""
+
+export_cache_dir = os.environ.get('PINYON_EXPORT_CACHE', os.path.join(gettempdir(), 'pinyon-exports'))
+"""Directory holding previously-written Parquet files"""
+
+
+def negotiate_format(request, available, default='csv'):
+    """Determine the format requested by a client
+
+    Uses the `format` parameter of the request, if provided. Otherwise, picks the best match for the Accept header
+
+    :param request: Request, request from the client
+    :param available: dict, formats that can be produced. Values must contain the key 'content_type'
+    :param default: string, format used if the client does not request one
+    :return: string, name of the format. None if the requested format is not available
+    """
+
+    if 'format' in request.GET:
+        name = request.GET['format']
+        return name if name in available else None
+
+    # Match the content types
+    offers = [default] + sorted(f for f in available if f != default and 'content_type' in available[f])
+    types = [available[f]['content_type'] for f in offers]
+    best = request.accept.best_match(types)
+    if best is None:
+        return default
+    return offers[types.index(best)]
+
+
+def _encode(text):
+    """Convert text to UTF-8 bytes, if needed"""
+    return text.encode('utf-8') if isinstance(text, unicode) else text
+
+
+def iter_csv(data, chunksize=10000):
+    """Render a DataFrame as CSV, a few rows at a time
+
+    :param data: DataFrame, data to be rendered
+    :param chunksize: int, number of rows rendered at a time
+    :return: iterator over bytes
+    """
+    if len(data) == 0:
+        yield _encode(data.to_csv(index=False))
+    for start in range(0, len(data), chunksize):
+        yield _encode(data.iloc[start:start + chunksize].to_csv(index=False, header=start == 0))
+
+
+def iter_json_lines(data, chunksize=10000):
+    """Render a DataFrame as JSON lines, a few rows at a time
+
+    :param data: DataFrame, data to be rendered
+    :param chunksize: int, number of rows rendered at a time
+    :return: iterator over bytes, each line is a JSON object holding one row
+    """
+    for start in range(0, len(data), chunksize):
+        chunk = data.iloc[start:start + chunksize]
+        yield _encode(chunk.to_json(orient='records', lines=True, date_format='iso')) + '\n'
+
+
+def _hash(value):
+    """Get a hash of a value, for use in a file name"""
+    return hashlib.sha1(unicode(value).encode('utf-8')).hexdigest()
+
+
+def get_parquet_file(data, name, version):
+    """Get the path to a Parquet file holding a certain dataset, writing it if needed
+
+    Files for other versions of the same dataset are deleted when a new version is written
+
+    :param data: DataFrame, dataset
+    :param name: string, name of the dataset (e.g., name of the extractor)
+    :param version: value that identifies this version of the dataset (e.g., time exported)
+    :return: string, path to the file
+    """
+
+    if pyarrow is None:
+        raise Exception('Parquet output requires pyarrow')
+
+    # Use the previous file, if available
+    prefix = _hash(name)
+    filename = '%s-%s.parquet' % (prefix, _hash(version)[:16])
+    path = os.path.join(export_cache_dir, filename)
+    if os.path.isfile(path):
+        return path
+
+    # Write to a temporary file, and then move it into place
+    if not os.path.isdir(export_cache_dir):
+        os.makedirs(export_cache_dir)
+    fd, temp_path = mkstemp(dir=export_cache_dir, suffix='.tmp')
+    os.close(fd)
+    try:
+        table = pyarrow.Table.from_pandas(data, preserve_index=False)
+        pyarrow.parquet.write_table(table, temp_path)
+        os.rename(temp_path, path)
+    finally:
+        if os.path.isfile(temp_path):
+            os.unlink(temp_path)
+
+    # Remove older versions. Clients still downloading them keep their open copy
+    for other in os.listdir(export_cache_dir):
+        if other.startswith(prefix + '-') and other.endswith('.parquet') and other != filename:
+            try:
+                os.unlink(os.path.join(export_cache_dir, other))
+            except OSError:
+                logging.warning('Could not remove old export file: %s' % other)
+    return path
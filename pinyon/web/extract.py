@@ -1,12 +1,15 @@
 """Views for extractors"""
 import os
-from pyramid.response import Response
+from pyramid.response import FileResponse, Response
 from pyramid.view import view_config
 import pyramid.httpexceptions as exc
 from tempfile import mkstemp
 
 from pinyon.artifacts import PandasArtifact
 from pinyon.extract import BaseExtractor
+from pinyon.web.caching import make_etag, is_not_modified, not_modified_response, set_cache_headers, \
+    render_artifact
+from pinyon.web.export import streamed_formats, negotiate_format, iter_csv, iter_json_lines, get_parquet_file
 
 
 class ExtractorViews:
@@ -33,7 +36,7 @@ class ExtractorViews:
         return {
             'name': name,
             'extractor': extractor,
-            'format_options': PandasArtifact().available_formats().keys()
+            'format_options': sorted(self.available_formats().keys())
         }
 
     @view_config(route_name='extractor_run')
@@ -54,25 +57,57 @@ class ExtractorViews:
 
     @view_config(route_name='extractor_data')
     def data(self):
-        """Send out data for external program"""
+        """Send out data for external program
 
-        # Get user request
-        extractor, name = self._get_extractor()
+        The format is taken from the `format` parameter or, if not provided, the Accept header. CSV, JSON lines and
+        Parquet files are streamed, so that large datasets need not be rendered in memory"""
 
         # Get desired format
-        data_format = self.request.GET.get('format', 'csv')
-
-        # Render into desired format
-        data_artifact = extractor.get_data()
-        output_data = data_artifact.render_output(data_format)
-        extension = self.available_formats()[data_format]['extension']
-
-        # Send out the data in CSV format
-        return Response(
-            content_type="application/force-download",
-            content_disposition='attachment; filename=%s.%s'%(extractor.name, extension),
-            body=output_data
-        )
+        formats = self.available_formats()
+        data_format = negotiate_format(self.request, formats)
+        if data_format is None:
+            return exc.HTTPNotFound(detail='No such format: %s' % self.request.GET.get('format'))
+
+        # Check if the client already has the current data, without loading the data
+        name = self.request.matchdict['name']
+        last_exported = BaseExtractor.objects(name=name).scalar('last_exported').first()
+        if last_exported is not None:
+            etag = make_etag(name, last_exported, data_format)
+            if is_not_modified(self.request, etag, last_exported):
+                return not_modified_response(etag, last_exported)
+
+        # Get user request
+        extractor, name = self._get_extractor()
+        disposition = 'attachment; filename=%s.%s' % (extractor.name, formats[data_format]['extension'])
+
+        if data_format in streamed_formats:
+            data = extractor.get_dataframe()
+            content_type = streamed_formats[data_format]['content_type']
+            if data_format == 'parquet':
+                path = get_parquet_file(data, name, extractor.last_exported)
+                response = FileResponse(path, request=self.request, content_type=content_type)
+                response.content_disposition = disposition
+            else:
+                rows = iter_csv(data) if data_format == 'csv' else iter_json_lines(data)
+                response = Response(app_iter=rows, content_type=content_type, content_disposition=disposition)
+        else:
+            # Render into desired format
+            data_artifact = extractor.get_data()
+            response = Response(
+                content_type="application/force-download",
+                content_disposition=disposition,
+                body=render_artifact(data_artifact, data_format)
+            )
+        return set_cache_headers(response, make_etag(name, extractor.last_exported, data_format),
+                                 extractor.last_exported)
+
+    def available_formats(self):
+        """List the formats data can be downloaded in
+
+        :return: dict, key is the name of the format and value is a dict with the extension and description"""
+        output = PandasArtifact().available_formats()
+        output.update(streamed_formats)
+        return output
 
 
 def includeme(config):
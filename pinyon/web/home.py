@@ -7,9 +7,8 @@ from pinyon.toolchain import ToolChain
 def home(request):
     """Home page"""
 
-    # Get the names of the extractors
-    toolchains = ToolChain.objects.all()
-    return {'toolchains': toolchains}
+    # Get summaries of the toolchains
+    return {'toolchains': ToolChain.get_summaries()}
 
 
 def includeme(config):
@@ -0,0 +1,48 @@
+"""Serve the metrics of the web application, and time each request"""
+import time
+
+from pyramid.response import Response
+from pyramid.view import view_config
+
+from pinyon import metrics
+
+exposition_content_type = 'text/plain; version=0.0.4; charset=utf-8'
+"""Content type of the Prometheus text exposition format"""
+
+
+def metrics_tween_factory(handler, registry):
+    """Make a tween that records the number and duration of requests, labelled by route
+
+    :param handler: function, next handler in the chain
+    :param registry: Registry, Pyramid component registry
+    :return: function, the tween
+    """
+
+    def metrics_tween(request):
+        start = time.time()
+        status = 500
+        try:
+            response = handler(request)
+            status = response.status_int
+            return response
+        finally:
+            route = getattr(request, 'matched_route', None)
+            route = 'unmatched' if route is None else route.name
+            metrics.request_count.inc(route=route, method=request.method, status=status)
+            metrics.request_duration.observe(time.time() - start, route=route, method=request.method)
+
+    return metrics_tween
+
+
+@view_config(route_name='metrics')
+def view_metrics(request):
+    """Render all metrics of this process in the text exposition format"""
+    response = Response(body=metrics.registry.render())
+    response.headers['Content-Type'] = exposition_content_type
+    response.cache_control = 'no-cache'
+    return response
+
+
+def includeme(config):
+    config.add_route('metrics', '/metrics')
+    config.add_tween('pinyon.web.metrics.metrics_tween_factory')
@@ -0,0 +1,195 @@
+"""Count and time the MongoDB commands issued while handling each web request
+
+Enabled by setting `pinyon.profile_queries = true` in the application settings. Commands are observed through the
+command monitoring interface of pymongo, which must be installed before the connection to the database is made.
+
+Requests that issue more than `pinyon.profile_queries.max_queries` commands (default: 50) or spend more than
+`pinyon.profile_queries.max_time` seconds (default: 1) in the database are logged as warnings. Totals for each route
+are served at /profile/queries and included in /metrics.
+"""
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from pymongo import monitoring
+from pyramid.response import Response
+from pyramid.settings import asbool
+
+from pinyon import metrics
+
+mongo_commands = metrics.Counter('pinyon_mongo_commands_total', 'Number of MongoDB commands issued by web requests',
+                                 ['route'])
+mongo_time = metrics.Counter('pinyon_mongo_command_seconds_total',
+                             'Time web requests spent waiting for MongoDB commands', ['route'])
+
+
+class QueryTracker(object):
+    """Record of the commands issued while handling a single request"""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.commands = dict()
+
+    def add(self, command, duration):
+        """Record a command
+
+        :param command: string, name of the command (e.g., find, update)
+        :param duration: float, time to complete the command, in seconds
+        """
+        self.count += 1
+        self.duration += duration
+        self.commands[command] = self.commands.get(command, 0) + 1
+
+
+class QueryListener(monitoring.CommandListener):
+    """Reports each completed command to the tracker of the current thread, if there is one"""
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def start_tracking(self):
+        """Begin recording the commands issued by this thread
+
+        :return: QueryTracker, tracker that will hold the commands"""
+        self._local.tracker = QueryTracker()
+        return self._local.tracker
+
+    def stop_tracking(self):
+        """Stop recording the commands issued by this thread"""
+        self._local.tracker = None
+
+    def _record(self, event):
+        tracker = getattr(self._local, 'tracker', None)
+        if tracker is not None:
+            tracker.add(event.command_name, event.duration_micros / 1e6)
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self._record(event)
+
+    def failed(self, event):
+        self._record(event)
+
+
+query_listener = QueryListener()
+"""Listener used by the profiling tween"""
+
+_installed = False
+"""Whether `query_listener` has been registered with pymongo"""
+
+
+def install_listener():
+    """Register the listener with pymongo. Only affects connections that are opened afterwards"""
+    global _installed
+    if not _installed:
+        monitoring.register(query_listener)
+        _installed = True
+
+
+class RouteStats(object):
+    """Totals of the queries made by requests to each route"""
+
+    def __init__(self):
+        self._stats = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, route, tracker, slow):
+        """Add the queries made by a request
+
+        :param route: string, name of the route
+        :param tracker: QueryTracker, commands issued by the request
+        :param slow: boolean, whether the request exceeded the thresholds
+        """
+        with self._lock:
+            stats = self._stats.setdefault(route, dict(requests=0, queries=0, query_time=0.0, max_queries=0,
+                                                       max_query_time=0.0, slow_requests=0))
+            stats['requests'] += 1
+            stats['queries'] += tracker.count
+            stats['query_time'] += tracker.duration
+            stats['max_queries'] = max(stats['max_queries'], tracker.count)
+            stats['max_query_time'] = max(stats['max_query_time'], tracker.duration)
+            if slow:
+                stats['slow_requests'] += 1
+
+    def summarize(self):
+        """Get the totals for each route
+
+        :return: dict, key is the route name. Values include the mean number of queries and time per request
+        """
+        with self._lock:
+            output = dict()
+            for route, stats in self._stats.items():
+                output[route] = dict(stats)
+                output[route]['mean_queries'] = float(stats['queries']) / stats['requests']
+                output[route]['mean_query_time'] = stats['query_time'] / stats['requests']
+            return output
+
+
+route_stats = RouteStats()
+"""Totals for the routes of this process"""
+
+
+def query_profiling_tween_factory(handler, registry):
+    """Make a tween that records the MongoDB commands issued by each request
+
+    :param handler: function, next handler in the chain
+    :param registry: Registry, Pyramid component registry. Thresholds are read from its settings
+    :return: function, the tween
+    """
+
+    settings = registry.settings or dict()
+    max_queries = int(settings.get('pinyon.profile_queries.max_queries', 50))
+    max_time = float(settings.get('pinyon.profile_queries.max_time', 1))
+
+    def query_profiling_tween(request):
+        tracker = query_listener.start_tracking()
+        start = time.time()
+        try:
+            return handler(request)
+        finally:
+            query_listener.stop_tracking()
+            route = getattr(request, 'matched_route', None)
+            route = 'unmatched' if route is None else route.name
+
+            # Report slow requests
+            slow = tracker.count > max_queries or tracker.duration > max_time
+            if slow:
+                commands = sorted(tracker.commands.items(), key=lambda x: -x[1])
+                logging.warning('%s %s (route %s) issued %d MongoDB commands taking %.3f s, in %.3f s total. '
+                                'Commands: %s' % (request.method, request.path, route, tracker.count,
+                                                  tracker.duration, time.time() - start,
+                                                  ', '.join('%s=%d' % c for c in commands)))
+
+            # Update the totals
+            route_stats.add(route, tracker, slow)
+            mongo_commands.inc(tracker.count, route=route)
+            mongo_time.inc(tracker.duration, route=route)
+
+    return query_profiling_tween
+
+
+def view_query_stats(request):
+    """Render the totals for each route as JSON"""
+    return Response(body=json.dumps(route_stats.summarize(), indent=2, sort_keys=True),
+                    content_type='application/json')
+
+
+def is_enabled(settings):
+    """Check whether query profiling is enabled
+
+    :param settings: dict, application settings
+    :return: boolean
+    """
+    return asbool((settings or dict()).get('pinyon.profile_queries', False))
+
+
+def includeme(config):
+    # Views are added here, rather than by scanning, because the route only exists when profiling is enabled
+    config.add_route('profile_queries', '/profile/queries')
+    config.add_view(view_query_stats, route_name='profile_queries')
+    config.add_tween('pinyon.web.profiling.query_profiling_tween_factory')
@@ -0,0 +1,134 @@
+"""Tools for serving slices of a dataset, so that clients need not download a whole table
+
+Datasets are kept in memory after they are first loaded, keyed by the tool and the time it was last run. Repeated
+queries against the same result are served without reading the tool from the database.
+
+Filters are evaluated only with numexpr, so that a query cannot make the server fall back to the much slower
+Python engine. Filters numexpr cannot handle are rejected.
+"""
+import json
+
+from pinyon import metrics
+from pinyon.tool.simple import evaluate
+from pinyon.utility import LRUCache
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+
+def get_data_size(data):
+    """Get the memory used by a dataset
+
+    :param data: DataFrame, dataset
+    :return: int, size in bytes, including the index and the contents of object columns
+    """
+    return int(data.memory_usage(index=True, deep=True).sum())
+
+
+data_cache = LRUCache(max_entries=8, max_size=512 * 1024 * 1024, sizeof=get_data_size)
+"""Holds datasets that have been queried recently, up to 512 MB in total. Key is (tool ID, time last run)"""
+metrics.registry.register_cache('query', data_cache)
+
+arrow_content_type = 'application/vnd.apache.arrow.stream'
+"""Content type of the Arrow streaming format"""
+
+
+class QueryError(Exception):
+    """Raised when a query is not valid"""
+    pass
+
+
+def parse_query(params):
+    """Read the query from the parameters of a request
+
+    :param params: dict, parameters from the request. Keys:
+        columns -> comma-separated list of columns to return
+        start, stop -> range of rows to return, after filtering and sorting
+        filter -> query used to select rows (see `DataFrame.query`). Must be supported by numexpr
+        sort -> comma-separated list of columns to sort by. Prefix with '-' for descending order
+    :return: dict, options for `run_query`
+    """
+
+    output = dict()
+    if params.get('columns'):
+        output['columns'] = [c.strip() for c in params['columns'].split(',') if len(c.strip()) > 0]
+    for key in ['start', 'stop']:
+        if params.get(key):
+            try:
+                output[key] = int(params[key])
+            except ValueError:
+                raise QueryError('%s must be an integer' % key)
+    if params.get('filter'):
+        output['filter'] = params['filter']
+    if params.get('sort'):
+        output['sort'] = [c.strip() for c in params['sort'].split(',') if len(c.strip()) > 0]
+    return output
+
+
+def run_query(data, columns=None, start=None, stop=None, filter=None, sort=None):
+    """Select a portion of a dataset
+
+    :param data: DataFrame, dataset to be queried
+    :param columns: list of string, names of the columns to return. None to return all
+    :param start: int, index of the first row to return
+    :param stop: int, index of the row after the last to return
+    :param filter: string, query used to select rows. Evaluated with numexpr
+    :param sort: list of string, columns to sort by. Columns prefixed by '-' are sorted in descending order
+    :return: (DataFrame, int), selected data and the number of rows that matched the filter
+    """
+
+    # Check the column names
+    names = list(columns or []) + [s.lstrip('-') for s in sort or []]
+    missing = [c for c in names if c not in data.columns]
+    if len(missing) > 0:
+        raise QueryError('No such column(s): %s' % ', '.join(missing))
+
+    # Select the rows
+    if filter is not None:
+        try:
+            data = evaluate(data, 'query', filter, fallback=False)
+        except Exception, e:
+            raise QueryError('Invalid filter: %s' % e)
+    total = len(data)
+
+    # Sort them
+    if sort:
+        data = data.sort_values([s.lstrip('-') for s in sort], ascending=[not s.startswith('-') for s in sort])
+
+    # Get the requested portion
+    data = data.iloc[start:stop]
+    if columns:
+        data = data[columns]
+    return data, total
+
+
+def to_json(data, total, start=None):
+    """Render a query result as JSON
+
+    :param data: DataFrame, selected data
+    :param total: int, number of rows that matched the query
+    :param start: int, index of the first row that was requested
+    :return: string, JSON object with keys columns, index, data (list of rows), total, and start
+    """
+    output = json.loads(data.to_json(orient='split', date_format='iso'))
+    output['total'] = total
+    output['start'] = start or 0
+    return json.dumps(output)
+
+
+def to_arrow(data):
+    """Render a query result in the Arrow streaming format
+
+    :param data: DataFrame, selected data
+    :return: bytes, Arrow stream
+    """
+    if pyarrow is None:
+        raise QueryError('Arrow output requires pyarrow')
+    table = pyarrow.Table.from_pandas(data, preserve_index=False)
+    sink = pyarrow.BufferOutputStream()
+    writer = pyarrow.RecordBatchStreamWriter(sink, table.schema)
+    writer.write_table(table)
+    writer.close()
+    return sink.getvalue().to_pybytes()
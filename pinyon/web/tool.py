@@ -1,5 +1,6 @@
 """Web views for tools"""
 import cPickle as pickle
+from threading import Thread
 
 import nbformat
 import pyramid.httpexceptions as exc
@@ -7,13 +8,17 @@ from nbconvert.exporters.html import HTMLExporter
 from pyramid.response import Response
 from pyramid.view import view_config
 
-from pinyon import import_all_known_classes, get_class
+from pinyon import KnownClass, get_class
 from pinyon.artifacts import PandasArtifact, PythonArtifact
 from pinyon.toolchain import ToolChain
 from pinyon.tool import WorkflowTool
-from pinyon.tool.decision import HTMLDecisionTracker, SingleEntryHTMLDecisionTracker
+from pinyon.tool.decision import HTMLDecisionTracker, SingleEntryHTMLDecisionTracker, \
+    SingleEntryBokehHTMLDecisionTracker
 from pinyon.tool.jupyter import JupyterNotebookTransformer
 from pinyon.tool.jupyter import add_data
+from pinyon.web.caching import make_etag, is_not_modified, not_modified_response, set_cache_headers, \
+    render_artifact
+from pinyon.web.query import QueryError, data_cache, parse_query, run_query, to_json, to_arrow, arrow_content_type
 
 
 class ToolViews:
@@ -31,6 +36,12 @@ class ToolViews:
         except:
             exc.HTTPNotFound(detail='No such tool: %s' % tid)
 
+    def _get_last_run(self):
+        """Get when the requested tool was last run, without loading its results
+
+        :return: datetime, when the tool was last run. None if it has not been run"""
+        return WorkflowTool.objects(id=self.request.matchdict['id']).scalar('last_run').first()
+
     @view_config(route_name='tool_view', renderer='template/tool_view.jinja2')
     def view(self):
         """Just view the tool"""
@@ -42,7 +53,8 @@ class ToolViews:
             'tool': tool,
             'format_options': PandasArtifact().available_formats().keys(),
             'is_jupyter': isinstance(tool, JupyterNotebookTransformer),
-            'is_decision': isinstance(tool, HTMLDecisionTracker)
+            'is_decision': isinstance(tool, HTMLDecisionTracker),
+            'can_prerender': isinstance(tool, SingleEntryBokehHTMLDecisionTracker)
         }
 
     @view_config(route_name='tool_run')
@@ -56,47 +68,144 @@ class ToolViews:
         go_recursive = self.request.GET.get('recursive', "False")
         go_recursive = True if go_recursive.lower() == "true" else False
 
+        # Check if they want a profile of the run
+        profile = self.request.GET.get('profile', "False")
+        profile = True if profile.lower() == "true" else False
+
         # Rerun tool, and any of the following tool (if desired)
-        tool.run(ignore_results=True, save_results=True, run_subsequent=go_recursive)
+        tool.run(ignore_results=True, save_results=True, run_subsequent=go_recursive, profile=profile)
         tool.save()
 
         return exc.HTTPFound(self.request.route_url('tool_view', id=name))
 
-    @view_config(route_name='tool_data')
-    def data(self):
-        """Send out data for external program"""
+    @view_config(route_name='tool_cancel')
+    def cancel(self):
+        """Stop the notebook being run by a tool"""
 
         # Get user request
         tool, name = self._get_tool()
 
+        # Check that it runs notebooks
+        if not hasattr(tool, 'cancel'):
+            return exc.HTTPNotAcceptable(detail='Tool does not run a notebook')
+
+        # Cancel the run
+        if not tool.cancel():
+            return exc.HTTPNotFound(detail='Tool %s is not running' % tool.name)
+
+        # Mark it as failed, without overwriting anything stored by the run
+        tool.last_error = 'NotebookCancelled: Cancelled by user'
+        tool.update(set__last_error=tool.last_error)
+        if not tool.update_toolchain_status():
+            tool.update_toolchain_summary()
+        tool.publish_event('failed', error=tool.last_error)
+
+        return exc.HTTPFound(self.request.route_url('tool_view', id=name))
+
+    @view_config(route_name='tool_data')
+    def data(self):
+        """Send out data for external program"""
+
         # Get desired format
         data_format = self.request.GET.get('format', 'csv')
 
+        # Check if the client already has the current data
+        tid = self.request.matchdict['id']
+        last_run = self._get_last_run()
+        if last_run is not None:
+            etag = make_etag(tid, last_run, 'data', data_format)
+            if is_not_modified(self.request, etag, last_run):
+                return not_modified_response(etag, last_run)
+
+        # Get user request
+        tool, name = self._get_tool()
+
         # Get the results of the tool
         res = tool.run(save_results=True)
 
         # Render into desired format
         data_artifact = res['data']
-        output_data = data_artifact.render_output(data_format)
+        was_rendered = data_artifact.is_rendered(data_format)
+        output_data = render_artifact(data_artifact, data_format)
+        if not was_rendered and data_artifact.is_rendered(data_format):
+            tool.save_rendered(['data'])
         extension = data_artifact.available_formats()[data_format]['extension']
 
         # Send out the data in CSV format
-        return Response(
+        response = Response(
             content_type="application/force-download",
             content_disposition='attachment; filename=%s.%s' % (tool.name, extension),
             body=output_data
         )
+        return set_cache_headers(response, make_etag(tid, tool.last_run, 'data', data_format), tool.last_run)
+
+    @view_config(route_name='tool_query')
+    def query(self):
+        """Get a portion of the data from this tool
+
+        Request parameters are described in `pinyon.web.query.parse_query`. Data are returned as JSON unless
+        `format=arrow` is requested or the Accept header prefers the Arrow streaming format"""
+
+        # Get the query
+        try:
+            options = parse_query(self.request.GET)
+        except QueryError, e:
+            return exc.HTTPBadRequest(detail=str(e))
+        output_format = self.request.GET.get('format')
+        if output_format is None:
+            best = self.request.accept.best_match(['application/json', arrow_content_type])
+            output_format = 'arrow' if best == arrow_content_type else 'json'
+        if output_format not in ['json', 'arrow']:
+            return exc.HTTPBadRequest(detail='No such format: %s' % output_format)
+
+        # Check if the client already has this result
+        tid = self.request.matchdict['id']
+        last_run = self._get_last_run()
+        if last_run is not None:
+            etag = make_etag(tid, last_run, 'query', output_format, self.request.query_string)
+            if is_not_modified(self.request, etag, last_run):
+                return not_modified_response(etag, last_run)
+
+        # Get the data, from memory if possible
+        data = data_cache.get((tid, last_run)) if last_run is not None else None
+        if data is None:
+            tool, name = self._get_tool()
+            data = tool.run(save_results=True)['data'].get_object()
+            last_run = tool.last_run
+            data_cache.set((tid, last_run), data)
+
+        # Run the query
+        try:
+            result, total = run_query(data, **options)
+            if output_format == 'arrow':
+                response = Response(body=to_arrow(result), content_type=arrow_content_type)
+            else:
+                response = Response(body=to_json(result, total, options.get('start')),
+                                    content_type='application/json', charset='UTF-8')
+        except QueryError, e:
+            return exc.HTTPBadRequest(detail=str(e))
+        return set_cache_headers(response, make_etag(tid, last_run, 'query', output_format,
+                                                     self.request.query_string), last_run)
 
     @view_config(route_name='tool_output')
     def output(self):
         """Download an output from this tool"""
 
-        # Get the requested tool
-        tool, tid = self._get_tool()
-
         # Get request output
         output_name = self.request.matchdict['piece']
 
+        # Check if the client already has the current output
+        tid = self.request.matchdict['id']
+        request_format = self.request.GET.get('format')
+        last_run = self._get_last_run()
+        if last_run is not None:
+            etag = make_etag(tid, last_run, output_name, request_format)
+            if is_not_modified(self.request, etag, last_run):
+                return not_modified_response(etag, last_run)
+
+        # Get the requested tool
+        tool, tid = self._get_tool()
+
         # Get that object, or throw a 404
         outputs = tool.run(save_results=True)
         if output_name not in outputs:
@@ -106,20 +215,27 @@ class ToolViews:
         # Get desired format
         output_format = self.request.GET.get('format', output.default_format())
         if output_format not in output.available_formats():
-            raise exc.HTTPNotFound(detail='Format %s not supported for %s'%(output_name, output_format()))
+            raise exc.HTTPNotFound(detail='Format %s not supported for %s' % (output_format, output_name))
 
         # Get the desired extension for that format
         extension = output.available_formats()[output_format]['extension']
 
         # Render that object as a pkl and return
+        etag = make_etag(tid, tool.last_run, output_name, request_format)
+        was_rendered = output.is_rendered(output_format)
+        output_data = render_artifact(output, output_format)
+        if not was_rendered and output.is_rendered(output_format):
+            tool.save_rendered([output_name])
         if output_format == 'html':
-            return Response(output.render_output(output_format))
-        return Response(
-            content_type="application/force-download",
-            content_disposition='attachment; filename=%s.%s' % (output_name, extension),
-            body=output.render_output(output_format),
-            charset='UTF-8'
-        )
+            response = Response(output_data)
+        else:
+            response = Response(
+                content_type="application/force-download",
+                content_disposition='attachment; filename=%s.%s' % (output_name, extension),
+                body=output_data,
+                charset='UTF-8'
+            )
+        return set_cache_headers(response, etag, tool.last_run)
 
     @view_config(route_name='tool_file')
     def get_file(self):
@@ -152,9 +268,12 @@ class ToolViews:
         output_style = self.request.GET.get('format', 'html')
 
         # Load in the notebook
-        if output_style == 'html':
+        if output_style in ['html', 'executed']:
             # Parse the notebook as an notebook object
-            nb = nbformat.reads(tool.notebook, nbformat.NO_CONVERT)
+            if output_style == 'executed' and tool.execution_record is not None:
+                nb = nbformat.reads(tool.execution_record, nbformat.NO_CONVERT)
+            else:
+                nb = nbformat.reads(tool.notebook, nbformat.NO_CONVERT)
             add_data(nb, None, None, use_placeholder=True)
 
             # Render it as HTML
@@ -226,6 +345,33 @@ class ToolViews:
 
         return Response(tool.get_html_tool())
 
+    @view_config(route_name='tool_prerender')
+    def prerender(self):
+        """Start rendering the plots for each entry of a decision tool in the background"""
+
+        # Get user request
+        tool, name = self._get_tool()
+
+        # Check that it is a tool that renders plots for each entry
+        if not isinstance(tool, SingleEntryBokehHTMLDecisionTracker):
+            return exc.HTTPNotAcceptable(detail='Tool does not render plots for each entry')
+
+        # Get the range of entries and number of processes
+        try:
+            start = int(self.request.GET['start']) if 'start' in self.request.GET else None
+            stop = int(self.request.GET['stop']) if 'stop' in self.request.GET else None
+            n_jobs = int(self.request.GET.get('jobs', 1))
+        except ValueError:
+            return exc.HTTPBadRequest(detail='start, stop and jobs must be integers')
+
+        # Render them in the background
+        thread = Thread(target=tool.prerender_entries,
+                        kwargs=dict(start=start, stop=stop, n_jobs=n_jobs, save_results=True))
+        thread.daemon = True
+        thread.start()
+
+        return exc.HTTPFound(self.request.route_url('tool_view', id=name))
+
     @view_config(route_name='tool_create', renderer='template/tool_create.jinja2')
     def create_tool(self):
         """Generate a form for creating a new tool"""
@@ -268,8 +414,7 @@ class ToolViews:
                 errors=e.message
 
         #    Get all workflow tool
-        tools = import_all_known_classes()
-        tools = [k for k,v in tools.iteritems() if isinstance(v, WorkflowTool)]
+        tools = KnownClass.get_subclasses('WorkflowTool')
 
         return {
             'tools': tools,
@@ -295,11 +440,14 @@ class ToolViews:
 def includeme(config):
     config.add_route('tool_view', '/tool/{id}/view')
     config.add_route('tool_run', '/tool/{id}/run')
+    config.add_route('tool_cancel', '/tool/{id}/cancel')
     config.add_route('tool_data', '/tool/{id}/data')
+    config.add_route('tool_query', '/tool/{id}/query')
     config.add_route('tool_output', '/tool/{id}/output/{piece}')
     config.add_route('tool_jupyter', '/tool/{id}/jupyter')
     config.add_route('tool_edit', '/tool/{id}/edit')
     config.add_route('tool_decision', '/tool/{id}/decision')
+    config.add_route('tool_prerender', '/tool/{id}/prerender')
     config.add_route('tool_create', '/tool/create/{toolchain}')
     config.add_route('tool_delete', '/tool/{id}/delete')
     config.add_route('tool_file', '/tool/{id}/file/{file}')
@@ -1,9 +1,13 @@
 """Views for extractors"""
+from threading import Thread
+
+from bson import ObjectId
 from pyramid.renderers import render_to_response
 from pyramid.response import Response
 from pyramid.view import view_config
 import pyramid.httpexceptions as exc
 
+from pinyon.events import stream_events, max_stream_time
 from pinyon.toolchain import ToolChain
 import networkx as nx
 from matplotlib import pyplot as plt
@@ -36,7 +40,9 @@ class ToolChainViews:
         return {
             'name': name,
             'toolchain': toolchain,
-            'stats': net_stats
+            'stats': net_stats,
+            'extractor': toolchain.get_extractor_summary(),
+            'tools': toolchain.get_tool_status()
         }
 
     @view_config(route_name='toolchain_run')
@@ -46,12 +52,43 @@ class ToolChainViews:
         # Get user request
         toolchain, name = self._get_toolchain()
 
+        # Check whether to return before the run completes
+        background = self.request.GET.get('background', "False")
+        background = True if background.lower() == "true" else False
+
         # Rerun extraction
-        toolchain.extractor.get_data(ignore_cache=True, run_subsequent=True, save_results=True)
-        toolchain.save()
+        if background:
+            # Progress is reported through the event stream
+            thread = Thread(target=_run_toolchain, args=(toolchain,))
+            thread.daemon = True
+            thread.start()
+        else:
+            _run_toolchain(toolchain)
 
         raise exc.HTTPFound(self.request.route_url('toolchain_view', name=name))
 
+    @view_config(route_name='toolchain_events')
+    def events(self):
+        """Stream the progress of tools in this toolchain as server-sent events"""
+
+        toolchain, name = self._get_toolchain()
+
+        # Browsers send the ID of the last event they received when reconnecting
+        after = self.request.headers.get('Last-Event-ID') or self.request.GET.get('after')
+        if after is not None and not ObjectId.is_valid(after):
+            raise exc.HTTPBadRequest(detail='Not a valid event ID: %s' % after)
+
+        # Each stream holds a thread of the server, so streams are kept short. Browsers reconnect when they end
+        try:
+            timeout = min(float(self.request.GET.get('timeout', max_stream_time)), max_stream_time)
+        except ValueError:
+            raise exc.HTTPBadRequest(detail='timeout must be a number')
+
+        response = Response(content_type='text/event-stream',
+                            app_iter=stream_events(toolchain.id, after=after, timeout=timeout))
+        response.cache_control = 'no-cache'
+        return response
+
     @view_config(route_name='toolchain_network')
     def network(self):
         # Get user request
@@ -64,7 +101,16 @@ class ToolChainViews:
         return Response(body=json.dumps(network, indent=2))
 
 
+def _run_toolchain(toolchain):
+    """Re-extract the data of a toolchain and re-run all of its tools
+
+    :param toolchain: ToolChain, toolchain to be run"""
+    toolchain.extractor.get_data(ignore_cache=True, run_subsequent=True, save_results=True)
+    toolchain.save()
+
+
 def includeme(config):
     config.add_route('toolchain_view', '/toolchain/{name}/view')
     config.add_route('toolchain_run', '/toolchain/{name}/run')
+    config.add_route('toolchain_events', '/toolchain/{name}/events')
     config.add_route('toolchain_network', '/toolchain/{name}/network')
@@ -18,6 +18,7 @@ setup(
 	'dill',
 	'jupyter',
         'mongoengine',
+        'numexpr',
         'pandas',
 	'pint',
 	'periodictable',
@@ -29,5 +30,12 @@ setup(
 	'wtforms',
 	'xmltodict',
     ],
-    packages=find_packages(exclude=('tests', 'docs'))
+    extras_require={
+        'compression': ['zstandard', 'lz4'],
+        'excel': ['openpyxl']
+    },
+    packages=find_packages(exclude=('tests', 'docs')),
+    entry_points={
+        'console_scripts': ['pinyon=pinyon.cli:main']
+    }
 )
@@ -1,9 +1,11 @@
 from unittest import TestCase
 import os
+from tempfile import mkstemp
 
 import pickle
+from pandas import DataFrame
 
-from pinyon.extract import ExcelExtractor
+from pinyon.extract import ExcelExtractor, DelimitedTextExtractor
 
 
 class TestBase(TestCase):
@@ -31,3 +33,48 @@ class TestBase(TestCase):
         ex._data_cache = None
         self.assertEquals(data.to_csv(), ex.get_data().to_csv())
         self.assertIsNotNone(ex._data_cache)
+
+    def test_delimited(self):
+        """Make sure data read in chunks matches reading the whole file"""
+
+        # Make a test file
+        fd, path = mkstemp(suffix='.csv')
+        os.close(fd)
+        expected = DataFrame({'a': range(10), 'b': [x / 3.0 for x in range(10)], 'c': ['x', 'y'] * 5})
+        expected.to_csv(path, index=False)
+
+        try:
+            ex = DelimitedTextExtractor(path=path, chunksize=3, downcast='all', usecols=['a', 'c'],
+                                        skip_unchanged=True)
+            data = ex.get_data().get_object()
+            self.assertEquals(['a', 'c'], list(data.columns))
+            self.assertEquals(list(expected['a']), list(data['a']))
+            self.assertEquals(list(expected['c']), list(data['c']))
+            self.assertEquals('category', str(data['c'].dtype))
+            self.assertEquals(1, data['a'].dtype.itemsize)
+
+            # Re-running with the same file should not re-read it
+            first_pull = ex.last_exported
+            ex.get_data(ignore_cache=True)
+            self.assertEquals(first_pull, ex.last_exported)
+
+            # Changing the options should
+            ex.usecols = []
+            data = ex.get_data(ignore_cache=True).get_object()
+            self.assertNotEquals(first_pull, ex.last_exported)
+            self.assertEquals(['a', 'b', 'c'], list(data.columns))
+        finally:
+            os.unlink(path)
+
+    def test_excel_chunks(self):
+        """Make sure reading an Excel file in chunks gives the same data"""
+
+        path = os.path.join('test-files', 'travel-times.xlsx')
+        expected = ExcelExtractor(path=path, sheet='To').get_data().get_object()
+        data = ExcelExtractor(path=path, sheet='To', chunksize=5).get_data().get_object()
+        self.assertEquals(list(expected.columns), list(data.columns))
+        self.assertEquals(len(expected), len(data))
+
+        # Options for pandas cannot be used when reading in chunks
+        with self.assertRaises(Exception):
+            ExcelExtractor(path=path, sheet='To', chunksize=5, import_options={'skiprows': 1})._run_extraction()
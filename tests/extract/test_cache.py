@@ -0,0 +1,48 @@
+from unittest import TestCase
+from collections import OrderedDict
+from tempfile import mkdtemp
+import os
+import shutil
+
+from pinyon.extract.cache import RecordCache
+
+
+class TestRecordCache(TestCase):
+
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.cache = RecordCache(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_cache(self):
+        records = [OrderedDict([('_id', 'a'), ('b', 1), ('a', [1, 2])]), OrderedDict([('_id', 'b'), ('b', 2)])]
+
+        # Nothing stored yet
+        self.assertFalse(self.cache.has_records('host', 'template'))
+        self.assertIsNone(self.cache.get_version('host', 'template'))
+        self.assertEquals([], self.cache.load('host', 'template'))
+
+        # Store, then read back
+        self.assertEquals(2, self.cache.update('host', 'template', records))
+        version = self.cache.get_version('host', 'template')
+        self.assertIsNotNone(version)
+        self.assertTrue(self.cache.has_records('host', 'template'))
+        self.assertFalse(self.cache.has_records('host', 'other'))
+        loaded = self.cache.load('host', 'template')
+        self.assertEquals(records, loaded)
+        self.assertEquals(['_id', 'b', 'a'], list(loaded[0].keys()))
+
+        # Only the changed record should be counted
+        records[1]['b'] = 3
+        self.assertEquals(1, self.cache.update('host', 'template', records))
+        self.assertNotEquals(version, self.cache.get_version('host', 'template'))
+        self.assertEquals(3, self.cache.load('host', 'template')[1]['b'])
+
+        # No temporary files are left behind
+        self.assertEquals(2, len(os.listdir(self.directory)))
+
+        # Clear the cache
+        self.cache.clear('host', 'template')
+        self.assertFalse(self.cache.has_records('host', 'template'))
@@ -1,6 +1,11 @@
 import unittest
+from pinyon import connect_to_database
+from pinyon.extract import mdcs as mdcs_extract
+from pinyon.extract.cache import RecordCache
 from pinyon.extract.mdcs import *
+from tempfile import mkdtemp
 import xmltodict
+import shutil
 import os
 
 
@@ -112,4 +117,109 @@ class TestMDCSUtilities(unittest.TestCase):
             units='min'
         )
 
-        self.assertEquals(60, flat.extract_data(test_xml))
\ No newline at end of file
+        self.assertEquals(60, flat.extract_data(test_xml))
+
+    def test_parallel_flattening(self):
+        flatteners = [
+            ExtractorFlattener(name='HardnessType', location=['HardnessMeasurement', 'Hardness', 'measurement-type']),
+            PhysicalQuantityExtractorFlattener(name='Temperature',
+                                               location=['HardnessMeasurement', 'AgingCondition', 'temperature']),
+            ExtractorFlattener(name='Missing', location=['NoSuchTag'])
+        ]
+        entries = [self.test_xml] * 37
+
+        # Make sure the serial and parallel paths give the same result
+        serial = MDCSExtractor(flatteners=flatteners).flatten_entries(entries)
+        parallel = MDCSExtractor(flatteners=flatteners, n_jobs=2).flatten_entries(entries)
+        self.assertEquals(37, len(parallel))
+        self.assertEquals(serial.to_csv(), parallel.to_csv())
+        self.assertEquals(list(serial.dtypes), list(parallel.dtypes))
+
+    def test_flattener_dtypes(self):
+        flatteners = [
+            ExtractorFlattener(name='HardnessType', location=['HardnessMeasurement', 'Hardness', 'measurement-type'],
+                               dtype='category'),
+            PhysicalQuantityExtractorFlattener(name='Temperature',
+                                               location=['HardnessMeasurement', 'AgingCondition', 'temperature']),
+            PhysicalQuantityExtractorFlattener(name='Missing', location=['NoSuchTag'], dtype='int32'),
+            ExtractorFlattener(name='Untyped', location=['HardnessMeasurement', 'Hardness', 'measurement-type'])
+        ]
+        data = MDCSExtractor(flatteners=flatteners).flatten_entries([self.test_xml] * 3)
+
+        self.assertEquals(['HardnessType', 'Temperature', 'Missing', 'Untyped'], list(data.columns))
+        self.assertEquals('category', str(data['HardnessType'].dtype))
+        self.assertEquals('float64', str(data['Temperature'].dtype))
+        self.assertEquals([25.0] * 3, list(data['Temperature']))
+        self.assertEquals('float64', str(data['Missing'].dtype))
+        self.assertTrue(data['Missing'].isnull().all())
+        self.assertEquals(['rockwell a'] * 3, list(data['Untyped']))
+
+    def test_dtype_conversion(self):
+        flatteners = [
+            PhysicalQuantityExtractorFlattener(name='Temperature',
+                                               location=['HardnessMeasurement', 'AgingCondition', 'temperature'],
+                                               dtype='int32'),
+            ExtractorFlattener(name='HardnessType', location=['HardnessMeasurement', 'Hardness', 'measurement-type'],
+                               dtype='float32')
+        ]
+        data = MDCSExtractor(flatteners=flatteners).flatten_entries([self.test_xml] * 3)
+
+        # Values that fit the type are converted, others are left unchanged
+        self.assertEquals('int32', str(data['Temperature'].dtype))
+        self.assertEquals([25] * 3, list(data['Temperature']))
+        self.assertEquals('object', str(data['HardnessType'].dtype))
+        self.assertEquals(['rockwell a'] * 3, list(data['HardnessType']))
+
+        # Unknown types are rejected when the flattener is validated
+        with self.assertRaises(ValidationError):
+            ExtractorFlattener(name='Bad', location=['NoSuchTag'], dtype='notatype').validate()
+
+    def test_column_reuse(self):
+        flatteners = [
+            ExtractorFlattener(name='HardnessType', location=['HardnessMeasurement', 'Hardness', 'measurement-type']),
+            PhysicalQuantityExtractorFlattener(name='Temperature',
+                                               location=['HardnessMeasurement', 'AgingCondition', 'temperature'])
+        ]
+        extractor = MDCSExtractor(flatteners=flatteners)
+        entries = [self.test_xml] * 3
+        first = extractor.flatten_entries(entries)
+        self.assertEquals(['HardnessType', 'Temperature'], [name for name, _ in extractor.column_fingerprints])
+
+        # Change one flattener. The other column should be copied from the previous result
+        first['HardnessType'] = 'copied'
+        extractor.flatteners[1].units = 'kelvin'
+        second = extractor.flatten_entries(entries, previous=first)
+        self.assertEquals(['copied'] * 3, list(second['HardnessType']))
+        self.assertEquals([25 + 273.15] * 3, list(second['Temperature']))
+
+        # Without previous data, everything is recomputed
+        third = extractor.flatten_entries(entries)
+        self.assertEquals(['rockwell a'] * 3, list(third['HardnessType']))
+
+    def test_record_reuse(self):
+        connect_to_database(name='pinyon_test', host="")
+        directory = mkdtemp()
+        original_cache = mdcs_extract.record_cache
+        mdcs_extract.record_cache = RecordCache(directory)
+        try:
+            # Store the records locally. The host does not exist, so any download would fail
+            mdcs_extract.record_cache.update('http://localhost:1', 'template-id', [self.test_xml] * 3)
+            extractor = MDCSExtractor(name='Test', host='http://localhost:1', username='user', template='Hardness',
+                                      template_id='template-id', template_id_title='Hardness',
+                                      flatteners=[ExtractorFlattener(name='HardnessType',
+                                                                     location=['HardnessMeasurement', 'Hardness',
+                                                                               'measurement-type'])])
+            data = extractor.get_data().get_object()
+            self.assertEquals(['rockwell a'] * 3, list(data['HardnessType']))
+
+            # Changing a flattener and re-running should flatten the stored records again, without downloading them
+            extractor.flatteners[0].name = 'Type'
+            data = extractor.get_data(ignore_cache=True).get_object()
+            self.assertEquals(['rockwell a'] * 3, list(data['Type']))
+
+            # Revalidating the records requires contacting the host
+            with self.assertRaises(Exception):
+                extractor.get_data(revalidate=True)
+        finally:
+            mdcs_extract.record_cache = original_cache
+            shutil.rmtree(directory)
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+import cProfile
+from unittest import TestCase
+
+from pandas import DataFrame
+
+from pinyon.artifacts import PandasArtifact, ProfileArtifact
+
+
+class TestArtifacts(TestCase):
+
+    def test_rendered(self):
+        artifact = PandasArtifact(name='data', description='Test data')
+        artifact.set_object(DataFrame({'a': [1, 2, 3], 'b': [u'α', u'β', u'γ']}))
+        self.assertFalse(artifact.is_rendered('csv'))
+
+        # Render, and make sure it is stored
+        csv = artifact.render_output('csv')
+        html = artifact.render_output('html')
+        self.assertTrue(artifact.is_rendered('csv'))
+        self.assertTrue(artifact.is_rendered('html'))
+        self.assertFalse(artifact.is_rendered('csv', sep='\t'))
+        self.assertFalse(artifact.is_rendered('pkl'))
+
+        # Make sure the stored copy survives a trip through the database
+        artifact = PandasArtifact._from_son(artifact.to_mongo())
+        self.assertTrue(artifact.is_rendered('html'))
+        self.assertEquals(csv, artifact.render_output('csv'))
+        self.assertEquals(html, artifact.render_output('html'))
+        self.assertEquals(type(html), type(artifact.render_output('html')))
+
+        # Options are stored separately
+        self.assertNotEquals(csv, artifact.render_output('csv', sep='\t'))
+        self.assertTrue(artifact.is_rendered('csv', sep='\t'))
+
+        # Changing the data clears the stored outputs
+        artifact.set_object(DataFrame({'a': [4]}))
+        self.assertFalse(artifact.is_rendered('csv'))
+        self.assertNotEquals(csv, artifact.render_output('csv'))
+
+    def test_size_limit(self):
+        artifact = PandasArtifact(name='data', description='Test data')
+        artifact.max_rendered_size = 10
+        artifact.set_object(DataFrame({'a': range(100)}))
+        artifact.render_output('csv')
+        self.assertFalse(artifact.is_rendered('csv'))
+
+    def test_profile(self):
+        profiler = cProfile.Profile()
+        profiler.enable()
+        sorted(range(1000), key=lambda x: -x)
+        profiler.disable()
+
+        artifact = ProfileArtifact(name='profile', description='Test profile')
+        artifact.set_object(profiler)
+        self.assertGreater(artifact.get_object().total_calls, 0)
+
+        # Render it
+        self.assertIn('cumulative', artifact.render_output('txt'))
+        self.assertEquals(artifact.object, artifact.render_output('pstats'))
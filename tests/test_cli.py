@@ -0,0 +1,35 @@
+from unittest import TestCase
+
+from pinyon import mongodb_settings
+from pinyon.cli import make_parser, get_database_settings
+
+
+class TestCLI(TestCase):
+
+    def test_parser(self):
+        args = make_parser().parse_args(['run-tool', 'abc', '--subtree', '--jobs', '4'])
+        self.assertEquals('run-tool', args.command)
+        self.assertEquals('abc', args.tool_id)
+        self.assertTrue(args.subtree)
+        self.assertEquals(4, args.jobs)
+        self.assertFalse(args.profile)
+        self.assertTrue(make_parser().parse_args(['run-tool', 'abc', '--profile']).profile)
+
+        args = make_parser().parse_args(['run-toolchain', 'TestChain', '--skip-extractor'])
+        self.assertEquals('TestChain', args.name)
+        self.assertTrue(args.skip_extractor)
+
+    def test_settings(self):
+        # Defaults come from the pinyon settings
+        args = make_parser().parse_args(['run-toolchain', 'TestChain'])
+        self.assertEquals(mongodb_settings, get_database_settings(args, environ={}))
+
+        # Environment overrides the defaults
+        settings = get_database_settings(args, environ={'PINYON_DB_NAME': 'envdb', 'PINYON_DB_PORT': '1234'})
+        self.assertEquals('envdb', settings['name'])
+        self.assertEquals(1234, settings['port'])
+
+        # Command line overrides the environment
+        args = make_parser().parse_args(['--db-name', 'clidb', 'run-toolchain', 'TestChain'])
+        settings = get_database_settings(args, environ={'PINYON_DB_NAME': 'envdb'})
+        self.assertEquals('clidb', settings['name'])
@@ -0,0 +1,62 @@
+from unittest import TestCase
+
+import pickle
+
+from mongoengine import Document
+
+from pinyon.compression import compress, decompress, available_codecs, CompressedBinaryField, CompressedBlob
+
+
+class TestCompression(TestCase):
+
+    def test_codecs(self):
+        data = pickle.dumps(range(10000))
+
+        for codec in available_codecs():
+            blob = compress(data, codec)
+            self.assertEquals(data, decompress(blob))
+            if codec != 'none':
+                self.assertLess(len(blob), len(data))
+
+    def test_legacy(self):
+        # Uncompressed data is passed through
+        data = pickle.dumps(dict(a=1))
+        self.assertEquals(data, decompress(data))
+        self.assertIsNone(decompress(None))
+
+    def test_field(self):
+        field = CompressedBinaryField(codec='zlib', lazy=False)
+        data = 'Hello' * 1000
+
+        stored = field.to_mongo(data)
+        self.assertLess(len(stored), len(data))
+        self.assertEquals(data, field.to_python(stored))
+
+        # Unchanged values are not compressed again
+        self.assertIs(stored, field.to_python(stored).compressed)
+        self.assertEquals(stored, field.to_mongo(field.to_python(stored)))
+
+        # Values that are already uncompressed, or were stored as strings, are unchanged
+        self.assertEquals(data, field.to_python(data))
+        self.assertEquals(data, field.to_python(unicode(data)))
+
+    def test_lazy(self):
+        class Blobs(Document):
+            meta = {'collection': 'test_compression_blobs'}
+            first = CompressedBinaryField(codec='zlib')
+            second = CompressedBinaryField(codec='zlib')
+
+        data = 'Hello' * 1000
+        stored = Blobs._fields['first'].to_mongo(data)
+        doc = Blobs._from_son({'first': stored, 'second': stored})
+
+        # Values are decompressed only when accessed
+        self.assertIsInstance(doc._data['first'], CompressedBlob)
+        self.assertEquals(data, doc.first)
+        self.assertNotIsInstance(doc._data['first'], CompressedBlob)
+        self.assertIsInstance(doc._data['second'], CompressedBlob)
+
+        # Neither is compressed again when stored
+        son = doc.to_mongo()
+        self.assertEquals(stored, son['first'])
+        self.assertEquals(stored, son['second'])
@@ -0,0 +1,53 @@
+import json
+from unittest import TestCase
+
+from bson import ObjectId
+
+from pinyon import connect_to_database
+from pinyon.events import RunEvent, format_event, stream_events
+from pinyon.extract import ExcelExtractor
+from pinyon.toolchain import ToolChain
+from pinyon.tool import WorkflowTool
+from pinyon.tool.simple import ColumnAddTransformer
+
+
+class TestEvents(TestCase):
+
+    def setUp(self):
+        connect_to_database(name='pinyon_test', host="")
+
+    def test_run(self):
+        for doc in [ExcelExtractor, ToolChain, WorkflowTool, RunEvent]:
+            doc.drop_collection()
+
+        # Make a toolchain with a single tool
+        tc = ToolChain(name='TestChain', description='A sample toolchain')
+        tc.extractor = ExcelExtractor(name='TravelTimeLoader', description='Load travel times from Excel file',
+                                      path='./test-files/travel-times.xlsx', sheet="To")
+        tc.extractor.save()
+        tc.save()
+        tool = ColumnAddTransformer(name='Add', description='Test', toolchain=tc, column_names=['new'],
+                                    skip_register=True)
+        tool.save()
+
+        # Run it, and check the events
+        tc.extractor.get_data(ignore_cache=True, run_subsequent=True, save_results=True)
+        events = list(RunEvent.objects(toolchain=tc.id).order_by('id'))
+        self.assertEquals([('TravelTimeLoader', 'started'), ('TravelTimeLoader', 'finished'),
+                           ('Add', 'started'), ('Add', 'finished')],
+                          [(e.source_name, e.event) for e in events])
+        self.assertEquals(events[1].rows_out, events[3].rows_in)
+        self.assertEquals(events[3].rows_in, events[3].rows_out)
+        self.assertIsNotNone(events[3].duration)
+
+        # Render them as server-sent events
+        message = format_event(events[0])
+        self.assertTrue(message.startswith('id: %s\n' % events[0].id))
+        self.assertEquals('started', json.loads(message.split('data: ')[1])['event'])
+
+        # Stream them
+        self.assertEquals(4, len(list(stream_events(tc.id, timeout=0))))
+        self.assertEquals(2, len(list(stream_events(tc.id, after=str(events[1].id), timeout=0.5, interval=0.1))))
+
+        # Resuming from an event that is no longer stored starts with the recent history
+        self.assertEquals(4, len(list(stream_events(tc.id, after=str(ObjectId()), timeout=0))))
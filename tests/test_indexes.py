@@ -0,0 +1,58 @@
+from unittest import TestCase
+
+from pinyon import connect_to_database, ensure_indexes, KnownClass
+from pinyon.extract import BaseExtractor, ExcelExtractor
+from pinyon.toolchain import ToolChain
+from pinyon.tool import WorkflowTool
+
+
+def find_stages(plan):
+    """Get the names of all stages in a query plan"""
+    output = []
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            output.append(plan['stage'])
+        for value in plan.values():
+            output.extend(find_stages(value))
+    elif isinstance(plan, list):
+        for value in plan:
+            output.extend(find_stages(value))
+    return output
+
+
+class TestIndexes(TestCase):
+
+    def setUp(self):
+        connect_to_database(name='pinyon_test', host="")
+        for doc in [BaseExtractor, ToolChain, WorkflowTool]:
+            doc.drop_collection()
+        ensure_indexes()
+
+        # Make many toolchains, each with a short chain of tools
+        for i in range(50):
+            ex = ExcelExtractor(name='Extractor%d' % i, description='Test', path='none.xlsx', sheet='To')
+            ex.save()
+            tc = ToolChain(name='TestChain%d' % i, description='A sample toolchain', extractor=ex)
+            tc.save()
+            previous = None
+            for j in range(4):
+                tool = WorkflowTool(name='Tool%d' % j, description='Test', toolchain=tc,
+                                    previous_step=previous, skip_register=True)
+                tool.save()
+                previous = tool
+
+    def assertNoCollectionScan(self, queryset):
+        plan = queryset.explain()
+        stages = find_stages(plan.get('queryPlanner', plan))
+        self.assertNotIn('COLLSCAN', stages)
+
+    def test_queries(self):
+        tc = ToolChain.objects.get(name='TestChain25')
+        tool = WorkflowTool.objects(toolchain=tc).first()
+
+        self.assertNoCollectionScan(WorkflowTool.objects.filter(previous_step=tool))
+        self.assertNoCollectionScan(WorkflowTool.objects.filter(toolchain=tc))
+        self.assertNoCollectionScan(WorkflowTool.objects.filter(toolchain=tc, previous_step__exists=False))
+        self.assertNoCollectionScan(BaseExtractor.objects(name='Extractor25'))
+        self.assertNoCollectionScan(ToolChain.objects(extractor=tc.extractor))
+        self.assertNoCollectionScan(KnownClass.objects(module_name='pinyon.tool', class_name='WorkflowTool'))
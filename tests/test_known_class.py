@@ -0,0 +1,44 @@
+from unittest import TestCase
+
+import pinyon
+from pinyon import connect_to_database, KnownClass, LazyClassQuerySet
+from pinyon.tool import WorkflowTool
+from pinyon.tool.simple import FilterTransformer
+
+
+class TestKnownClass(TestCase):
+
+    def setUp(self):
+        connect_to_database(name='pinyon_test', host="")
+        KnownClass.drop_collection()
+        pinyon._registered_classes.clear()
+
+    def test_register(self):
+        FilterTransformer()
+
+        # Make sure the class and its hierarchy are recorded
+        known = KnownClass.objects.get(module_name='pinyon.tool.simple', class_name='FilterTransformer')
+        self.assertEquals('WorkflowTool.FilterTransformer', known.class_hierarchy)
+
+        # Make sure it is only registered once
+        FilterTransformer()
+        self.assertEquals(1, KnownClass.objects(class_name='FilterTransformer').count())
+
+        # Make sure it is found as a tool without instantiating anything
+        self.assertIn(('pinyon.tool.simple', 'FilterTransformer'), KnownClass.get_subclasses('WorkflowTool'))
+        self.assertNotIn(('pinyon.tool.simple', 'FilterTransformer'), KnownClass.get_subclasses('BaseExtractor'))
+
+    def test_queryset(self):
+        # Base class should not filter on the class at all
+        self.assertEquals({}, LazyClassQuerySet.get_class_query(WorkflowTool))
+
+        # Subclasses should match any class further down their hierarchy
+        query = LazyClassQuerySet.get_class_query(FilterTransformer)
+        self.assertEquals({'$regex': '^WorkflowTool\\.FilterTransformer(\\.|$)'}, query['_cls'])
+
+        # Documents of classes that have not been imported should be found through any class above them
+        WorkflowTool.drop_collection()
+        WorkflowTool._get_collection().insert_one({'_cls': 'WorkflowTool.FilterTransformer.NotImported',
+                                                   'name': 'NotImported'})
+        self.assertEquals(1, WorkflowTool.objects(name='NotImported').count())
+        self.assertEquals(1, FilterTransformer.objects(name='NotImported').count())
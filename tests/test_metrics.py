@@ -0,0 +1,62 @@
+from unittest import TestCase
+
+from pandas import DataFrame
+
+from pinyon import metrics
+from pinyon.artifacts import PandasArtifact
+from pinyon.utility import LRUCache
+
+
+class TestMetrics(TestCase):
+
+    def test_counter(self):
+        registry = metrics.Registry()
+        counter = metrics.Counter('test_total', 'A test counter', ['kind'], registry=registry)
+        counter.inc(kind='a')
+        counter.inc(2, kind='a')
+        counter.inc(kind='b"c')
+        self.assertEquals(3, counter.get(kind='a'))
+        self.assertRaises(ValueError, counter.inc, -1, kind='a')
+        self.assertRaises(ValueError, counter.inc)
+
+        # Render it
+        text = registry.render()
+        self.assertIn('# TYPE test_total counter\n', text)
+        self.assertIn('test_total{kind="a"} 3.0\n', text)
+        self.assertIn('test_total{kind="b\\"c"} 1.0\n', text)
+
+    def test_histogram(self):
+        registry = metrics.Registry()
+        histogram = metrics.Histogram('test_seconds', 'A test histogram', registry=registry, buckets=[1, 0.1])
+        for value in [0.05, 0.5, 5]:
+            histogram.observe(value)
+        with histogram.time():
+            pass
+        self.assertEquals(4, histogram.get_count())
+        self.assertAlmostEquals(5.55, histogram.get_sum(), places=2)
+
+        # Buckets are cumulative
+        text = registry.render()
+        self.assertIn('test_seconds_bucket{le="0.1"} 2\n', text)
+        self.assertIn('test_seconds_bucket{le="1.0"} 3\n', text)
+        self.assertIn('test_seconds_bucket{le="+Inf"} 4\n', text)
+        self.assertIn('test_seconds_count 4\n', text)
+
+    def test_cache(self):
+        registry = metrics.Registry()
+        cache = LRUCache()
+        registry.register_cache('test', cache)
+        cache.set('a', 1)
+        cache.get('a')
+        cache.get('b')
+        text = registry.render()
+        self.assertIn('pinyon_cache_hits_total{cache="test"} 1.0\n', text)
+        self.assertIn('pinyon_cache_misses_total{cache="test"} 1.0\n', text)
+        self.assertIn('pinyon_cache_entries{cache="test"} 1.0\n', text)
+
+    def test_artifact_bytes(self):
+        before = metrics.artifact_bytes.get(type='PandasArtifact', operation='serialize')
+        artifact = PandasArtifact(name='data', description='Test data')
+        artifact.set_object(DataFrame({'a': [1, 2, 3]}))
+        self.assertEquals(before + len(artifact.object),
+                          metrics.artifact_bytes.get(type='PandasArtifact', operation='serialize'))
@@ -2,7 +2,8 @@ from unittest import TestCase
 
 from pinyon import connect_to_database
 from pinyon.extract import ExcelExtractor
-from pinyon.toolchain import ToolChain
+from pinyon.toolchain import ToolChain, get_tree_stats
+from pinyon.tool import WorkflowTool
 from pinyon.tool.simple import ColumnAddTransformer
 
 
@@ -25,3 +26,53 @@ class TestToolChain(TestCase):
         self.assertEquals('TestChain', tc.name)
         self.assertEquals('A sample toolchain', tc.description)
         self.assertEquals(ExcelExtractor.__name__, tc.extractor.__class__.__name__)
+
+    def test_tree_stats(self):
+        # Only the extractor
+        self.assertEquals(dict(depth=1, width=1), get_tree_stats([]))
+
+        # Extractor -> a -> (b -> d, c), and extractor -> e
+        edges = [('a', None), ('b', 'a'), ('c', 'a'), ('d', 'b'), ('e', None)]
+        self.assertEquals(dict(depth=4, width=3), get_tree_stats(edges))
+
+    def test_summary(self):
+        for doc in [ExcelExtractor, ToolChain, WorkflowTool]:
+            doc.drop_collection()
+        tc = self.make_class()
+        tc.extractor.save()
+        tc.save()
+        self.assertEquals(dict(depth=1, width=1, tool_count=0), ToolChain.objects.get(id=tc.id).get_stats())
+
+        # Make the tools: extractor -> a -> b, extractor -> c
+        a = WorkflowTool(name='a', description='Test', toolchain=tc, skip_register=True)
+        a.save()
+        b = WorkflowTool(name='b', description='Test', toolchain=tc, previous_step=a, skip_register=True)
+        b.save()
+        WorkflowTool(name='c', description='Test', toolchain=tc, skip_register=True).save()
+
+        # Check the stored summary
+        stored = ToolChain.objects.get(id=tc.id)
+        self.assertEquals(dict(depth=3, width=2, tool_count=3), stored.get_stats())
+        self.assertEquals(['a', 'b', 'c'], [t['name'] for t in stored.get_tool_status()])
+        self.assertEquals('TravelTimeLoader', stored.get_extractor_summary()['name'])
+        hierarchy = stored.get_tool_hierarchy()
+        self.assertEquals('TravelTimeLoader', hierarchy['name'])
+        self.assertEquals(['a', 'c'], [x['name'] for x in hierarchy['children']])
+        self.assertEquals(['b'], [x['name'] for x in hierarchy['children'][0]['children']])
+
+        # Changing the status of a tool only updates its entry
+        b.last_error = 'Exception: Failed'
+        b.save()
+        stored = ToolChain.objects.get(id=tc.id)
+        status = dict((t['name'], t) for t in stored.get_tool_status())
+        self.assertEquals('Exception: Failed', status['b']['last_error'])
+        summary = ToolChain.get_summaries()[0]
+        self.assertEquals(3, summary['tool_count'])
+        self.assertEquals(3, summary['depth'])
+        self.assertEquals(1, summary['error_count'])
+
+        # Deleting a tool moves its children up
+        a.delete()
+        stored = ToolChain.objects.get(id=tc.id)
+        self.assertEquals(dict(depth=2, width=2, tool_count=2), stored.get_stats())
+        self.assertEquals(['b', 'c'], sorted(x['name'] for x in stored.get_tool_hierarchy()['children']))
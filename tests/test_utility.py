@@ -3,9 +3,10 @@ from unittest import TestCase
 from bson.objectid import ObjectId
 
 from pinyon import connect_to_database
+from pinyon.artifacts import Artifact
 from pinyon.extract import ExcelExtractor
 from pinyon.toolchain import ToolChain
-from pinyon.utility import Note
+from pinyon.utility import Note, LRUCache
 from pinyon.tool import WorkflowTool
 
 
@@ -24,6 +25,57 @@ class TestNote(TestCase):
         self.assertGreater(note.edited, note.created)
 
 
+class TestLRUCache(TestCase):
+
+    def test_eviction(self):
+        cache = LRUCache(max_entries=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+
+        # Use a, so that b is the least recently used
+        self.assertEquals(1, cache.get('a'))
+        cache.set('c', 3)
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertEquals(2, len(cache))
+
+        # Check the counts
+        self.assertIsNone(cache.get('b'))
+        self.assertEquals(1, cache.hits)
+        self.assertEquals(1, cache.misses)
+
+    def test_ttl(self):
+        now = [0]
+        cache = LRUCache(ttl=10, timer=lambda: now[0])
+        cache.set('a', 1)
+
+        now[0] = 5
+        self.assertEquals(1, cache.get('a'))
+
+        now[0] = 11
+        self.assertIsNone(cache.get('a'))
+        self.assertEquals(0, len(cache))
+
+    def test_max_size(self):
+        cache = LRUCache(max_size=10)
+        cache.set('a', 'x' * 4)
+        cache.set('b', 'x' * 4)
+        self.assertEquals(8, cache.size)
+
+        # Adding c must evict a, the least recently used
+        cache.set('c', 'x' * 4)
+        self.assertNotIn('a', cache)
+        self.assertEquals(8, cache.size)
+
+        # Entries larger than the limit are not stored
+        cache.set('d', 'x' * 11)
+        self.assertNotIn('d', cache)
+        self.assertEquals(2, len(cache))
+
+        cache.clear()
+        self.assertEquals(0, cache.size)
+
+
 class BogusTool(WorkflowTool):
     def _run(self, data, other_inputs):
         return data, {'data2': data}
@@ -88,4 +140,17 @@ class TestWorkFlow(TestCase):
         self.assertIsNone(y.previous_step)
         self.assertEquals(x.toolchain, y.toolchain.id)
         self.assertIsNone(y._result_cache)
-        self.assertIsNone(y.result)
\ No newline at end of file
+        self.assertIsNone(y.result)
+
+    def test_limit_rendered(self):
+        x = WorkflowTool(skip_register=True)
+        x.max_total_rendered_size = 10
+        x.result = dict(a=Artifact(name='a', description='Test', object='a'),
+                        b=Artifact(name='b', description='Test', object='b'))
+        x.result['a'].rendered = {'small': 'x' * 3, 'large': 'x' * 6}
+        x.result['b'].rendered = {'medium': 'x' * 5}
+
+        # The largest output should be removed first
+        x.limit_rendered()
+        self.assertEquals(['small'], x.result['a'].rendered.keys())
+        self.assertEquals(['medium'], x.result['b'].rendered.keys())
@@ -2,7 +2,8 @@ import unittest
 
 from pandas import DataFrame
 
-from pinyon.tool.simple import FilterTransformer, RequiredFieldTransformer, ColumnAddTransformer, SimpleEvalTransformer
+from pinyon.tool.simple import FilterTransformer, RequiredFieldTransformer, ColumnAddTransformer, SimpleEvalTransformer, \
+    _engine_cache
 
 
 class TestFilter(unittest.TestCase):
@@ -19,6 +20,26 @@ class TestFilter(unittest.TestCase):
         self.assertEquals(1, len(data))
         self.assertEquals([1], list(data.index))
 
+    def test_engines(self):
+        data = DataFrame([[1, 1], [0, 0]], columns=['a', 'b'])
+
+        # Python engine gives the same answer
+        trans = FilterTransformer(query='a < 0.5', engine='python', skip_register=True)
+        result, _ = trans._run(data, {})
+        self.assertEquals([1], list(result.index))
+
+        # Expressions numexpr does not support fall back to the Python engine
+        data['c'] = ['x', 'y']
+        trans = FilterTransformer(query='c.str.contains("y")', engine='numexpr', skip_register=True)
+        result, _ = trans._run(data, {})
+        self.assertEquals([1], list(result.index))
+        self.assertEquals('python', _engine_cache.get(('query', 'c.str.contains("y")', 'numexpr')))
+
+        # Errors in the expression itself are not retried
+        trans = FilterTransformer(query='nosuchcolumn < 0.5', engine='numexpr', skip_register=True)
+        self.assertRaises(NameError, trans._run, data, {})
+        self.assertIsNone(_engine_cache.get(('query', 'nosuchcolumn < 0.5', 'numexpr')))
+
 
 class TestColumnAdd(unittest.TestCase):
 
@@ -3,7 +3,7 @@ from unittest import TestCase
 
 from pinyon.extract import ExcelExtractor
 from pinyon.toolchain import ToolChain
-from pinyon.tool.decision import HTMLDecisionTracker
+from pinyon.tool.decision import HTMLDecisionTracker, SingleEntryBokehHTMLDecisionTracker
 
 
 class DecisionTest(TestCase):
@@ -65,3 +65,32 @@ class DecisionTest(TestCase):
         self.assertEquals(previous_results, wt._decisions_cache)
 
 
+class PrerenderTest(TestCase):
+
+    def test_fingerprint(self):
+        wt = SingleEntryBokehHTMLDecisionTracker(name='TestTool', description='Test', skip_register=True)
+        fingerprint = wt.get_entry_fingerprint('datahash', 'A', {})
+
+        # Same entry, data and decisions give the same fingerprint
+        self.assertEquals(fingerprint, wt.get_entry_fingerprint('datahash', 'A', {}))
+
+        # Changes to the data, entry, decisions or notebook give a different fingerprint
+        self.assertNotEquals(fingerprint, wt.get_entry_fingerprint('newhash', 'A', {}))
+        self.assertNotEquals(fingerprint, wt.get_entry_fingerprint('datahash', 'B', {}))
+        self.assertNotEquals(fingerprint, wt.get_entry_fingerprint('datahash', 'A', {'Route': ('1', '2', 'Notes')}))
+        wt.notebook += ' '
+        self.assertNotEquals(fingerprint, wt.get_entry_fingerprint('datahash', 'A', {}))
+
+    def test_entry_keys(self):
+        wt = SingleEntryBokehHTMLDecisionTracker(name='TestTool', description='Test', skip_register=True)
+        wt._decisions_cache = {(1, 'Route'): ('1', '2', 'Notes'), (2, 'Route'): ('3', '4', 'Notes')}
+
+        # Keys from the web pages are strings, even if entries are identified by row number
+        self.assertEquals({'Route': ('1', '2', 'Notes')}, wt.get_decisions_for_entry('1'))
+        self.assertEquals(wt.get_decisions_for_entry(1), wt.get_decisions_for_entry('1'))
+
+        # Plots that have not been saved are found with either form of the key
+        wt._prerendered_cache = {'1': ('fingerprint', dict(div='', script=''))}
+        self.assertEquals('fingerprint', wt.get_prerendered_plot(1)[0])
+        self.assertIsNone(wt.get_prerendered_plot('2'))
+
@@ -1,8 +1,13 @@
 from unittest import TestCase
 
+import nbformat
+from pandas import DataFrame
+
 from pinyon.extract import ExcelExtractor
 from pinyon.toolchain import ToolChain
-from pinyon.tool.jupyter import JupyterNotebookTransformer
+from pinyon.tool.jupyter import JupyterNotebookTransformer, add_data, strip_notebook, get_notebook_key, \
+    run_notebook, run_notebook_batch, execute_notebook, NotebookTimeout
+from pinyon.utility import LRUCache
 
 
 class TestNotebook(TestCase):
@@ -26,3 +31,101 @@ class TestNotebook(TestCase):
         jt.calc_settings['multiple'] = 2
         output = jt.run(ignore_results=True)
         self.assertTrue(all(mult1 * 2 == output['data']['DayOfWeek']))
+
+    def test_strip(self):
+        nb = nbformat.reads(open('./test-files/jupyter_example.ipynb').read(), nbformat.NO_CONVERT)
+
+        # Add a large dataset, and a large output
+        add_data(nb, {'data': DataFrame({'a': range(10000)})}, {})
+        nb.cells[-1]['outputs'] = [nbformat.v4.new_output('execute_result', data={'text/plain': 'x' * 10000},
+                                                          execution_count=1)]
+        nb.cells[4]['outputs'] = [nbformat.v4.new_output('stream', name='stdout', text='y' * 10000)]
+
+        # Strip it
+        strip_notebook(nb, max_output_size=1000)
+        self.assertNotIn('pickle.loads', nb.cells[2]['source'])
+        self.assertEquals([], nb.cells[-1]['outputs'])
+        self.assertIn('truncated', nb.cells[4]['outputs'][0]['text'])
+        self.assertLess(len(nbformat.writes(nb)), 10000)
+
+    def test_separate_storage(self):
+        tc = ToolChain(name='TestChain', description='A sample toolchain', skip_register=True)
+        tc.extractor = ExcelExtractor(path='./test-files/travel-times.xlsx', sheet='To', skip_register=True)
+
+        jt = JupyterNotebookTransformer.load_notebook('Test', 'Test notebook', './test-files/jupyter_example.ipynb')
+        jt.calc_settings = {'multiple': 1}
+        jt.notebook_storage = 'separate'
+        jt.toolchain = tc
+        original = jt.notebook
+
+        # Notebook should be unchanged, and the record should not contain the inputs
+        jt.run(ignore_results=True)
+        self.assertEquals(original, jt.notebook)
+        self.assertIsNotNone(jt.execution_record)
+        self.assertNotIn('pickle.loads', jt.execution_record)
+
+    def test_notebook_key(self):
+        nb = nbformat.reads(open('./test-files/jupyter_example.ipynb').read(), nbformat.NO_CONVERT)
+        key = get_notebook_key(nb, {'data': 1}, {'multiple': 1})
+
+        # Should not depend on the inputs stored in the notebook
+        add_data(nb, {'data': 2}, {})
+        self.assertEquals(key, get_notebook_key(nb, {'data': 1}, {'multiple': 1}))
+
+        # Should change with the inputs, settings or code
+        self.assertNotEquals(key, get_notebook_key(nb, {'data': 2}, {'multiple': 1}))
+        self.assertNotEquals(key, get_notebook_key(nb, {'data': 1}, {'multiple': 2}))
+        nb.cells[4]['source'] += '\n'
+        self.assertNotEquals(key, get_notebook_key(nb, {'data': 1}, {'multiple': 1}))
+
+    def test_batch(self):
+        notebook = open('./test-files/jupyter_example.ipynb').read()
+        data = DataFrame({'Date': ['2016-06-16', '2016-06-17']})
+        data['Date'] = data['Date'].astype('datetime64[ns]')
+
+        # Run the notebook separately and as a batch
+        settings = [{'multiple': 1}, {'multiple': 2}]
+        results = run_notebook_batch(notebook, [{}, {}], settings, shared_inputs={'data': data})
+        self.assertEquals(2, len(results))
+        for result, setting in zip(results, settings):
+            _, expected = run_notebook(notebook, {'data': data.copy()}, setting)
+            self.assertEquals(list(expected['data']['DayOfWeek']), list(result['data']['DayOfWeek']))
+
+        # Runs that fail return None, without affecting the others
+        results = run_notebook_batch(notebook, [{'data': None}, {}], {'multiple': 1}, shared_inputs={'data': data})
+        self.assertIsNone(results[0])
+        self.assertIsNotNone(results[1])
+
+    def test_cache(self):
+        notebook = open('./test-files/jupyter_example.ipynb').read()
+        data = DataFrame({'Date': ['2016-06-16', '2016-06-17']})
+        data['Date'] = data['Date'].astype('datetime64[ns]')
+        cache = LRUCache()
+
+        # Only the outputs are stored
+        nb, first = run_notebook(notebook, {'data': data}, {'multiple': 1}, cache=cache)
+        self.assertIsNotNone(nb)
+        nb, second = run_notebook(notebook, {'data': data}, {'multiple': 1}, cache=cache)
+        self.assertIsNone(nb)
+        self.assertEquals(1, cache.hits)
+        self.assertEquals(list(first['data']['DayOfWeek']), list(second['data']['DayOfWeek']))
+
+    def test_timeout(self):
+        nb = nbformat.reads(open('./test-files/jupyter_example.ipynb').read(), nbformat.NO_CONVERT)
+        nb.cells[2]['source'] = 'import time\ntime.sleep(30)\n' + nb.cells[2]['source']
+
+        # Notebook should be stopped well before it finishes
+        with self.assertRaises(NotebookTimeout):
+            execute_notebook(nb, timeout=2)
+
+    def test_execution_id(self):
+        # Unsaved tools must not share an ID, or cancelling one would stop the other
+        first = JupyterNotebookTransformer(name='First', description='Test', skip_register=True)
+        second = JupyterNotebookTransformer(name='Second', description='Test', skip_register=True)
+        self.assertNotEquals(first.get_execution_id(), second.get_execution_id())
+        self.assertFalse(first.cancel())
+
+        first.timeout = 10
+        options = first.get_notebook_options()
+        self.assertEquals(10, options['timeout'])
+        self.assertEquals(first.get_execution_id(), options['execution_id'])
@@ -0,0 +1,44 @@
+import unittest
+from datetime import datetime, timedelta
+
+from pandas import DataFrame
+from webob import Request
+
+from pinyon.artifacts import PandasArtifact
+from pinyon.web.caching import make_etag, is_not_modified, not_modified_response, render_artifact, render_cache
+
+
+class TestCaching(unittest.TestCase):
+
+    def test_conditional(self):
+        last_run = datetime(2016, 7, 1, 12, 0, 0)
+        etag = make_etag('tool', last_run, 'data', 'csv')
+        self.assertNotEquals(etag, make_etag('tool', datetime.now(), 'data', 'csv'))
+
+        # No conditions
+        self.assertFalse(is_not_modified(Request.blank('/'), etag, last_run))
+
+        # Matching and non-matching entity tags
+        self.assertTrue(is_not_modified(Request.blank('/', headers={'If-None-Match': '"%s"' % etag}), etag, last_run))
+        self.assertFalse(is_not_modified(Request.blank('/', headers={'If-None-Match': '"other"'}), etag, last_run))
+
+        # Modification times
+        response = not_modified_response(etag, last_run)
+        self.assertEquals(304, response.status_int)
+        request = Request.blank('/', headers={'If-Modified-Since': response.headers['Last-Modified']})
+        self.assertTrue(is_not_modified(request, etag, last_run))
+        self.assertFalse(is_not_modified(request, etag, last_run + timedelta(minutes=1)))
+
+    def test_render_cache(self):
+        artifact = PandasArtifact(name='data', description='Test data')
+        artifact.set_object(DataFrame({'a': [1, 2, 3]}))
+
+        # Second render should come from the cache
+        first = render_artifact(artifact, 'csv')
+        hits = render_cache.hits
+        self.assertEquals(first, render_artifact(artifact, 'csv'))
+        self.assertEquals(hits + 1, render_cache.hits)
+
+        # Changing the data should change the output
+        artifact.set_object(DataFrame({'a': [4, 5, 6]}))
+        self.assertNotEquals(first, render_artifact(artifact, 'csv'))
@@ -0,0 +1,57 @@
+import json
+import os
+import shutil
+import unittest
+from tempfile import mkdtemp
+
+from pandas import DataFrame
+from webob import Request
+
+from pinyon.web import export
+from pinyon.web.export import streamed_formats, negotiate_format, iter_csv, iter_json_lines, get_parquet_file
+
+
+class TestExport(unittest.TestCase):
+
+    def setUp(self):
+        self.data = DataFrame({'a': range(25), 'b': ['x%d' % i for i in range(25)]})
+
+    def test_negotiate(self):
+        self.assertEquals('csv', negotiate_format(Request.blank('/'), streamed_formats))
+        self.assertEquals('jsonl', negotiate_format(Request.blank('/?format=jsonl'), streamed_formats))
+        self.assertIsNone(negotiate_format(Request.blank('/?format=nope'), streamed_formats))
+        request = Request.blank('/', headers={'Accept': 'application/vnd.apache.parquet'})
+        self.assertEquals('parquet', negotiate_format(request, streamed_formats))
+        request = Request.blank('/', headers={'Accept': 'text/html,*/*;q=0.8'})
+        self.assertEquals('csv', negotiate_format(request, streamed_formats))
+
+    def test_csv(self):
+        chunks = list(iter_csv(self.data, chunksize=10))
+        self.assertEquals(3, len(chunks))
+        self.assertEquals(self.data.to_csv(index=False), ''.join(chunks))
+        self.assertEquals(DataFrame({'a': []}).to_csv(index=False), ''.join(iter_csv(DataFrame({'a': []}))))
+
+    def test_json_lines(self):
+        lines = ''.join(iter_json_lines(self.data, chunksize=10)).splitlines()
+        self.assertEquals(25, len(lines))
+        self.assertEquals({'a': 24, 'b': 'x24'}, json.loads(lines[-1]))
+
+    @unittest.skipIf(export.pyarrow is None, 'pyarrow is not installed')
+    def test_parquet(self):
+        directory = mkdtemp()
+        original = export.export_cache_dir
+        export.export_cache_dir = directory
+        try:
+            # Same version gives the same file
+            first = get_parquet_file(self.data, 'test', 1)
+            self.assertEquals(first, get_parquet_file(self.data, 'test', 1))
+
+            # A new version replaces the old file, but not those of other datasets
+            other = get_parquet_file(self.data, 'other', 1)
+            second = get_parquet_file(self.data, 'test', 2)
+            self.assertNotEquals(first, second)
+            files = sorted(os.path.join(directory, f) for f in os.listdir(directory))
+            self.assertEquals(sorted([other, second]), files)
+        finally:
+            export.export_cache_dir = original
+            shutil.rmtree(directory)
@@ -0,0 +1,29 @@
+import unittest
+
+from pyramid.config import Configurator
+from pyramid.response import Response
+from webtest import TestApp
+
+from pinyon import metrics
+
+
+class TestMetricsView(unittest.TestCase):
+
+    def setUp(self):
+        config = Configurator()
+        config.include('pinyon.web.metrics')
+        config.scan('pinyon.web.metrics')
+        config.add_route('hello', '/hello')
+        config.add_view(lambda request: Response('hello'), route_name='hello')
+        self.testapp = TestApp(config.make_wsgi_app())
+
+    def test_scrape(self):
+        before = metrics.request_count.get(route='hello', method='GET', status=200)
+        self.testapp.get('/hello', status=200)
+        self.assertEquals(before + 1, metrics.request_count.get(route='hello', method='GET', status=200))
+
+        # Scrape the metrics
+        res = self.testapp.get('/metrics', status=200)
+        self.assertTrue(res.content_type.startswith('text/plain'))
+        self.assertIn(b'# TYPE pinyon_http_request_duration_seconds histogram', res.body)
+        self.assertIn(b'pinyon_http_requests_total{route="hello",method="GET",status="200"}', res.body)
@@ -0,0 +1,49 @@
+import unittest
+
+from pyramid.config import Configurator
+from pyramid.response import Response
+from webtest import TestApp
+
+from pinyon.web.profiling import query_listener, route_stats
+
+
+class CommandEvent(object):
+    """Holds the fields of a completed command that are read by the listener"""
+
+    def __init__(self, command_name, duration_micros):
+        self.command_name = command_name
+        self.duration_micros = duration_micros
+
+
+def many_queries(request):
+    for i in range(3):
+        query_listener.succeeded(CommandEvent('find', 1000))
+    query_listener.failed(CommandEvent('update', 2000))
+    return Response('done')
+
+
+class TestQueryProfiling(unittest.TestCase):
+
+    def setUp(self):
+        config = Configurator(settings={'pinyon.profile_queries.max_queries': '2'})
+        config.include('pinyon.web.profiling')
+        config.add_route('many', '/many')
+        config.add_view(many_queries, route_name='many')
+        self.testapp = TestApp(config.make_wsgi_app())
+
+    def test_tween(self):
+        # Commands outside of a request are not counted
+        query_listener.succeeded(CommandEvent('find', 1000))
+        self.testapp.get('/many', status=200)
+        self.testapp.get('/many', status=200)
+
+        stats = route_stats.summarize()['many']
+        self.assertEquals(2, stats['requests'])
+        self.assertEquals(8, stats['queries'])
+        self.assertEquals(4, stats['max_queries'])
+        self.assertEquals(2, stats['slow_requests'])
+        self.assertAlmostEquals(0.005, stats['mean_query_time'])
+
+        # Served as JSON
+        res = self.testapp.get('/profile/queries', status=200)
+        self.assertEquals(4.0, res.json['many']['mean_queries'])
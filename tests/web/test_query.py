@@ -0,0 +1,53 @@
+import json
+import unittest
+
+from pandas import DataFrame
+
+from pinyon.web.query import QueryError, parse_query, run_query, to_json
+
+
+class TestQuery(unittest.TestCase):
+
+    def setUp(self):
+        self.data = DataFrame({'a': [3, 1, 4, 1, 5], 'b': ['x', 'y', 'z', 'w', 'v']})
+
+    def test_parse(self):
+        self.assertEquals({}, parse_query({}))
+        self.assertEquals(dict(columns=['a', 'b'], start=1, stop=3, filter='a > 1', sort=['-a']),
+                          parse_query({'columns': 'a, b', 'start': '1', 'stop': '3', 'filter': 'a > 1',
+                                       'sort': '-a'}))
+        with self.assertRaises(QueryError):
+            parse_query({'start': 'one'})
+
+    def test_query(self):
+        # Columns and ranges
+        result, total = run_query(self.data, columns=['b'], start=1, stop=3)
+        self.assertEquals(5, total)
+        self.assertEquals(['b'], list(result.columns))
+        self.assertEquals(['y', 'z'], list(result['b']))
+
+        # Filter and sort
+        result, total = run_query(self.data, filter='a > 1', sort=['-a'])
+        self.assertEquals(3, total)
+        self.assertEquals([5, 4, 3], list(result['a']))
+
+        # Bad queries
+        with self.assertRaises(QueryError):
+            run_query(self.data, columns=['c'])
+        with self.assertRaises(QueryError):
+            run_query(self.data, sort=['-c'])
+        with self.assertRaises(QueryError):
+            run_query(self.data, filter='a >')
+
+        # Filters numexpr cannot handle are rejected, rather than run with the Python engine
+        with self.assertRaises(QueryError):
+            run_query(self.data, filter='b.str.contains("y")')
+
+    def test_json(self):
+        result, total = run_query(self.data, start=2, stop=4)
+        output = json.loads(to_json(result, total, 2))
+        self.assertEquals(5, output['total'])
+        self.assertEquals(2, output['start'])
+        self.assertEquals([2, 3], output['index'])
+        self.assertEquals(['a', 'b'], output['columns'])
+        self.assertEquals([[4, 'z'], [1, 'w']], output['data'])